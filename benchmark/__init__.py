@@ -0,0 +1,3 @@
+"""
+Benchmarks of pmemcached, run with python -m benchmark --help.
+"""
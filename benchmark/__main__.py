@@ -0,0 +1,106 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+from .load import free_port, parse_sizes, run_load, start_server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmark',
+        description='Measure the throughput and latency of pmemcached.')
+    parser.add_argument('--server', metavar='HOST:PORT',
+        help='Benchmark a running server instead of starting one')
+    parser.add_argument('--server-args', default='',
+        help='Extra arguments for the server started, like '
+        '--server-args="-s slab"')
+    parser.add_argument('-d', '--duration', type=float, default=10,
+        help='Seconds to measure for (default: %(default)s)')
+    parser.add_argument('-c', '--connections', type=int, default=8,
+        help='Connections per process (default: %(default)s)')
+    parser.add_argument('-P', '--processes', type=int, default=1,
+        help='Load generating processes (default: %(default)s)')
+    parser.add_argument('--pipeline', type=int, default=1,
+        help='Requests in flight per connection (default: %(default)s)')
+    parser.add_argument('-k', '--keys', type=int, default=10000,
+        help='Size of the key space (default: %(default)s)')
+    parser.add_argument('-s', '--value-size', default='100',
+        help='Value size in bytes, N or MIN-MAX (default: %(default)s)')
+    parser.add_argument('-r', '--get-ratio', type=float, default=0.9,
+        help='Fraction of requests that are gets (default: %(default)s)')
+    parser.add_argument('-z', '--zipf', type=float, default=0.99,
+        help='Zipf exponent of the key popularity, 0 for uniform '
+        '(default: %(default)s)')
+    parser.add_argument('--no-fill', dest='fill', action='store_false',
+        help="Don't set every key before measuring")
+    parser.add_argument('--seed', type=int, default=0,
+        help='Random seed (default: %(default)s)')
+    parser.add_argument('-o', '--output', metavar='PATH',
+        help='Write the configuration and results as JSON to PATH')
+    return parser.parse_args(argv)
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = {
+        'processes': args.processes,
+        'connections': args.connections,
+        'pipeline': args.pipeline,
+        'duration': args.duration,
+        'keys': args.keys,
+        'sizes': parse_sizes(args.value_size),
+        'get_ratio': args.get_ratio,
+        'zipf': args.zipf,
+        'fill': args.fill,
+        'seed': args.seed,
+    }
+
+    server = None
+    if args.server:
+        host, _, port = args.server.rpartition(':')
+        options.update(host=host or '127.0.0.1', port=int(port))
+    else:
+        options.update(host='127.0.0.1', port=free_port())
+        server = start_server(options['port'], args.server_args.split())
+
+    started = time.time()
+    try:
+        results = run_load(options)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {
+        'config': dict(vars(args), sizes=options['sizes']),
+        'commit': commit(),
+        'python': '%s %s' % (platform.python_implementation(),
+            platform.python_version()),
+        'started': started,
+        'results': results.report(),
+    }
+
+    measured = report['results']
+    latency = measured['latency_us']
+    print('%d operations in %.2f seconds: %.0f ops/s, %d errors' % (
+        measured['operations'], measured['seconds'], measured['throughput'],
+        measured['errors']))
+    print('Latency in microseconds: p50 %d, p99 %d, p999 %d, max %d' % (
+        latency['p50'], latency['p99'], latency['p999'], latency['max']))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    return 1 if measured['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,331 @@
+"""
+Load generator speaking the binary protocol to a pmemcached server.
+
+Every connection keeps --pipeline requests in flight for --duration
+seconds, picking keys with a Zipfian popularity and values of
+--value-size bytes. The key space is filled before measuring so gets hit.
+"""
+import bisect
+import multiprocessing
+import random
+import socket
+import subprocess
+import sys
+import time
+from timeit import default_timer
+from twisted.internet import defer, protocol, reactor
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from pmemcached import codec
+from pmemcached.client import MemcachedClientProtocol
+from pmemcached.stats import Histogram
+
+GET = 0x00
+SET = 0x01
+SUCCESS = 0x00
+NOT_FOUND = 0x01
+
+
+class Zipf:
+    """
+    Samples ranks in [0, n) with a probability proportional to
+    1 / (rank + 1) ** s, so rank 0 is the most popular. s of 0 is uniform.
+    """
+    def __init__(self, n, s, random):
+        self.n = n
+        self.random = random
+        self.cdf = None
+        if s:
+            total = 0.0
+            cdf = []
+            for rank in range(n):
+                total += 1.0 / (rank + 1) ** s
+                cdf.append(total)
+            self.cdf = [weight / total for weight in cdf]
+
+    def sample(self):
+        if self.cdf is None:
+            return int(self.random.random() * self.n)
+        return min(bisect.bisect_left(self.cdf, self.random.random()),
+            self.n - 1)
+
+
+def parse_sizes(sizes):
+    """
+    A value size is either N or MIN-MAX, picked uniformly.
+    """
+    low, _, high = sizes.partition('-')
+    low = int(low)
+    high = int(high) if high else low
+    if not 0 <= low <= high:
+        raise ValueError('Invalid value sizes %r' % sizes)
+    return low, high
+
+
+def make_key(rank):
+    return ('key:%010d' % rank).encode('ascii')
+
+
+def get_frame(key):
+    return codec.encodeRequestHeader(GET, len(key), 0, 0, len(key), 0, 0) + \
+        key
+
+
+def set_frame(key, value):
+    extras = codec.STORE_EXTRAS.size
+    return codec.encodeRequestHeader(SET, len(key), extras, 0,
+        extras + len(key) + len(value), 0, 0) + \
+        codec.STORE_EXTRAS.pack(0, 0) + key + value
+
+
+class Workload:
+    """
+    Builds the requests of one process, seeded so runs are repeatable.
+    """
+    def __init__(self, keys, sizes, get_ratio, zipf, seed):
+        self.random = random.Random(seed)
+        self.keys = [make_key(rank) for rank in range(keys)]
+        self.sizes = sizes
+        self.get_ratio = get_ratio
+        self.zipf = Zipf(keys, zipf, self.random)
+        self.value = b'x' * sizes[1]
+
+    def value_for(self):
+        low, high = self.sizes
+        if low == high:
+            return self.value
+        return self.value[:self.random.randint(low, high)]
+
+    def fill(self, index, count):
+        """
+        Set requests for the share of the key space of process index.
+        """
+        for key in self.keys[index::count]:
+            yield set_frame(key, self.value_for())
+
+    def requests(self):
+        keys = self.keys
+        sample = self.zipf.sample
+        ratio = self.get_ratio
+        rand = self.random.random
+        while True:
+            key = keys[sample()]
+            if rand() < ratio:
+                yield get_frame(key)
+            else:
+                yield set_frame(key, self.value_for())
+
+
+class Results:
+    """
+    What a process measured, merged across processes.
+    """
+    def __init__(self):
+        self.operations = 0
+        self.gets = 0
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.errors = 0
+        self.elapsed = 0.0
+        self.latency = Histogram()
+
+    def record(self, frame, seconds):
+        self.operations += 1
+        status = codec.STATUS.unpack_from(frame, codec.STATUS_OFFSET)[0]
+        if frame[codec.OPCODE_OFFSET:codec.OPCODE_OFFSET + 1] == b'\x00':
+            self.gets += 1
+            if status == SUCCESS:
+                self.hits += 1
+            elif status == NOT_FOUND:
+                self.misses += 1
+            else:
+                self.errors += 1
+        else:
+            self.sets += 1
+            if status != SUCCESS:
+                self.errors += 1
+        self.latency.record(int(seconds * 1000000))
+
+    def merge(self, other):
+        for name in ('operations', 'gets', 'hits', 'misses', 'sets',
+            'errors'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        # Processes run side by side
+        self.elapsed = max(self.elapsed, other.elapsed)
+        self.latency.merge(other.latency)
+
+    def report(self):
+        latency = self.latency
+        return {
+            'operations': self.operations,
+            'seconds': round(self.elapsed, 3),
+            'throughput': round(self.operations / self.elapsed, 1)
+                if self.elapsed else 0,
+            'gets': self.gets,
+            'hits': self.hits,
+            'misses': self.misses,
+            'sets': self.sets,
+            'errors': self.errors,
+            'latency_us': {
+                'p50': latency.percentile(50),
+                'p99': latency.percentile(99),
+                'p999': latency.percentile(99.9),
+                'max': latency.max,
+            },
+        }
+
+
+class LoadClient(MemcachedClientProtocol):
+    """
+    Keeps pipeline requests in flight, taken from the requests iterator,
+    until it is exhausted or the load is stopped. Instead of deferreds the
+    time each request was sent at waits for its response.
+    """
+    def __init__(self, load):
+        MemcachedClientProtocol.__init__(self)
+        self.load = load
+        self.done = defer.Deferred()
+
+    def fill(self):
+        load = self.load
+        frames = []
+        while len(self.waiting) < load.pipeline and load.running:
+            try:
+                frames.append(next(load.requests))
+            except StopIteration:
+                load.running = False
+                break
+            self.waiting.append(default_timer())
+        if frames:
+            self.transport.writeSequence(frames)
+        elif not self.waiting:
+            self.transport.loseConnection()
+
+    def responseReceived(self, frame):
+        started = self.waiting.popleft()
+        if self.load.results is not None:
+            self.load.results.record(frame, default_timer() - started)
+
+    def dataReceived(self, data):
+        MemcachedClientProtocol.dataReceived(self, data)
+        self.fill()
+
+    def connectionLost(self, reason):
+        self.done.callback(None)
+
+
+class Load:
+    """
+    Runs requests over connections, recording them into results unless it
+    is None.
+    """
+    def __init__(self, requests, pipeline, results=None):
+        self.requests = requests
+        self.pipeline = pipeline
+        self.results = results
+        self.running = True
+
+    @defer.inlineCallbacks
+    def run(self, endpoint, connections, duration=None):
+        factory = protocol.Factory()
+        factory.buildProtocol = lambda address: LoadClient(self)
+        clients = []
+        for i in range(connections):
+            clients.append((yield endpoint.connect(factory)))
+
+        started = default_timer()
+        for client in clients:
+            client.fill()
+        if duration is not None:
+            stop = reactor.callLater(duration, setattr, self, 'running',
+                False)
+        yield defer.gatherResults([client.done for client in clients])
+        if duration is not None and stop.active():
+            stop.cancel()
+        if self.results is not None:
+            self.results.elapsed = default_timer() - started
+
+
+def run_process(options):
+    """
+    Fill this process' share of the key space and measure. Runs its own
+    reactor, so it is the whole life of a process.
+    """
+    index = options['index']
+    workload = Workload(options['keys'], options['sizes'],
+        options['get_ratio'], options['zipf'], options['seed'] + index)
+    endpoint = TCP4ClientEndpoint(reactor, options['host'], options['port'])
+    results = Results()
+    failures = []
+
+    @defer.inlineCallbacks
+    def run():
+        try:
+            if options['fill']:
+                yield Load(workload.fill(index, options['processes']),
+                    options['pipeline']).run(endpoint, options['connections'])
+            yield Load(workload.requests(), options['pipeline'],
+                results).run(endpoint, options['connections'],
+                options['duration'])
+        except Exception as e:
+            failures.append(e)
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+    if failures:
+        raise failures[0]
+    return results
+
+
+def run_load(options):
+    """
+    Run options['processes'] load generators and merge what they measured.
+    """
+    count = options['processes']
+    processes = [dict(options, index=index) for index in range(count)]
+    if count == 1:
+        return run_process(processes[0])
+
+    # Spawned, a forked child would share the reactor of this process
+    pool = multiprocessing.get_context('spawn').Pool(count)
+    try:
+        measured = pool.map(run_process, processes)
+    finally:
+        pool.close()
+        pool.join()
+    results = Results()
+    for other in measured:
+        results.merge(other)
+    return results
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def start_server(port, arguments, timeout=10):
+    """
+    Run pmemcached on port with the extra command line arguments and wait
+    until it accepts connections.
+    """
+    server = subprocess.Popen([sys.executable, '-m', 'pmemcached', '-p',
+        str(port), '--log-level', 'warning'] + arguments)
+    deadline = time.time() + timeout
+    while True:
+        if server.poll() is not None:
+            raise SystemExit('The server exited with %d' % server.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return server
+        except socket.error:
+            if time.time() > deadline:
+                server.terminate()
+                raise SystemExit('The server did not start')
+            time.sleep(0.1)
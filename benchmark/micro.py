@@ -0,0 +1,326 @@
+"""
+Microbenchmarks of the protocol and storages, in process and without
+sockets, run with python -m benchmark.micro.
+
+Every benchmark reports:
+
+- ns/op, the best of a few timed runs.
+- B/op, the most memory allocated at once while running one operation,
+  as seen by tracemalloc.
+- blocks/op, memory blocks still allocated after an operation, anything
+  but 0 means operations keep memory around.
+
+With --baseline, the results are compared to a previous --output and the
+run fails when a benchmark got slower than --threshold.
+"""
+import argparse
+import fnmatch
+import json
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from twisted.internet import task
+from twisted.test import proto_helpers
+from pmemcached import codec
+from pmemcached.server import Memcached, MemcachedFactory
+from pmemcached.storages.memory import Storage as MemoryStorage
+from pmemcached.storages.oplog import Storage as OpLogStorage
+from pmemcached.storages.slab import Storage as SlabStorage
+from pmemcached.storages.tiered import Storage as TieredStorage
+
+KEY = b'benchmark:key'
+VALUE = b'x' * 100
+
+BENCHMARKS = []
+
+
+def benchmark(setup):
+    """
+    Register setup, which returns the operation to measure and a function
+    releasing what it needs.
+    """
+    BENCHMARKS.append((setup.__name__, setup))
+    return setup
+
+
+def patch_clock(storage):
+    clock = task.Clock()
+    storage.callLater = clock.callLater
+    storage.seconds = clock.seconds
+    return storage
+
+
+def make_protocol():
+    storage = patch_clock(MemoryStorage())
+    storage[KEY] = {'flags': 0, 'expiry': 0, 'value': VALUE}
+    protocol = MemcachedFactory(storage).buildProtocol(('127.0.0.1', 0))
+    protocol.makeConnection(proto_helpers.StringTransport())
+    return protocol
+
+
+def request(command, key=b'', extras=b'', value=b''):
+    return codec.encodeRequestHeader(command, len(key), len(extras), 0,
+        len(extras) + len(key) + len(value), 0, 0) + extras + key + value
+
+
+def nothing():
+    pass
+
+
+def discard_responses(protocol):
+    """
+    Drop what protocol queued or wrote, so it doesn't pile up over runs.
+    """
+    del protocol._responses[:]
+    protocol._queued = 0
+    protocol.transport.clear()
+
+
+@benchmark
+def handle_header():
+    protocol = make_protocol()
+    header = memoryview(request(Memcached.COMMANDS['get'], KEY))[
+        :codec.HEADER_SIZE]
+    return lambda: protocol.handleHeader(header), nothing
+
+
+def handle_data(frame):
+    protocol = make_protocol()
+
+    def op():
+        protocol.handleData(frame)
+        discard_responses(protocol)
+    return op, nothing
+
+
+@benchmark
+def handle_data_noop():
+    return handle_data(request(Memcached.COMMANDS['noop']))
+
+
+@benchmark
+def handle_data_get():
+    return handle_data(request(Memcached.COMMANDS['get'], KEY))
+
+
+@benchmark
+def handle_data_set():
+    return handle_data(request(Memcached.COMMANDS['set'], KEY,
+        codec.STORE_EXTRAS.pack(0, 0), VALUE))
+
+
+@benchmark
+def handle_data_multiget():
+    return handle_data(b''.join(request(Memcached.COMMANDS['getkq'], KEY)
+        for i in range(16)) + request(Memcached.COMMANDS['noop']))
+
+
+@benchmark
+def send_message_value():
+    protocol = make_protocol()
+    success = Memcached.STATUSES['success']
+
+    def op():
+        protocol.sendMessage(0x00, 0, 4, success, 0, 1, 0, VALUE)
+        discard_responses(protocol)
+    return op, nothing
+
+
+@benchmark
+def send_message_status():
+    protocol = make_protocol()
+    notFound = Memcached.STATUSES['key_not_found']
+
+    def op():
+        protocol.sendMessage(0x00, 0, 0, notFound, 0, 0)
+        discard_responses(protocol)
+    return op, nothing
+
+
+def memory_storage():
+    return patch_clock(MemoryStorage()), nothing
+
+
+def slab_storage():
+    return patch_clock(SlabStorage()), nothing
+
+
+def oplog_storage():
+    directory = tempfile.mkdtemp()
+    # Created with the clock of the reactor, patched right after
+    storage = patch_clock(OpLogStorage(os.path.join(directory, 'log'),
+        fsync='never'))
+
+    def release():
+        storage.close()
+        shutil.rmtree(directory)
+    return storage, release
+
+
+def tiered_storage():
+    directory = tempfile.mkdtemp()
+    storage = patch_clock(TieredStorage(path=os.path.join(directory, 'cold'),
+        cold_bytes=16 * 1024 * 1024))
+    return storage, lambda: shutil.rmtree(directory)
+
+
+STORAGES = [('memory', memory_storage), ('slab', slab_storage),
+    ('oplog', oplog_storage), ('tiered', tiered_storage)]
+
+
+def storage_benchmarks(name, make):
+    def setitem():
+        storage, release = make()
+
+        def op():
+            storage[KEY] = {'flags': 0, 'expiry': 0, 'value': VALUE}
+            storage.commit()
+        return op, release
+
+    def getitem():
+        storage, release = make()
+        storage[KEY] = {'flags': 0, 'expiry': 0, 'value': VALUE}
+        storage.commit()
+        return lambda: storage[KEY], release
+
+    def contains():
+        storage, release = make()
+        storage[KEY] = {'flags': 0, 'expiry': 0, 'value': VALUE}
+        storage.commit()
+        return lambda: KEY in storage, release
+
+    def expiry():
+        storage, release = make()
+
+        def op():
+            storage[KEY] = {'flags': 0, 'expiry': 60, 'value': VALUE}
+            storage._expire_key(KEY)
+            storage.commit()
+        return op, release
+
+    for setup in (setitem, getitem, contains, expiry):
+        setup.__name__ = '%s_%s' % (name, setup.__name__)
+        benchmark(setup)
+
+
+for name, make in STORAGES:
+    storage_benchmarks(name, make)
+
+
+def peak_allocated(op):
+    """
+    Return the most memory op held at once while running, tracemalloc
+    must be tracing.
+    """
+    if hasattr(tracemalloc, 'reset_peak'):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        op()
+        return tracemalloc.get_traced_memory()[1] - current
+    # Before Python 3.9 tracing again is the only way to reset the peak
+    tracemalloc.stop()
+    tracemalloc.start()
+    op()
+    return tracemalloc.get_traced_memory()[1]
+
+
+def measure(setup, repeat=5, allocations=1000):
+    op, release = setup()
+    try:
+        timer = timeit.Timer(op)
+        number = timer.autorange()[0]
+        best = min(timer.repeat(repeat, number)) / number
+
+        tracemalloc.start()
+        try:
+            op()
+            before = tracemalloc.take_snapshot()
+            for i in range(allocations):
+                op()
+            after = tracemalloc.take_snapshot()
+            peak = sum(peak_allocated(op) for i in range(allocations))
+        finally:
+            tracemalloc.stop()
+        # Leaving out what measuring allocated
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__)]
+        blocks = sum(stat.count_diff for stat in
+            after.filter_traces(ignore).compare_to(
+                before.filter_traces(ignore), 'lineno'))
+    finally:
+        release()
+
+    return {
+        'ns_per_op': round(best * 1e9, 1),
+        'bytes_per_op': peak // allocations,
+        'blocks_per_op': round(float(blocks) / allocations, 3),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Return the names of the benchmarks more than threshold times slower
+    than in baseline.
+    """
+    slower = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before and result['ns_per_op'] > \
+            before['ns_per_op'] * (1 + threshold):
+            slower.append(name)
+    return slower
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmark.micro',
+        description='Microbenchmarks of the protocol and storages.')
+    parser.add_argument('-k', '--filter', default='*',
+        help='Only run benchmarks matching this pattern')
+    parser.add_argument('-o', '--output', metavar='PATH',
+        help='Write the results as JSON to PATH')
+    parser.add_argument('--baseline', metavar='PATH',
+        help='Results of a previous --output to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help='Slowdown over the baseline considered a regression '
+        '(default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    print('%-28s %12s %10s %10s %8s' % ('benchmark', 'ns/op', 'B/op',
+        'blocks/op', 'change'))
+    for name, setup in BENCHMARKS:
+        if not fnmatch.fnmatch(name, args.filter):
+            continue
+        result = results[name] = measure(setup)
+        change = ''
+        if name in baseline:
+            change = '%+.1f%%' % (100.0 * result['ns_per_op'] /
+                baseline[name]['ns_per_op'] - 100)
+        print('%-28s %12.1f %10d %10.3f %8s' % (name, result['ns_per_op'],
+            result['bytes_per_op'], result['blocks_per_op'], change))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    slower = compare(results, baseline, args.threshold)
+    if slower:
+        print('Slower than the baseline by more than %d%%: %s' % (
+            args.threshold * 100, ', '.join(slower)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,222 @@
-from twisted.internet import protocol, reactor
-from .server import MemcachedFactory
-from .storages import getStorage
+import argparse
+import os
+import sys
+import tempfile
+from .compression import Compressor, Zlib
+from .logger import LEVELS, AccessLog, log
+from .server import Memcached, MemcachedFactory
+from .stats import Stats
+from .storages import STORAGES, getStorage
 
 
-def run_server():
-    reactor.listenTCP(11211, MemcachedFactory(getStorage('memory')))
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='pmemcached',
+        description='A binary protocol memcached server.')
+    parser.add_argument('-p', '--port', type=int, default=11211,
+        help='TCP port to listen on (default: %(default)s)')
+    parser.add_argument('-m', '--memory-limit', type=int, default=64,
+        help='Item memory in megabytes, 0 for unlimited '
+        '(default: %(default)s)')
+    parser.add_argument('-s', '--storage', choices=sorted(STORAGES),
+        default='memory', help='Storage backend (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+        help='Worker processes sharing the port, each one owns a shard of '
+        'the keys and of the memory limit (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=1,
+        help='Event loop threads sharing the port and a single thread safe '
+        'storage, like -s striped (default: %(default)s)')
+    parser.add_argument('--socket-dir', default=tempfile.gettempdir(),
+        help='Directory for the sockets workers use to talk to each other '
+        '(default: %(default)s)')
+    parser.add_argument('--log-path', default='pmemcached.log',
+        help='Operation log of the oplog storage (default: %(default)s)')
+    parser.add_argument('--fsync', choices=('always', 'interval', 'never'),
+        default='interval', help='When the oplog storage syncs its log to '
+        'disk: after every batch of requests, every --fsync-interval or '
+        'never (default: %(default)s)')
+    parser.add_argument('--fsync-interval', type=int, default=1000,
+        help='Milliseconds between syncs (default: %(default)s)')
+    parser.add_argument('--cold-path', default='pmemcached.cold',
+        help='File the tiered storage maps its cold tier from, removed '
+        'once mapped (default: %(default)s)')
+    parser.add_argument('--cold-size', type=int, default=1024,
+        help='Megabytes of the cold tier (default: %(default)s)')
+    parser.add_argument('--large-value', type=int, default=64 * 1024,
+        help='Values of this many bytes or more go straight to the cold '
+        'tier (default: %(default)s)')
+    parser.add_argument('--snapshot', metavar='PATH',
+        help='Load items from this file on startup and save them to it '
+        'periodically and on shutdown')
+    parser.add_argument('--snapshot-interval', type=int, default=300,
+        help='Seconds between snapshots (default: %(default)s)')
+    parser.add_argument('--replication-port', type=int,
+        help='Stream writes to the replicas connecting to this TCP port')
+    parser.add_argument('--replica-of', metavar='HOST:PORT',
+        help='Follow the primary whose --replication-port is at HOST:PORT')
+    parser.add_argument('--max-request-size', type=int,
+        default=Memcached.MAX_REQUEST, help='Requests with a bigger body are '
+        'answered with value_too_large (default: %(default)s)')
+    parser.add_argument('--max-pending', type=int,
+        default=Memcached.MAX_PENDING, help='Bytes of responses a '
+        'connection may have waiting to be sent before its requests stop '
+        'being read (default: %(default)s)')
+    parser.add_argument('--compress-threshold', type=int, default=0,
+        help='Compress stored values of this many bytes or more with zlib, '
+        '0 disables it (default: %(default)s)')
+    parser.add_argument('--compress-level', type=int, default=1,
+        choices=range(1, 10), metavar='{1..9}',
+        help='zlib compression level (default: %(default)s)')
+    parser.add_argument('--latency-sample', type=int, default=10,
+        help='Time one command out of this many for the latency stats, 0 '
+        'disables them (default: %(default)s)')
+    parser.add_argument('--hot-keys', type=int, default=10,
+        help='Keys with the most requests and bytes reported by stat '
+        'hotkeys, 0 disables their tracking (default: %(default)s)')
+    parser.add_argument('--hot-key-sample', type=int, default=10,
+        help='Track the key of one get or set out of this many '
+        '(default: %(default)s)')
+    parser.add_argument('--log-level', choices=sorted(LEVELS, key=LEVELS.get),
+        default='info', help='Least important messages logged to stderr '
+        '(default: %(default)s)')
+    parser.add_argument('--debug-sample', type=int, default=1,
+        help='Only log one debug message out of this many '
+        '(default: %(default)s)')
+    parser.add_argument('--access-log', metavar='PATH',
+        help='Append a JSON line per request to this file')
+    parser.add_argument('--event-loop', choices=('twisted', 'asyncio', 'uvloop'),
+        default='twisted', help='Serve connections with the Twisted reactor '
+        'or with asyncio, on its default loop or on uvloop '
+        '(default: %(default)s)')
+    parser.add_argument('--worker-index', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def setup_snapshots(args, storage):
+    from twisted.internet import reactor
+    from .snapshot import Snapshotter, load
+
+    path = args.snapshot
+    if args.worker_index is not None:
+        path = '%s.%d' % (path, args.worker_index)
+    if os.path.exists(path):
+        log.info('Loaded %d items from %s', load(storage, path), path)
+
+    snapshotter = Snapshotter(storage, path, args.snapshot_interval)
+    snapshotter.start()
+    reactor.addSystemEventTrigger('before', 'shutdown', snapshotter.stop)
+    reactor.addSystemEventTrigger('before', 'shutdown', snapshotter.snapshot)
+
+
+def setup_access_log(args):
+    from twisted.internet import reactor
+
+    path = args.access_log
+    if args.worker_index is not None:
+        path = '%s.%d' % (path, args.worker_index)
+    accessLog = AccessLog(path)
+    accessLog.start()
+    reactor.addSystemEventTrigger('during', 'shutdown', accessLog.close)
+    return accessLog
+
+
+def setup_replication(args, storage):
+    from twisted.internet import reactor
+    from .replication import Primary, Replica
+
+    if args.replica_of:
+        host, _, port = args.replica_of.rpartition(':')
+        replica = Replica(storage, host, int(port))
+        reactor.connectTCP(host, int(port), replica)
+        reactor.addSystemEventTrigger('before', 'shutdown', replica.stopTrying)
+        return replica
+
+    primary = Primary(storage)
+    reactor.listenTCP(args.replication_port, primary)
+    return primary
+
+
+def setup_stats(args):
+    stats = Stats(args.latency_sample, args.hot_keys, args.hot_key_sample)
+    stats.settings.update((name, value)
+        for name, value in sorted(vars(args).items()) if value is not None)
+    return stats
+
+
+def run_server(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ['proxy']:
+        from .proxy import run_proxy
+        return run_proxy(argv[1:])
+
+    args = parse_args(argv)
+    log.setLevel(LEVELS[args.log_level], args.debug_sample)
+    log.start(sys.stderr)
+
+    if args.threads > 1 and (args.workers > 1 or args.access_log):
+        raise SystemExit('--threads can not be used with --workers nor '
+            '--access-log')
+    if (args.replication_port or args.replica_of) and \
+        (args.workers > 1 or args.threads > 1):
+        raise SystemExit('Replication can not be used with --workers nor '
+            '--threads')
+    if args.replication_port and args.replica_of:
+        raise SystemExit('A replica can not have replicas')
+    if args.workers > 1 and args.worker_index is None:
+        from .workers import run_workers
+        return run_workers(args, argv)
+
+    if args.event_loop != 'twisted':
+        from .aio import install_reactor
+        install_reactor(args.event_loop)
+    from twisted.internet import reactor
+
+    options = {'max_bytes': args.memory_limit * 1024 * 1024 // args.workers}
+    if args.storage == 'oplog':
+        options.update(path=args.log_path, fsync=args.fsync,
+            fsync_interval=args.fsync_interval)
+        if args.worker_index is not None:
+            options['path'] = '%s.%d' % (args.log_path, args.worker_index)
+    elif args.storage == 'tiered':
+        options.update(path=args.cold_path,
+            cold_bytes=args.cold_size * 1024 * 1024 // args.workers,
+            large_value=args.large_value)
+        if args.worker_index is not None:
+            options['path'] = '%s.%d' % (args.cold_path, args.worker_index)
+    storage = getStorage(args.storage, **options)
+    if args.event_loop != 'twisted' or args.threads > 1:
+        # asyncio protocols sweep expired keys as they serve requests
+        storage.sweep_from_ticks()
+    reactor.addSystemEventTrigger('during', 'shutdown', storage.close)
+    if args.snapshot:
+        setup_snapshots(args, storage)
+
+    stats = setup_stats(args)
+    accessLog = setup_access_log(args) if args.access_log else None
+    compressor = Compressor(args.compress_threshold,
+        Zlib(args.compress_level))
+
+    replication = None
+    if args.replication_port or args.replica_of:
+        replication = setup_replication(args, storage)
+
+    if args.worker_index is not None:
+        from .workers import serve_worker
+        return serve_worker(args, storage, stats, accessLog, compressor)
+
+    if args.threads > 1:
+        from .threads import serve_threads
+        return serve_threads(args, storage, stats, compressor)
+
+    if args.event_loop == 'twisted':
+        reactor.listenTCP(args.port, MemcachedFactory(storage, stats=stats,
+            accessLog=accessLog, maxRequest=args.max_request_size,
+            maxPending=args.max_pending, compressor=compressor,
+            replication=replication))
+    else:
+        from . import aio
+        aio.listenTCP(args.port, aio.MemcachedFactory(storage, stats=stats,
+            accessLog=accessLog, maxRequest=args.max_request_size,
+            maxPending=args.max_pending, compressor=compressor,
+            replication=replication))
     reactor.run()
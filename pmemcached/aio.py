@@ -0,0 +1,174 @@
+"""
+asyncio transport of the protocol, picked with --event-loop.
+
+Twisted keeps running on top of the same event loop through its asyncio
+reactor, so snapshots, the operation log and forwarding between workers
+work unchanged, but connections are served by asyncio itself. Reads land
+straight in a preallocated buffer through BufferedProtocol.get_buffer and
+frames are parsed where they are, and expired keys are swept as requests
+are served instead of on timers, see BaseStorage.sweep_from_ticks.
+"""
+import asyncio
+import os
+import socket
+from twisted.internet.address import IPv4Address, IPv6Address, UNIXAddress
+from . import server
+
+
+def new_event_loop(name='asyncio'):
+    """
+    Return a new asyncio event loop, or a uvloop one.
+    """
+    if name == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            raise SystemExit('--event-loop uvloop needs uvloop installed')
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+def install_reactor(name='asyncio'):
+    """
+    Run Twisted on a new event loop, see new_event_loop, and return the
+    loop. It must be called before anything imports the reactor.
+    """
+    loop = new_event_loop(name)
+    asyncio.set_event_loop(loop)
+
+    from twisted.internet import asyncioreactor
+    asyncioreactor.install(loop)
+    return loop
+
+
+class Transport:
+    """
+    The parts of Twisted's ITransport the protocol uses, over an asyncio
+    transport. Writes are the asyncio methods themselves.
+    """
+    bufferSize = 64 * 1024
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.write = transport.write
+        self.writeSequence = transport.writelines
+        self.loseConnection = transport.close
+        self.pauseProducing = transport.pause_reading
+        self.resumeProducing = transport.resume_reading
+
+    def registerProducer(self, producer, streaming):
+        """
+        asyncio tells the protocol itself through pause_writing and
+        resume_writing instead, past bufferSize.
+        """
+        self.transport.set_write_buffer_limits(high=self.bufferSize)
+
+    def getPeer(self):
+        peer = self.transport.get_extra_info('peername')
+        if isinstance(peer, tuple):
+            if ':' in peer[0]:
+                return IPv6Address('TCP', peer[0], peer[1])
+            return IPv4Address('TCP', peer[0], peer[1])
+        return UNIXAddress(peer or None)
+
+
+class Memcached(server.Memcached, asyncio.BufferedProtocol):
+    # Bytes read from the socket at once, the buffer grows for frames that
+    # don't fit and shrinks back once they are handled
+    BUFFER_SIZE = 256 * 1024
+    MIN_READ = 4096
+
+    def __init__(self, factory):
+        super().__init__(factory)
+        self._buffer = bytearray(self.BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        # Received bytes not handled yet are _buffer[_start:_end]
+        self._start = 0
+        self._end = 0
+
+    def connection_made(self, transport):
+        self.transport = Transport(transport)
+        self.connectionMade()
+
+    def connection_lost(self, exc):
+        self.connectionLost(exc)
+
+    def pause_writing(self):
+        self.pauseProducing()
+
+    def resume_writing(self):
+        self.resumeProducing()
+
+    def handlePending(self):
+        self.buffer_updated(0)
+
+    def get_buffer(self, sizehint):
+        if len(self._buffer) - self._end < self.MIN_READ or \
+            self._start + self._needed > len(self._buffer):
+            self._compact()
+        return self._view[self._end:]
+
+    def _compact(self):
+        """
+        Move the pending bytes to the start of the buffer, to a bigger one
+        if the frame they begin doesn't fit.
+        """
+        pending = self._end - self._start
+        size = max(self._needed, pending) + self.MIN_READ
+        if size > len(self._buffer):
+            buffer = bytearray(max(size, 2 * len(self._buffer)))
+            buffer[:pending] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        else:
+            self._view[:pending] = self._view[self._start:self._end]
+        self._start = 0
+        self._end = pending
+
+    def buffer_updated(self, nbytes):
+        self.stats.bytes_read += nbytes
+        self._end += nbytes
+        if self._end - self._start < self._needed:
+            return
+
+        self._start += self.handleData(self._view[self._start:self._end])
+        if self._start == self._end:
+            self._start = self._end = 0
+            if len(self._buffer) > self.BUFFER_SIZE:
+                self._buffer = bytearray(self.BUFFER_SIZE)
+                self._view = memoryview(self._buffer)
+
+        storage = self.factory.storage
+        storage.tick()
+        storage.commit()
+        self.flushResponses()
+
+
+class MemcachedFactory(server.MemcachedFactory):
+    """
+    Used as the protocol factory of asyncio servers.
+    """
+    protocol = Memcached
+
+    def __call__(self):
+        return self.buildProtocol(None)
+
+
+def listenTCP(port, factory, interface='', reusePort=False, loop=None):
+    """
+    Serve factory on port, like reactor.listenTCP. Must be called before
+    the loop, the current one by default, runs.
+    """
+    if reusePort and not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit('Listening on a shared port needs SO_REUSEPORT '
+            'support')
+    loop = loop or asyncio.get_event_loop()
+    return loop.run_until_complete(loop.create_server(factory,
+        interface or None, port, reuse_port=reusePort or None))
+
+
+def listenUNIX(path, factory, loop=None):
+    if os.path.exists(path):
+        os.unlink(path)
+    loop = loop or asyncio.get_event_loop()
+    return loop.run_until_complete(loop.create_unix_server(factory, path))
@@ -0,0 +1,118 @@
+"""
+Pipelined binary protocol client used to talk to other servers.
+"""
+from collections import deque
+from twisted.internet import defer, protocol
+from . import codec
+from .logger import log
+
+
+class MemcachedClientProtocol(protocol.Protocol):
+    """
+    Requests are written as soon as they are made and their responses are
+    matched in order, so every request sent must be answered: quiet
+    commands can't go through here.
+    """
+    def __init__(self):
+        self._chunks = []
+        self._buffered = 0
+        self._needed = codec.HEADER_SIZE
+        self.waiting = deque()
+
+    def request(self, frame):
+        """
+        Send a complete request frame, the deferred fires with the complete
+        response frame.
+        """
+        d = defer.Deferred()
+        self.waiting.append(d)
+        self.transport.write(frame)
+        return d
+
+    def dataReceived(self, data):
+        if self._buffered:
+            self._chunks.append(data)
+            self._buffered += len(data)
+            if self._buffered < self._needed:
+                return
+            data = b''.join(self._chunks)
+
+        size = len(data)
+        offset = 0
+        self._needed = codec.HEADER_SIZE
+        while size - offset >= codec.HEADER_SIZE:
+            end = offset + codec.HEADER_SIZE + codec.BODY_LENGTH.unpack_from(
+                data, offset + codec.BODY_LENGTH_OFFSET)[0]
+            if end > size:
+                self._needed = end - offset
+                break
+            if not self.waiting:
+                log.warning('Unexpected response, dropping connection')
+                self.transport.loseConnection()
+                return
+            self.responseReceived(data[offset:end])
+            offset = end
+
+        if offset < size:
+            self._chunks = [data[offset:]]
+            self._buffered = size - offset
+        else:
+            self._chunks = []
+            self._buffered = 0
+
+    def responseReceived(self, frame):
+        self.waiting.popleft().callback(frame)
+
+    def connectionLost(self, reason):
+        waiting, self.waiting = self.waiting, deque()
+        for d in waiting:
+            d.errback(reason)
+        backend = getattr(self.factory, 'backend', None)
+        if backend is not None:
+            backend.clientLost(self)
+
+
+class Backend:
+    """
+    A lazily connected, pipelined connection to another server through a
+    twisted client endpoint. Requests made while connecting are queued and
+    a lost connection is made again on the next request.
+    """
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.client = None
+        self.connecting = False
+        self.queue = []
+        self.factory = protocol.Factory.forProtocol(MemcachedClientProtocol)
+        self.factory.backend = self
+        # Reconnections would log every time otherwise
+        self.factory.noisy = False
+
+    def request(self, frame):
+        if self.client is not None:
+            return self.client.request(frame)
+
+        d = defer.Deferred()
+        self.queue.append((frame, d))
+        if not self.connecting:
+            self.connecting = True
+            self.endpoint.connect(self.factory).addCallbacks(
+                self._connected, self._failed)
+        return d
+
+    def _connected(self, client):
+        self.connecting = False
+        self.client = client
+        queue, self.queue = self.queue, []
+        for frame, d in queue:
+            client.request(frame).chainDeferred(d)
+
+    def _failed(self, reason):
+        self.connecting = False
+        queue, self.queue = self.queue, []
+        for frame, d in queue:
+            d.errback(reason)
+
+    def clientLost(self, client):
+        if self.client is client:
+            self.client = None
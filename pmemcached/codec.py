@@ -0,0 +1,95 @@
+"""
+Precompiled structures for the memcached binary protocol.
+
+Every fixed layout of the protocol is compiled once here so request
+handling never builds format strings. Variable length parts (key and
+value) are sliced out of the request buffer instead of being unpacked.
+"""
+import struct
+
+HEADER = struct.Struct(''.join([
+    '!',  # big-endian
+    'B',  # Magic
+    'B',  # Command
+    'H',  # Key length
+    'B',  # Extras length
+    'B',  # Data type
+    'H',  # Status
+    'L',  # Body length
+    'L',  # Opaque
+    'Q',  # CAS
+]))
+HEADER_SIZE = HEADER.size
+
+# Single header fields, unpacked from a frame without decoding all of it
+OPCODE_OFFSET = 1
+OPAQUE = struct.Struct('!L')
+OPAQUE_OFFSET = 12
+STATUS = struct.Struct('!H')
+STATUS_OFFSET = 6
+BODY_LENGTH = struct.Struct('!L')
+BODY_LENGTH_OFFSET = 8
+
+# Extras layouts
+# Flags|expiry time, used by set, add and replace
+STORE_EXTRAS = struct.Struct('!LL')
+# Delta|initial value|expiry time, used by incr and decr
+COUNTER_EXTRAS = struct.Struct('!QQL')
+# Expiry time, used by flush
+FLUSH_EXTRAS = struct.Struct('!L')
+# Flags, sent back on get
+FLAGS = struct.Struct('!L')
+
+# Response header followed by the flags of a value, packed in one go
+VALUE_HEADER = struct.Struct(HEADER.format + 'L')
+
+# Body of incr and decr responses
+COUNTER = struct.Struct('!Q')
+
+MAGIC_REQUEST = 0x80
+MAGIC_RESPONSE = 0x81
+
+# Data type bit of values compressed with the server's codec, zlib unless
+# configured otherwise. In requests it means the client sends or accepts
+# compressed values. The binary protocol reserves this bit for Snappy, this
+# server uses it for its own codec instead, so clients sending or accepting
+# compressed values must use that codec.
+DATATYPE_COMPRESSED = 0x02
+
+
+def decodeHeader(data, offset=0):
+    """
+    Unpack the header found at offset of data, which may be any buffer.
+    """
+    return HEADER.unpack_from(data, offset)
+
+
+def encodeRequestHeader(command, keyLength, extLength, dataType, bodyLength,
+    opaque, cas):
+    return HEADER.pack(MAGIC_REQUEST, command, keyLength, extLength, dataType,
+        0x00, bodyLength, opaque, cas)
+
+
+def encodeHeader(command, keyLength, extLength, status, bodyLength,
+    opaque, cas):
+    return HEADER.pack(MAGIC_RESPONSE, command, keyLength, extLength, 0x00,
+        status, bodyLength, opaque, cas)
+
+
+def encodeValueHeader(command, keyLength, bodyLength, opaque, cas, flags,
+    dataType=0x00):
+    """
+    Header and flags of a successful response carrying a value.
+    """
+    return VALUE_HEADER.pack(MAGIC_RESPONSE, command, keyLength, FLAGS.size,
+        dataType, 0x00, bodyLength, opaque, cas, flags)
+
+
+def splitReply(command, status, message):
+    """
+    Encode a reply without key nor CAS around its opaque, which is the only
+    part that changes from one request to the next.
+    """
+    header = encodeHeader(command, 0, 0, status, len(message), 0, 0)
+    return (header[:OPAQUE_OFFSET],
+        header[OPAQUE_OFFSET + OPAQUE.size:] + message)
@@ -0,0 +1,109 @@
+"""
+Server side compression of stored values, see --compress-threshold.
+
+Values of threshold bytes or more are compressed when they are stored, if
+that makes them smaller, and kept with the codec.DATATYPE_COMPRESSED data
+type. Gets asking for that data type receive them as they are, the others
+get them decompressed. Values clients send compressed are stored as they
+are whatever the threshold.
+
+Compressing a value of THREAD_THRESHOLD bytes or more would stall the
+reactor, those are stored as they are and compressed in a thread pool,
+then swapped in unless they were written again meanwhile.
+"""
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from .codec import DATATYPE_COMPRESSED
+from .storages.base import OutOfMemory
+
+
+class Zlib:
+    """
+    The default codec. Any object with compress and decompress methods
+    will do, as long as clients sending and accepting compressed values
+    use the same one. decompress raises ValueError for data the codec did
+    not compress.
+    """
+    def __init__(self, level=1):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        try:
+            return zlib.decompress(data)
+        except zlib.error as e:
+            raise ValueError(str(e))
+
+
+class Compressor:
+    """
+    Compresses values of threshold bytes or more with codec, 0 only
+    decompresses the values clients sent compressed.
+    """
+    THREAD_THRESHOLD = 64 * 1024
+    THREADS = 2
+
+    def __init__(self, threshold=0, codec=None, threads=THREADS):
+        self.threshold = threshold
+        self.codec = codec if codec is not None else Zlib()
+        self.pool = ThreadPoolExecutor(threads, 'pmemcached-compress')
+        from twisted.internet import reactor
+        self.callInThread = self.pool.submit
+        self.callFromThread = reactor.callFromThread
+
+    def compress_item(self, item, stats):
+        """
+        Compress the value of item in place if it is worth it. Return
+        whether it has to be compressed later by compress_later instead.
+        """
+        value = item['value']
+        if not self.threshold or len(value) < self.threshold or \
+            item['datatype']:
+            return False
+        if len(value) >= self.THREAD_THRESHOLD:
+            return True
+
+        data = self.codec.compress(value)
+        if len(data) < len(value):
+            item['value'] = data
+            item['datatype'] = DATATYPE_COMPRESSED
+            stats.compressed(len(value), len(data))
+        return False
+
+    def compress_later(self, storage, key, cas, value, stats):
+        """
+        Compress value in the pool and swap it in for the item of key if
+        it still has cas.
+        """
+        self.callInThread(self._compress, storage, key, cas, value, stats)
+
+    def _compress(self, storage, key, cas, value, stats):
+        data = self.codec.compress(value)
+        if len(data) < len(value):
+            self.callFromThread(self._swap, storage, key, cas, len(value),
+                data, stats)
+
+    def _swap(self, storage, key, cas, size, data, stats):
+        try:
+            if storage.threadsafe:
+                with storage.lock(key):
+                    swapped = storage.swap_value(key, cas, data,
+                        DATATYPE_COMPRESSED)
+            else:
+                swapped = storage.swap_value(key, cas, data,
+                    DATATYPE_COMPRESSED)
+        except OutOfMemory:
+            return
+        if swapped:
+            storage.commit()
+            stats.compressed(size, len(data))
+
+    def decompress(self, value, stats):
+        """
+        Raise ValueError when value is not compressed with the codec, like
+        values clients sent with a wrong data type.
+        """
+        stats.decompressions += 1
+        return self.codec.decompress(value)
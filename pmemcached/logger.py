@@ -1 +1,130 @@
-from twisted.python import log
+"""
+Level gated logging on top of twisted.python.log.
+
+Messages take their arguments separately and are only formatted when their
+level is enabled, hot paths check log.debugging before calling at all.
+Debug messages are also sampled, only one out of debug_sample is logged.
+"""
+import json
+import time
+from twisted.internet import task
+from twisted.logger import FilteringLogObserver, LogLevel, \
+    LogLevelFilterPredicate, globalLogBeginner, textFileLogObserver
+from twisted.python import log as twistedLog
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+TWISTED_LEVELS = {DEBUG: LogLevel.debug, INFO: LogLevel.info,
+    WARNING: LogLevel.warn, ERROR: LogLevel.error}
+
+
+class Logger:
+    def __init__(self, level=INFO, debug_sample=1):
+        self.setLevel(level, debug_sample)
+
+    def setLevel(self, level, debug_sample=1):
+        self.level = level
+        self.debugging = level <= DEBUG
+        self.debug_sample = max(debug_sample, 1)
+        self._until_debug = 0
+
+    def start(self, output):
+        """
+        Write messages to output, Twisted's own ones included, from the
+        level up.
+        """
+        predicate = LogLevelFilterPredicate(
+            defaultLogLevel=TWISTED_LEVELS[self.level])
+        globalLogBeginner.beginLoggingTo([FilteringLogObserver(
+            textFileLogObserver(output), [predicate])],
+            redirectStandardIO=False)
+
+    def _emit(self, level, message, args):
+        if args:
+            message = message % args
+        twistedLog.msg(message, logLevel=level)
+
+    def debug(self, message, *args):
+        if not self.debugging:
+            return
+        if self._until_debug:
+            self._until_debug -= 1
+            return
+        self._until_debug = self.debug_sample - 1
+        self._emit(DEBUG, message, args)
+
+    def info(self, message, *args):
+        if self.level <= INFO:
+            self._emit(INFO, message, args)
+
+    msg = info
+
+    def warning(self, message, *args):
+        if self.level <= WARNING:
+            self._emit(WARNING, message, args)
+
+    def err(self, *args, **kwargs):
+        """
+        Failures are always logged, see twisted.python.log.err.
+        """
+        twistedLog.err(*args, **kwargs)
+
+
+log = Logger()
+
+
+class AccessLog:
+    """
+    One JSON line per request written to path. Requests only append a
+    tuple to a buffer, it is formatted and written every interval seconds
+    or as soon as the reactor is free once MAX_BUFFERED are waiting.
+    """
+    FIELDS = ('time', 'client', 'command', 'key', 'length')
+    MAX_BUFFERED = 10000
+
+    def __init__(self, path, interval=1):
+        self.path = path
+        self.interval = interval
+        self.output = open(path, 'a')
+        self.records = []
+        from twisted.internet import reactor
+        self.callLater = reactor.callLater
+        self.loop = task.LoopingCall(self.flush)
+        self._flush = None
+
+    def start(self):
+        self.loop.start(self.interval, now=False)
+
+    def record(self, client, command, key, length):
+        records = self.records
+        records.append((time.time(), client, command, key, length))
+        if len(records) >= self.MAX_BUFFERED and self._flush is None:
+            self._flush = self.callLater(0, self.flush)
+
+    def flush(self):
+        if self._flush is not None:
+            if self._flush.active():
+                self._flush.cancel()
+            self._flush = None
+        if not self.records:
+            return
+
+        records, self.records = self.records, []
+        lines = []
+        for record in records:
+            record = dict(zip(self.FIELDS, record))
+            record['key'] = record['key'].decode('utf-8', 'replace')
+            lines.append(json.dumps(record, sort_keys=True))
+        lines.append('')
+        self.output.write('\n'.join(lines))
+        self.output.flush()
+
+    def close(self):
+        if self.loop.running:
+            self.loop.stop()
+        self.flush()
+        self.output.close()
@@ -0,0 +1,187 @@
+"""
+Proxy mode, run with pmemcached proxy: clients talk to it like to any
+pmemcached server and every request with a key is forwarded to the backend
+server owning the key on a ketama consistent hash ring.
+
+Each backend gets a single persistent connection that requests of every
+client are pipelined over. The requests of a multi-get are split between
+backends that way, and their responses are merged back in the order the
+client sent them. Backends failing FAILURE_LIMIT requests in a row are
+ejected from the ring, so their keys move to the other ones, and put back
+after RETRY_INTERVAL seconds.
+"""
+import argparse
+import bisect
+import hashlib
+import struct
+import sys
+from twisted.internet import defer, reactor
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from .client import Backend
+from .logger import LEVELS, log
+from .server import Memcached, MemcachedFactory
+from .stats import Stats
+from .storages.memory import Storage
+
+POINT = struct.Struct('<L')
+
+
+def key_hash(key):
+    return POINT.unpack_from(hashlib.md5(key).digest())[0]
+
+
+def ketama_points(name, count):
+    """
+    Yield the count points of the node called name on the ring, four out
+    of each md5 digest of name-index like libketama.
+    """
+    for index in range(count // 4):
+        digest = hashlib.md5(('%s-%d' % (name, index)).encode('utf-8'))
+        digest = digest.digest()
+        for offset in range(0, 16, 4):
+            yield POINT.unpack_from(digest, offset)[0]
+
+
+class Unavailable(Exception):
+    """
+    Raised for requests when every backend is ejected.
+    """
+
+
+class NoBackend:
+    def request(self, frame):
+        return defer.fail(Unavailable('No backend available'))
+
+
+class Node:
+    """
+    A backend of the ring, counting its failed requests.
+    """
+    def __init__(self, ring, name, backend):
+        self.ring = ring
+        self.name = name
+        self.backend = backend
+        self.failures = 0
+
+    def request(self, frame):
+        return self.backend.request(frame).addCallbacks(self._succeeded,
+            self._failed)
+
+    def _succeeded(self, frame):
+        self.failures = 0
+        return frame
+
+    def _failed(self, reason):
+        self.failures += 1
+        if self.failures >= self.ring.FAILURE_LIMIT:
+            self.ring.eject(self.name)
+        return reason
+
+
+class Ring:
+    """
+    Routes keys to the nodes, see workers.Shards.
+    """
+    POINTS = 160
+    FAILURE_LIMIT = 2
+    RETRY_INTERVAL = 10
+
+    def __init__(self, backends):
+        """
+        backends maps the names of the nodes, host:port, to the backend
+        talking to them.
+        """
+        self.nodes = dict((name, Node(self, name, backend))
+            for name, backend in backends.items())
+        self.ejected = set()
+        self.callLater = reactor.callLater
+        self.noBackend = NoBackend()
+        self._build()
+
+    def _build(self):
+        points = sorted((point, name) for name in self.nodes
+            if name not in self.ejected
+            for point in ketama_points(name, self.POINTS))
+        self._points = [point for point, name in points]
+        self._owners = [self.nodes[name] for point, name in points]
+
+    def route(self, key):
+        if not self._points:
+            return self.noBackend
+        index = bisect.bisect_left(self._points, key_hash(key))
+        if index == len(self._points):
+            index = 0
+        return self._owners[index]
+
+    def others(self):
+        """
+        Return the nodes still in the ring, for requests about all of the
+        keys.
+        """
+        return [node for name, node in sorted(self.nodes.items())
+            if name not in self.ejected]
+
+    def eject(self, name):
+        if name in self.ejected:
+            return
+        log.warning('Ejecting backend %s for %d seconds', name,
+            self.RETRY_INTERVAL)
+        self.ejected.add(name)
+        self._build()
+        self.callLater(self.RETRY_INTERVAL, self.restore, name)
+
+    def restore(self, name):
+        log.info('Putting backend %s back', name)
+        self.nodes[name].failures = 0
+        self.ejected.discard(name)
+        self._build()
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='pmemcached proxy',
+        description='Route binary protocol requests to pmemcached servers '
+        'on a consistent hash ring.')
+    parser.add_argument('-p', '--port', type=int, default=11211,
+        help='TCP port to listen on (default: %(default)s)')
+    parser.add_argument('-b', '--backend', metavar='HOST:PORT',
+        action='append', required=True, dest='backends',
+        help='Backend server, repeat it for every one')
+    parser.add_argument('--max-request-size', type=int,
+        default=Memcached.MAX_REQUEST, help='Requests with a bigger body are '
+        'answered with value_too_large (default: %(default)s)')
+    parser.add_argument('--max-pending', type=int,
+        default=Memcached.MAX_PENDING, help='Bytes of responses a '
+        'connection may have waiting to be sent before its requests stop '
+        'being read (default: %(default)s)')
+    parser.add_argument('--latency-sample', type=int, default=10,
+        help='Time one command out of this many for the latency stats, 0 '
+        'disables them (default: %(default)s)')
+    parser.add_argument('--log-level', choices=sorted(LEVELS, key=LEVELS.get),
+        default='info', help='Least important messages logged to stderr '
+        '(default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+def run_proxy(argv):
+    args = parse_args(argv)
+    log.setLevel(LEVELS[args.log_level])
+    log.start(sys.stderr)
+
+    backends = {}
+    for address in args.backends:
+        host, port = parse_address(address)
+        backends['%s:%d' % (host, port)] = Backend(
+            TCP4ClientEndpoint(reactor, host, port))
+    stats = Stats(args.latency_sample)
+    stats.settings.update(vars(args), backends=','.join(sorted(backends)))
+
+    # Keys are never served from the storage, only a proxy's own stats
+    reactor.listenTCP(args.port, MemcachedFactory(Storage(), Ring(backends),
+        stats, maxRequest=args.max_request_size, maxPending=args.max_pending))
+    log.info('Proxying port %d to %s', args.port, ', '.join(sorted(backends)))
+    reactor.run()
@@ -0,0 +1,431 @@
+"""
+Asynchronous replication to warm standbys. A primary started with
+--replication-port streams its writes to the replicas connected there, which
+are started with --replica-of.
+
+A replica connecting is sent a snapshot of the primary, see snapshot.py,
+preceded by its size (Q). Then come batches of the writes made since it
+connected, each one a header followed by records of the oplog format, see
+storages/oplog.py:
+
+    batch:  sent at (d) | records length (L) | records
+
+Sets, and the counters incr and decr leave, are sent as SET records, and
+deletes and flushes as DELETE and FLUSH records. Expiry times and delayed
+flushes are sent as absolute timestamps. Batches are sent once per reactor
+iteration, and empty ones every HEARTBEAT seconds when idle. The replica
+answers each read of batches with the send time of the last one it
+applied, an ACK, so both ends know how far behind it is.
+
+Replicas evict and expire items on their own and do not pass their writes
+on. A replica losing its primary connects again and starts over from a
+fresh snapshot. So does a replica falling MAX_BACKLOG bytes of records
+behind, while it bootstraps or reads slower than the primary writes, which
+the primary disconnects.
+"""
+import math
+import os
+import struct
+import tempfile
+from twisted.internet import protocol, reactor, task
+from twisted.protocols.basic import FileSender
+from . import snapshot
+from .logger import log
+from .storages.base import OutOfMemory, as_bytes
+from .storages.oplog import (DATATYPES, DELETE, FLUSH, FLUSH_NAMESPACE,
+    RECORD, SET_OPS)
+
+SIZE = struct.Struct('!Q')
+BATCH = struct.Struct('!dL')
+ACK = struct.Struct('!d')
+
+
+def expiry_for(storage, deadline, now):
+    """
+    Expiry time to store an item expiring at deadline with.
+    """
+    expiry = int(math.ceil(deadline - now))
+    if expiry > storage.MAX_RELATIVE_EXPIRY:
+        return int(math.ceil(deadline))
+    return max(expiry, 1)
+
+
+class Feed(protocol.Protocol):
+    """
+    The connection of a replica to its primary, on the primary.
+    """
+    def __init__(self, primary):
+        self.primary = primary
+        self.peer = None
+        # Records written since the replica connected, sent once the
+        # snapshot is
+        self.records = []
+        # Their size
+        self.backlog = 0
+        self.streaming = False
+        # Whether the transport has too much to write, records then wait
+        self.paused = False
+        self.bytes_sent = 0
+        # Seconds between sending a batch and its ACK
+        self.lag = 0.0
+        self._acks = b''
+
+    def connectionMade(self):
+        peer = self.transport.getPeer()
+        self.peer = '%s:%s' % (peer.host, peer.port)
+        log.info('Replica %s connected, sending it a snapshot', self.peer)
+        self.primary.feeds.append(self)
+        fd, path = tempfile.mkstemp(prefix='pmemcached-replica-',
+            dir=self.primary.directory)
+        os.close(fd)
+        snapshotter = snapshot.Snapshotter(self.primary.storage, path)
+        snapshotter.snapshot().addCallback(self._snapshotted, path
+            ).addErrback(self._failed).addBoth(self._remove, path)
+
+    def _snapshotted(self, ignored, path):
+        if self not in self.primary.feeds:
+            # Lost meanwhile
+            return
+        output = open(path, 'rb')
+        size = os.fstat(output.fileno()).st_size
+        self.transport.write(SIZE.pack(size))
+        self.bytes_sent += SIZE.size + size
+        return FileSender().beginFileTransfer(output,
+            self.transport).addCallback(self._sent).addBoth(
+            self._close, output)
+
+    def _sent(self, ignored):
+        log.info('Snapshot sent to replica %s, streaming', self.peer)
+        self.streaming = True
+        self.transport.registerProducer(self, True)
+        self.send()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.send()
+
+    def stopProducing(self):
+        pass
+
+    def fallBehind(self):
+        """
+        Disconnect the replica, its records are dropped.
+        """
+        log.warning('Replica %s is %d bytes behind, disconnecting it',
+            self.peer, self.backlog)
+        self.primary.feeds.remove(self)
+        self.records = []
+        self.backlog = 0
+        self.transport.loseConnection()
+
+    def _failed(self, reason):
+        if self in self.primary.feeds:
+            log.err(reason, 'Bootstrapping replica %s failed' % self.peer)
+            self.transport.loseConnection()
+
+    def _close(self, result, output):
+        output.close()
+        return result
+
+    def _remove(self, ignored, path):
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def send(self):
+        records, self.records = self.records, []
+        length, self.backlog = self.backlog, 0
+        records.insert(0, BATCH.pack(self.primary.seconds(), length))
+        self.transport.writeSequence(records)
+        self.bytes_sent += BATCH.size + length
+
+    def dataReceived(self, data):
+        data = self._acks + data
+        end = len(data) - len(data) % ACK.size
+        if end:
+            sent = ACK.unpack_from(data, end - ACK.size)[0]
+            self.lag = max(self.primary.seconds() - sent, 0.0)
+        self._acks = data[end:]
+
+    def connectionLost(self, reason):
+        log.info('Replica %s disconnected', self.peer)
+        if self in self.primary.feeds:
+            self.primary.feeds.remove(self)
+
+
+class Primary(protocol.Factory):
+    """
+    Listens to replicas and streams them the writes of storage, which the
+    protocols report with changed, deleted and flushed. Snapshots for new
+    replicas are written to directory.
+    """
+    HEARTBEAT = 1
+    # Bytes of records a replica may have waiting before it is disconnected
+    MAX_BACKLOG = 64 * 1024 * 1024
+
+    def __init__(self, storage, directory=None):
+        self.storage = storage
+        self.directory = directory
+        self.feeds = []
+        self.seconds = reactor.seconds
+        self.callLater = reactor.callLater
+        self._send = None
+        self.heartbeat = task.LoopingCall(self.send)
+
+    def buildProtocol(self, addr):
+        feed = Feed(self)
+        feed.factory = self
+        return feed
+
+    def startFactory(self):
+        self.heartbeat.start(self.HEARTBEAT, now=False)
+
+    def stopFactory(self):
+        if self.heartbeat.running:
+            self.heartbeat.stop()
+
+    def record(self, op, key, flags=0, value=b'', deadline=0):
+        if not self.feeds:
+            return
+        record = RECORD.pack(op, len(key), flags, len(value), deadline) + \
+            key + value
+        for feed in self.feeds:
+            feed.records.append(record)
+            feed.backlog += len(record)
+        if self._send is None:
+            self._send = self.callLater(0, self.send)
+
+    def send(self):
+        """
+        Send the records written since the last batch to the replicas,
+        those still bootstrapping or paused keep them for later.
+        """
+        if self._send is not None:
+            if self._send.active():
+                self._send.cancel()
+            self._send = None
+        for feed in list(self.feeds):
+            if feed.backlog > self.MAX_BACKLOG:
+                feed.fallBehind()
+            elif feed.streaming and not feed.paused:
+                feed.send()
+
+    def changed(self, key):
+        """
+        Replicate the item key holds now, or its deletion if it holds none.
+        """
+        if not self.feeds:
+            return
+        item = self.storage.peek(key)
+        if item is None:
+            self.record(DELETE, key)
+            return
+        self.record(SET_OPS[item.get('datatype', 0)], key, item['flags'],
+            bytes(as_bytes(item['value'])), self.storage.deadline(key))
+
+    def deleted(self, key):
+        self.record(DELETE, key)
+
+    def flushed(self, expiry, namespace):
+        deadline = 0
+        if expiry:
+            deadline = self.storage._deadline(expiry)
+        if namespace is None:
+            self.record(FLUSH, b'', deadline=deadline)
+        else:
+            self.record(FLUSH_NAMESPACE, namespace, deadline=deadline)
+
+    def stats(self):
+        stats = [('role', 'primary'), ('replicas', len(self.feeds))]
+        for feed in self.feeds:
+            stats.extend([
+                ('replica:%s:state' % feed.peer,
+                    'streaming' if feed.streaming else 'bootstrapping'),
+                ('replica:%s:bytes_sent' % feed.peer, feed.bytes_sent),
+                ('replica:%s:lag_ms' % feed.peer, int(feed.lag * 1000)),
+            ])
+        return stats
+
+
+class Stream(protocol.Protocol):
+    """
+    The connection of a replica to its primary, on the replica: loads the
+    snapshot then applies the batches.
+    """
+    def __init__(self, replica):
+        self.replica = replica
+        # Partial batch left over from previous reads and how many bytes
+        # are needed before it can be applied
+        self._chunks = []
+        self._buffered = 0
+        self._needed = BATCH.size
+        # Snapshot bytes still to come, None until their size is known
+        self._snapshot = None
+        self._output = None
+        self._path = None
+
+    def connectionMade(self):
+        log.info('Connected to primary %s', self.replica.primary)
+        self.replica.state = 'bootstrapping'
+        fd, self._path = tempfile.mkstemp(prefix='pmemcached-primary-',
+            dir=self.replica.directory)
+        self._output = os.fdopen(fd, 'wb')
+
+    def dataReceived(self, data):
+        if self._snapshot != 0:
+            data = self._bootstrap(data)
+            if not data:
+                return
+        if self._buffered:
+            self._chunks.append(data)
+            self._buffered += len(data)
+            if self._buffered < self._needed:
+                return
+            data = b''.join(self._chunks)
+
+        size = len(data)
+        offset = 0
+        applied = None
+        self._needed = BATCH.size
+        while size - offset >= BATCH.size:
+            sent, length = BATCH.unpack_from(data, offset)
+            end = offset + BATCH.size + length
+            if end > size:
+                self._needed = end - offset
+                break
+            self.replica.apply(data, offset + BATCH.size, end, sent)
+            applied = sent
+            offset = end
+        if applied is not None:
+            self.transport.write(ACK.pack(applied))
+
+        self._chunks = [data[offset:]] if offset < size else []
+        self._buffered = size - offset
+
+    def _bootstrap(self, data):
+        """
+        Save the snapshot, return the data after it.
+        """
+        if self._snapshot is None:
+            data = b''.join(self._chunks) + data
+            if len(data) < SIZE.size:
+                self._chunks = [data]
+                return b''
+            self._chunks = []
+            self._snapshot = SIZE.unpack_from(data)[0]
+            data = data[SIZE.size:]
+
+        part = data[:self._snapshot]
+        self._output.write(part)
+        self._snapshot -= len(part)
+        if self._snapshot:
+            return b''
+
+        self._output.close()
+        self._output = None
+        try:
+            self.replica.bootstrap(self._path)
+        finally:
+            os.unlink(self._path)
+            self._path = None
+        return data[len(part):]
+
+    def connectionLost(self, reason):
+        log.warning('Lost primary %s: %s', self.replica.primary,
+            reason.getErrorMessage())
+        self.replica.state = 'connecting'
+        if self._output is not None:
+            self._output.close()
+        if self._path is not None:
+            os.unlink(self._path)
+
+
+class Replica(protocol.ReconnectingClientFactory):
+    """
+    Follows the primary at host:port into storage, connecting again with
+    backoff when the connection is lost. Snapshots are saved to directory
+    while they are received.
+    """
+    maxDelay = 10
+    noisy = False
+
+    def __init__(self, storage, host, port, directory=None):
+        self.storage = storage
+        self.primary = '%s:%d' % (host, port)
+        self.directory = directory
+        self.state = 'connecting'
+        self.applied = 0
+        # Seconds between the primary sending the last batch applied and
+        # its application, clocks of both ends are assumed in sync
+        self.lag = 0.0
+        self.seconds = reactor.seconds
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        stream = Stream(self)
+        stream.factory = self
+        return stream
+
+    def bootstrap(self, path):
+        """
+        Replace the items of storage by those of the snapshot at path.
+        """
+        self.storage.flush()
+        log.info('Loaded %d items from primary %s',
+            snapshot.load(self.storage, path), self.primary)
+        self.state = 'streaming'
+
+    def apply(self, data, offset, end, sent):
+        """
+        Apply the records of data between offset and end, sent at sent.
+        """
+        storage = self.storage
+        now = storage.seconds()
+        while offset < end:
+            op, keyLength, flags, valueLength, deadline = \
+                RECORD.unpack_from(data, offset)
+            keyEnd = offset + RECORD.size + keyLength
+            key = data[keyEnd - keyLength:keyEnd]
+            offset = keyEnd + valueLength
+            self.applied += 1
+
+            if op in (FLUSH, FLUSH_NAMESPACE):
+                storage.flush(expiry_for(storage, deadline, now)
+                    if deadline > now else 0,
+                    key if op == FLUSH_NAMESPACE else None)
+            elif op == DELETE or 0 < deadline <= now:
+                try:
+                    del storage[key]
+                except KeyError:
+                    pass
+            else:
+                try:
+                    storage[key] = {'flags': flags,
+                        'expiry': expiry_for(storage, deadline, now)
+                            if deadline else 0,
+                        'value': data[keyEnd:offset],
+                        'datatype': DATATYPES[op]}
+                except OutOfMemory:
+                    pass
+        storage.commit()
+        self.lag = max(self.seconds() - sent, 0.0)
+
+    def changed(self, key):
+        pass
+
+    def deleted(self, key):
+        pass
+
+    def flushed(self, expiry, namespace):
+        pass
+
+    def stats(self):
+        return [
+            ('role', 'replica'),
+            ('primary', self.primary),
+            ('state', self.state),
+            ('applied', self.applied),
+            ('lag_ms', int(self.lag * 1000)),
+        ]
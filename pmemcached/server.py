@@ -1,232 +1,845 @@
 import struct
-from twisted.internet import protocol
-from logger import log
+from twisted.internet import defer, protocol
+from . import codec
+from .compression import Compressor
+from .logger import log
+from .stats import Stats
+from .storages.base import KeyExists, OutOfMemory, as_bytes
+
+
+class Forwarded:
+    """
+    Placeholder for the response of a request sent to another server,
+    responses queued after it wait until it is filled.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self):
+        self.data = None
 
 
 class Memcached(protocol.Protocol):
-    HEADER_STRUCT = ''.join([
-        '!',  # big-endian
-        'B',  # Magic
-        'B',  # Command
-        'H',  # Key length
-        'B',  # Extras length
-        'B',  # Data type
-        'H',  # Status
-        'L',  # Body length
-        'L',  # Opaque
-        'Q',  # CAS
-    ])
-
-    HEADER_SIZE = 24
+    HEADER_SIZE = codec.HEADER_SIZE
 
     MAGIC = {
-        'request': 0x80,
-        'response': 0x81
+        'request': codec.MAGIC_REQUEST,
+        'response': codec.MAGIC_RESPONSE
     }
 
-    # All structures will be appended to HEADER_STRUCT
+    # Command name and its opcode, each one is handled by
+    # handle<Name>Command(command, opaque, cas, extras, key, value)
     COMMANDS = {
-        # Struct key name
-        'get': {'command': 0x00, 'struct': '%ds'},
-        # Struct flags|expiry time|key|value
-        'set': {'command': 0x01, 'struct': '!LL%ds%ds'},
-        'add': {'command': 0x02, 'struct': '!LL%ds%ds'},
-        'replace': {'command': 0x03, 'struct': '!LL%ds%ds'},
-        'delete': {'command': 0x04, 'struct': '%ds'},
-        #'incr': {'command': 0x05, 'struct': '!QQL%ds'},
-        #'decr': {'command': 0x06, 'struct': '!QQL%ds'},
-        #'flush': {'command': 0x08, 'struct': 'I'},
-        #'auth_negotiation': {'command': 0x20},
-        #'auth_request': {'command': 0x21, 'struct': '%ds%ds'}
+        'get': 0x00,
+        'set': 0x01,
+        'add': 0x02,
+        'replace': 0x03,
+        'delete': 0x04,
+        'incr': 0x05,
+        'decr': 0x06,
+        'flush': 0x08,
+        'getq': 0x09,
+        'noop': 0x0a,
+        'getk': 0x0c,
+        'getkq': 0x0d,
+        'stat': 0x10,
+        'setq': 0x11,
+        'addq': 0x12,
+        'replaceq': 0x13,
+        'deleteq': 0x14,
+        'incrq': 0x15,
+        'decrq': 0x16,
+        'flushq': 0x18,
+        #'auth_negotiation': 0x20,
+        #'auth_request': 0x21,
+    }
+
+    # Quiet commands and the command whose handler they share. Gets only
+    # answer hits and everything else only answers errors.
+    QUIET_COMMANDS = {
+        0x09: 0x00,
+        0x0d: 0x0c,
+        0x11: 0x01,
+        0x12: 0x02,
+        0x13: 0x03,
+        0x14: 0x04,
+        0x15: 0x05,
+        0x16: 0x06,
+        0x18: 0x08,
+    }
+    QUIET_GETS = frozenset([0x09, 0x0d])
+
+    # Commands that send the key back with the value
+    KEY_COMMANDS = frozenset([0x0c, 0x0d])
+
+    DECREMENTS = frozenset([0x06, 0x16])
+
+    # Counter expiry time meaning a missing counter must not be created
+    NO_CREATE = 0xffffffff
+
+    # Commands whose key isn't an item, they are never forwarded and don't
+    # hold the lock of their key
+    LOCAL_COMMANDS = frozenset([0x08, 0x10, 0x18])
+
+    # Commands without CAS following each other in a read are handled
+    # together by handle<Name>s(batch) with the storage's batch operations.
+    # Batches hold up to MAX_BATCH requests, and only as many as the
+    # responses seen so far say fit in what is left of maxPending.
+    BATCHED_COMMANDS = {
+        0x00: 'get',
+        0x09: 'get',
+        0x0c: 'get',
+        0x0d: 'get',
+        0x01: 'set',
+        0x11: 'set',
+        0x04: 'delete',
+        0x14: 'delete',
     }
+    MAX_BATCH = 64
 
     STATUSES = {
-        'success': {'code': 0x00, 'message': ''},
-        'key_not_found': {'code': 0x01, 'message': 'Not found'},
-        'key_exists': {'code': 0x02, 'message': 'Data exists for key.'},
-        'value_too_large': {'code': 0x03, 'message': ''},
-        'invalid_arguments': {'code': 0x04, 'message': 'Invalid arguments'},
-        'item_not_stored': {'code': 0x05, 'message': ''},
-        'non_numeric': {'code': 0x06, 'message': ''},
-        'unknown_command': {'code': 0x81, 'message': 'Unknown command'},
-        'out_of_memory': {'code': 0x82, 'message': ''},
+        'success': {'code': 0x00, 'message': b''},
+        'key_not_found': {'code': 0x01, 'message': b'Not found'},
+        'key_exists': {'code': 0x02, 'message': b'Data exists for key.'},
+        'value_too_large': {'code': 0x03, 'message': b'Too large.'},
+        'invalid_arguments': {'code': 0x04, 'message': b'Invalid arguments'},
+        'item_not_stored': {'code': 0x05, 'message': b''},
+        'non_numeric': {'code': 0x06,
+            'message': b'Non-numeric server-side value for incr or decr'},
+        'unknown_command': {'code': 0x81, 'message': b'Unknown command'},
+        'out_of_memory': {'code': 0x82, 'message': b'Out of memory'},
+        'internal_error': {'code': 0x84, 'message': b'Internal error'},
+        'temporary_failure': {'code': 0x86, 'message': b'Temporary failure'},
     }
 
+    # Requests with a bigger body are answered with value_too_large, a 1MB
+    # value with room for its key and extras
+    MAX_REQUEST = 1024 * 1024 + 1024
+    # Bytes of responses a connection may have waiting to be sent before its
+    # requests stop being read
+    MAX_PENDING = 1024 * 1024
+
     def __init__(self, factory):
         self.factory = factory
+        self.stats = factory.stats
+        self.accessLog = factory.accessLog
+        self.client = None
+        self.maxRequest = factory.maxRequest
+        self.maxPending = factory.maxPending
+        self.compressor = factory.compressor
+        self.replication = factory.replication
+        # Data type of the request being handled
+        self.dataType = 0
+        # Partial frame left over from previous reads and how many bytes
+        # are needed before it can be dispatched.
+        self._chunks = []
+        self._buffered = 0
+        self._needed = self.HEADER_SIZE
+        # Body bytes of a rejected request still to be skipped
+        self._discarding = 0
+        # Responses of the current read, written at once when it is done,
+        # and their size
+        self._responses = []
+        self._queued = 0
+        # Whether the transport asked to stop reading requests
+        self.paused = False
+        # Forwarded placeholders among them
+        self._forwarded = 0
+        # Opcode to bound handler, so dispatching is a single lookup
+        self.handlers = dict(
+            (opcode, getattr(self, 'handle%sCommand' % name.capitalize()))
+            for name, opcode in self.COMMANDS.items()
+            if opcode not in self.QUIET_COMMANDS)
+        for quiet, opcode in self.QUIET_COMMANDS.items():
+            self.handlers[quiet] = self.handlers[opcode]
+        self.batchHandlers = dict(
+            (opcode, getattr(self, 'handle%ss' % name.capitalize()))
+            for opcode, name in self.BATCHED_COMMANDS.items())
+        # Requests waiting to be handled together, as (command, opaque,
+        # extras, key, value, data type), and the handler they wait for
+        self._batch = []
+        self._batchHandler = None
+        # Average bytes of the responses of the last batch, the first
+        # request is handled alone
+        self._responseSize = self.maxPending
 
     def connectionMade(self):
-        log.msg('Yay one client!')
+        peer = self.transport.getPeer()
+        self.client = '%s:%s' % (peer.host, peer.port) \
+            if hasattr(peer, 'host') else 'unix'
+        if log.debugging:
+            log.debug('Connection from %s', self.client)
+        self.stats.curr_connections += 1
+        self.stats.total_connections += 1
+        # Pauses the connection once maxPending bytes wait to be sent
+        self.transport.bufferSize = self.maxPending
+        self.transport.registerProducer(self, True)
+
+    def connectionLost(self, reason):
+        self.stats.curr_connections -= 1
+
+    def pauseProducing(self):
+        """
+        The transport has too much to write: stop reading requests, and
+        handling those already read, until it drained.
+        """
+        if log.debugging:
+            log.debug('Pausing %s', self.client)
+        self.paused = True
+        self.stats.pauses += 1
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        self.transport.resumeProducing()
+        self.handlePending()
+
+    def stopProducing(self):
+        pass
+
+    def handlePending(self):
+        """
+        Handle the requests left over when the connection was paused.
+        """
+        self.dataReceived(b'')
 
     def sendMessage(self, command, keyLength, extLength, status, opaque, cas,
-        extra=None, body=None):
-        bodyLength = 0
-        if body:
-            bodyLength = len(body) + 4  # flags
-        else:
-            bodyLength = len(status['message'])
-        log.msg('Sending message: %s' % \
-            status['message'] if not body else body)
-
-        args = [self.HEADER_STRUCT + '%ds' % bodyLength,
-                    self.MAGIC['response'],
-                    command,
-                    keyLength,
-                    extLength,
-                    0x00,
-                    status['code'],
-                    bodyLength,
-                    opaque,
-                    cas]
-
-        if not body:
-            args.append(status['message'])
+        extra=None, body=None, key=b'', dataType=0):
+        """
+        Queue a response, it will be written with the rest of the responses
+        generated by the same read on flushResponses.
+
+        Values are queued as they are so they reach writeSequence without
+        being copied, only their header and flags are packed.
+        """
+        responses = self._responses
+        if body is not None:
+            bodyLength = codec.FLAGS.size + len(key) + len(body)
+            header = codec.encodeValueHeader(command, keyLength, bodyLength,
+                opaque, cas, extra, dataType)
+            responses.append(header + key if key else header)
+            if body.__class__ is memoryview:
+                # Views into a storage may change before the transport gets
+                # to write them
+                body = body.tobytes()
+            responses.append(body)
         else:
-            args += ['%s%s' % (struct.pack('!L', extra), body)]
+            reply = None
+            if not keyLength and not cas:
+                reply = self.REPLIES.get((command, status['code']))
+            bodyLength = len(key) + len(status['message'])
+            if reply is not None:
+                responses.append(reply[0] + codec.OPAQUE.pack(opaque) +
+                    reply[1])
+            else:
+                # Keys, CAS values and unknown commands
+                responses.append(codec.encodeHeader(command, keyLength,
+                    extLength, status['code'], bodyLength, opaque, cas) +
+                    key + status['message'])
+        self._queued += self.HEADER_SIZE + bodyLength
+        self.stats.bytes_written += self.HEADER_SIZE + bodyLength
+
+    def flushResponses(self):
+        responses = self._responses
+        if not responses:
+            return
 
-        bin = struct.pack(*args)
+        self._queued = 0
+        if not self._forwarded:
+            self.transport.writeSequence(responses)
+            self._responses = []
+            return
 
-        self.transport.write(bin)
+        # Write everything up to the first forwarded request still waiting
+        # for its response
+        ready = []
+        for response in responses:
+            if response.__class__ is Forwarded:
+                if response.data is None:
+                    break
+                self._forwarded -= 1
+                response = response.data
+            ready.append(response)
+        del responses[:len(ready)]
+        if ready:
+            self.transport.writeSequence(ready)
 
     def handleCommand(self, magic, command, keyLength, extLength, dataType,
-        status, bodyLength, opaque, cas, extra):
-        log.msg('Trying to handle command 0x%0.2x' % command)
-        commands = dict([(c[1]['command'], c[0]) for c in \
-            self.COMMANDS.items()])
-
-        if command not in commands.keys():
+        status, bodyLength, opaque, cas, body):
+        if log.debugging:
+            log.debug('Trying to handle command 0x%0.2x', command)
+        stats = self.stats
+        stats.commands[command] += 1
+        handler = self.handlers.get(command)
+
+        if handler is None:
+            if self._batch:
+                self.runBatch()
             self.sendMessage(command, 0, 0,
-                self.STATUSES['unknown_command'], 0, 0)
+                self.STATUSES['unknown_command'], opaque, 0)
             return False
 
-        log.msg('Handling %s' % commands[command])
-
-        commandName = 'handle%sCommand' % commands[command].capitalize()
-        if hasattr(self, commandName):
-            getattr(self, commandName)(magic, command, keyLength, extLength,
-            dataType, status, bodyLength, opaque, cas, extra)
+        keyEnd = extLength + keyLength
+        key = body[extLength:keyEnd].tobytes()
+        if self.accessLog is not None:
+            self.accessLog.record(self.client, self.COMMAND_NAMES[command],
+                key, bodyLength)
+        if self.factory.shards is not None and keyLength and \
+            command not in self.LOCAL_COMMANDS:
+            backend = self.factory.shards.route(key)
+            if backend is not None:
+                if self._batch:
+                    self.runBatch()
+                self.forwardCommand(backend, command, keyLength, extLength,
+                    dataType, bodyLength, opaque, cas, body)
+                return
+
+        batchHandler = None if cas else self.batchHandlers.get(command)
+        if batchHandler is not None and extLength != codec.STORE_EXTRAS.size \
+            and self.BATCHED_COMMANDS[command] == 'set':
+            # Handled alone, and answered with invalid_arguments
+            batchHandler = None
+        batch = self._batch
+        if batch and batchHandler is not self._batchHandler:
+            self.runBatch()
+            batch = self._batch
+        if batchHandler is not None:
+            self._batchHandler = batchHandler
+            batch.append((command, opaque, body[:extLength], key,
+                body[keyEnd:], dataType))
+            batched = len(batch)
+            if batched * self._responseSize >= \
+                self.maxPending - self._queued or batched >= self.MAX_BATCH:
+                self.runBatch()
             return
 
-    def _handleSetAddReplaceCommand(self, magic, command, keyLength,
-        extLength, dataType, status, bodyLength, opaque, cas, extra):
-        contentLength = bodyLength - keyLength - extLength
-        (flags, expiry, key, value) = struct.unpack(
-            self.COMMANDS['set']['struct']  % (keyLength, contentLength),
-            extra)
+        self.dataType = dataType
+        storage = self.factory.storage
+        if storage.threadsafe and command not in self.LOCAL_COMMANDS:
+            with storage.lock(key):
+                self.runHandler(handler, command, opaque, cas,
+                    body[:extLength], key, body[keyEnd:])
+        else:
+            self.runHandler(handler, command, opaque, cas, body[:extLength],
+                key, body[keyEnd:])
+
+    def runHandler(self, handler, command, opaque, cas, extras, key, value):
+        stats = self.stats
+        if stats.until_sample:
+            stats.until_sample -= 1
+            handler(command, opaque, cas, extras, key, value)
+        else:
+            started = stats.timer()
+            handler(command, opaque, cas, extras, key, value)
+            stats.record_latency(command, stats.timer() - started)
+
+    def runBatch(self):
+        """
+        Handle the batched requests. When one of them is sampled, each one
+        is timed as its share of the whole batch.
+        """
+        batch, self._batch = self._batch, []
+        queued = self._queued
+        stats = self.stats
+        if stats.until_sample >= len(batch):
+            stats.until_sample -= len(batch)
+            self._batchHandler(batch)
+        else:
+            started = stats.timer()
+            self._batchHandler(batch)
+            stats.record_latency(batch[0][0],
+                (stats.timer() - started) / len(batch))
+        self._responseSize = max((self._queued - queued) // len(batch), 1)
+
+    def forwardCommand(self, backend, command, keyLength, extLength, dataType,
+        bodyLength, opaque, cas, body):
+        """
+        Send a request to the server owning its key. Quiet commands are sent
+        loud, so every request gets a response, and the answers they would
+        not send are dropped when they arrive.
+        """
+        frame = codec.encodeRequestHeader(
+            self.QUIET_COMMANDS.get(command, command), keyLength, extLength,
+            dataType, bodyLength, opaque, cas) + body.tobytes()
+
+        forwarded = Forwarded()
+        self._responses.append(forwarded)
+        self._forwarded += 1
+        backend.request(frame).addCallbacks(self._forwardedResponse,
+            self._forwardFailed, callbackArgs=(forwarded, command),
+            errbackArgs=(forwarded, command, opaque))
+
+    def broadcastCommand(self, backends, command, opaque, extras, key):
+        """
+        Send a request to every backend and answer it once they all did,
+        with the first error if any.
+        """
+        frame = codec.encodeRequestHeader(
+            self.QUIET_COMMANDS.get(command, command), len(key), len(extras),
+            0, len(extras) + len(key), opaque, 0) + extras + key
+
+        forwarded = Forwarded()
+        self._responses.append(forwarded)
+        self._forwarded += 1
+        defer.gatherResults([backend.request(frame) for backend in backends],
+            consumeErrors=True).addCallbacks(self._broadcasted,
+            self._forwardFailed, callbackArgs=(forwarded, command, opaque),
+            errbackArgs=(forwarded, command, opaque))
+
+    def _broadcasted(self, frames, forwarded, command, opaque):
+        success = self.STATUSES['success']['code']
+        for frame in frames:
+            if codec.STATUS.unpack_from(frame, codec.STATUS_OFFSET)[0] != \
+                success:
+                break
+        else:
+            frame = codec.encodeHeader(
+                self.QUIET_COMMANDS.get(command, command), 0, 0, success, 0,
+                opaque, 0)
+        self._forwardedResponse(frame, forwarded, command)
+
+    def _forwardedResponse(self, frame, forwarded, command):
+        if command in self.QUIET_COMMANDS:
+            status = codec.STATUS.unpack_from(frame, codec.STATUS_OFFSET)[0]
+            success = status == self.STATUSES['success']['code']
+            if success != (command in self.QUIET_GETS):
+                frame = b''
+            else:
+                frame = frame[:codec.OPCODE_OFFSET] + \
+                    struct.pack('!B', command) + \
+                    frame[codec.OPCODE_OFFSET + 1:]
+        forwarded.data = frame
+        self.stats.bytes_written += len(frame)
+        self.flushResponses()
+
+    def _forwardFailed(self, reason, forwarded, command, opaque):
+        log.warning('Forwarding command 0x%0.2x failed: %s', command,
+            reason.getErrorMessage())
+        status = self.STATUSES['temporary_failure']
+        forwarded.data = codec.encodeHeader(command, 0, 0, status['code'],
+            len(status['message']), opaque, 0) + status['message']
+        self.flushResponses()
+
+    def checkCas(self, command, opaque, cas, key):
+        """
+        Return whether key holds the item with the given CAS, answering
+        with the error otherwise.
+        """
+        try:
+            item = self.factory.storage[key]
+        except KeyError:
+            self.sendMessage(command, 0, 0, self.STATUSES['key_not_found'],
+                opaque, 0)
+            return False
+
+        if item['cas'] != cas:
+            self.sendMessage(command, 0, 0, self.STATUSES['key_exists'],
+                opaque, 0)
+            return False
+        return True
 
-        if command == self.COMMANDS['add']['command'] and \
-            key in self.factory.storage:
-            self.sendMessage(command, 0, 0, self.STATUSES['key_exists'], 0, 0)
+    def _handleSetAddReplaceCommand(self, command, opaque, cas, extras, key,
+        value):
+        if len(extras) != codec.STORE_EXTRAS.size:
+            self.sendMessage(command, 0, 0,
+                self.STATUSES['invalid_arguments'], opaque, 0)
             return
-
-        if command == self.COMMANDS['replace']['command'] and \
-            key not in self.factory.storage:
-            self.sendMessage(command, 0, 0, self.STATUSES['key_not_found'], 0, 0)
+        (flags, expiry) = codec.STORE_EXTRAS.unpack(extras)
+        exists = None
+        if command in (self.COMMANDS['add'], self.COMMANDS['addq']):
+            exists = False
+            cas = 0
+        elif command in (self.COMMANDS['replace'], self.COMMANDS['replaceq']):
+            exists = True
+
+        # Values sent compressed are stored as they are
+        item = {'flags': flags, 'expiry': expiry, 'value': value.tobytes(),
+            'datatype': self.dataType & codec.DATATYPE_COMPRESSED}
+        compressLater = self.compressor.compress_item(item, self.stats)
+        try:
+            self.factory.storage.check_and_set(key, item, cas, exists)
+        except KeyError:
+            self.sendMessage(command, 0, 0, self.STATUSES['key_not_found'],
+                opaque, 0)
+            return
+        except KeyExists:
+            self.sendMessage(command, 0, 0, self.STATUSES['key_exists'],
+                opaque, 0)
             return
+        except OutOfMemory:
+            self.sendMessage(command, 0, 0, self.STATUSES['out_of_memory'],
+                opaque, 0)
+            return
+        self._stored(command, opaque, key, item, compressLater, len(value))
+
+    def handleSets(self, batch):
+        storage = self.factory.storage
+        items = []
+        compressLater = []
+        for command, opaque, extras, key, value, dataType in batch:
+            (flags, expiry) = codec.STORE_EXTRAS.unpack(extras)
+            item = {'flags': flags, 'expiry': expiry,
+                'value': value.tobytes(),
+                'datatype': dataType & codec.DATATYPE_COMPRESSED}
+            compressLater.append(self.compressor.compress_item(item,
+                self.stats))
+            items.append((key, item))
+
+        stored = storage.set_many(items)
+        for request, (key, item), later, done in zip(batch, items,
+            compressLater, stored):
+            if done:
+                self._stored(request[0], request[1], key, item, later,
+                    len(request[4]))
+            else:
+                self.sendMessage(request[0], 0, 0,
+                    self.STATUSES['out_of_memory'], request[1], 0)
+
+    def _stored(self, command, opaque, key, item, compressLater, size):
+        if compressLater:
+            self.compressor.compress_later(self.factory.storage, key,
+                item['cas'], item['value'], self.stats)
+        if self.replication is not None:
+            self.replication.changed(key)
+        stats = self.stats
+        if stats.until_key_sample:
+            stats.until_key_sample -= 1
+        else:
+            stats.record_key(key, size)
 
-        self.factory.storage[key] = {'flags': flags, 'expiry': expiry,
-            'value': value}
+        if command not in self.QUIET_COMMANDS:
+            self.sendMessage(command, 0, 0, self.STATUSES['success'],
+                opaque, item['cas'])
 
-        self.sendMessage(command, 0, 0, self.STATUSES['success'], 0, 0)
+    handleSetCommand = _handleSetAddReplaceCommand
+    handleAddCommand = _handleSetAddReplaceCommand
+    handleReplaceCommand = _handleSetAddReplaceCommand
 
-    def handleSetCommand(self, magic, command, keyLength, extLength, dataType,
-        status, bodyLength, opaque, cas, extra):
-        return self._handleSetAddReplaceCommand(magic, command, keyLength,
-            extLength, dataType, status, bodyLength, opaque, cas, extra)
+    def handleGetCommand(self, command, opaque, cas, extras, key, value):
+        try:
+            item = self.factory.storage[key]
+        except KeyError:
+            item = None
+        self._sendItem(command, opaque, key, item)
+
+    def handleGets(self, batch):
+        items = self.factory.storage.get_many(
+            [request[3] for request in batch])
+        for request, item in zip(batch, items):
+            self.dataType = request[5]
+            self._sendItem(request[0], request[1], request[3], item)
+
+    def _sendItem(self, command, opaque, key, item):
+        """
+        Answer a get of key with item, None when it is missing.
+        """
+        withKey = command in self.KEY_COMMANDS
+        stats = self.stats
+        if item is None:
+            stats.get_misses += 1
+            if stats.until_key_sample:
+                stats.until_key_sample -= 1
+            else:
+                stats.record_key(key, 0)
+            if command in self.QUIET_COMMANDS:
+                return
+            self.sendMessage(command, len(key), 0,
+                self.STATUSES['key_not_found'], opaque, 0,
+                key=key if withKey else b'')
+            return
 
-    def handleAddCommand(self, magic, command, keyLength, extLength, dataType,
-        status, bodyLength, opaque, cas, extra):
-        return self._handleSetAddReplaceCommand(magic, command, keyLength,
-            extLength, dataType, status, bodyLength, opaque, cas, extra)
+        stats.get_hits += 1
+        value = as_bytes(item['value'])
+        if stats.until_key_sample:
+            stats.until_key_sample -= 1
+        else:
+            stats.record_key(key, len(value))
+        dataType = item.get('datatype', 0)
+        if dataType and not self.dataType & dataType:
+            try:
+                value = self.compressor.decompress(value, stats)
+            except ValueError:
+                # Sent compressed with another codec, or not at all
+                self.sendMessage(command, 0, 0,
+                    self.STATUSES['internal_error'], opaque, 0)
+                return
+            dataType = 0
+        if withKey:
+            self.sendMessage(command, len(key), 4, self.STATUSES['success'],
+                opaque, item['cas'], item['flags'], value, key, dataType)
+        else:
+            self.sendMessage(command, 0, 4, self.STATUSES['success'],
+                opaque, item['cas'], item['flags'], value, dataType=dataType)
 
-    def handleReplaceCommand(self, magic, command, keyLength, extLength,
-        dataType, status, bodyLength, opaque, cas, extra):
-        return self._handleSetAddReplaceCommand(magic, command, keyLength,
-            extLength, dataType, status, bodyLength, opaque, cas, extra)
+    handleGetkCommand = handleGetCommand
 
-    def handleGetCommand(self, magic, command, keyLength, extLength, dataType,
-        status, bodyLength, opaque, cas, extra):
-        key = struct.unpack(self.COMMANDS['get']['struct'] % keyLength,
-            extra)
+    def handleDeleteCommand(self, command, opaque, cas, extras, key, value):
+        if cas and not self.checkCas(command, opaque, cas, key):
+            return
 
         try:
-            value = self.factory.storage[key[0]]
-
-            self.sendMessage(command, 0, 4, self.STATUSES['success'],
-            0, 1, value['flags'], value['value'])
+            del self.factory.storage[key]
         except KeyError:
-            self.sendMessage(command, len(key[0]), 0,
-                self.STATUSES['key_not_found'], 0, 0)
+            self._deleted(command, opaque, key, False)
+        else:
+            self._deleted(command, opaque, key, True)
+
+    def handleDeletes(self, batch):
+        deleted = self.factory.storage.delete_many(
+            [request[3] for request in batch])
+        for request, done in zip(batch, deleted):
+            self._deleted(request[0], request[1], request[3], done)
+
+    def _deleted(self, command, opaque, key, deleted):
+        if not deleted:
+            self.sendMessage(command, 0, 0, self.STATUSES['key_not_found'],
+                opaque, 0)
+            return
+        if self.replication is not None:
+            self.replication.deleted(key)
+
+        if command not in self.QUIET_COMMANDS:
+            self.sendMessage(command, 0, 0, self.STATUSES['success'],
+                opaque, 0)
+
+    def handleFlushCommand(self, command, opaque, cas, extras, key, value):
+        """
+        Flush every item, or with a key those of its namespace, after the
+        expiry time in extras if any. Flushes reach every other server
+        the key space is shared with.
+        """
+        if len(extras) not in (0, codec.FLUSH_EXTRAS.size):
+            self.sendMessage(command, 0, 0,
+                self.STATUSES['invalid_arguments'], opaque, 0)
+            return
+        expiry = codec.FLUSH_EXTRAS.unpack(extras)[0] if extras else 0
+        storage = self.factory.storage
+        namespace = key.partition(storage.NAMESPACE_SEPARATOR)[0] \
+            if key else None
+        storage.flush(expiry, namespace)
+        if self.replication is not None:
+            self.replication.flushed(expiry, namespace)
+
+        shards = self.factory.shards
+        # Workers send each other their flushes over unix sockets, those
+        # are not sent on again
+        if shards is not None and self.client != 'unix':
+            self.broadcastCommand(shards.others(), command, opaque,
+                bytes(extras), key)
+        elif command not in self.QUIET_COMMANDS:
+            self.sendMessage(command, 0, 0, self.STATUSES['success'],
+                opaque, 0)
+
+    def sendStat(self, command, opaque, name, value):
+        name = name.encode('ascii')
+        value = str(value).encode('ascii')
+        self._queued += self.HEADER_SIZE + len(name) + len(value)
+        self.stats.bytes_written += self.HEADER_SIZE + len(name) + len(value)
+        self._responses.append(codec.encodeHeader(command, len(name), 0,
+            self.STATUSES['success']['code'], len(name) + len(value), opaque,
+            0) + name + value)
+
+    def handleStatCommand(self, command, opaque, cas, extras, key, value):
+        """
+        Send one response per stat of the group named by the key and an
+        empty one to finish.
+        """
+        if not key:
+            stats = self.stats.general(self.factory.storage,
+                self.COMMAND_NAMES)
+        elif key == b'settings':
+            stats = sorted(self.stats.settings.items())
+        elif key == b'latency':
+            stats = self.stats.latency(self.COMMAND_NAMES)
+        elif key == b'hotkeys':
+            stats = self.stats.hot_keys()
+        elif key == b'replication' and self.replication is not None:
+            stats = self.replication.stats()
+        else:
+            self.sendMessage(command, 0, 0, self.STATUSES['key_not_found'],
+                opaque, 0)
+            return
+
+        for name, stat in stats:
+            self.sendStat(command, opaque, name, stat)
+        self.sendMessage(command, 0, 0, self.STATUSES['success'], opaque, 0)
+
+    def handleNoopCommand(self, command, opaque, cas, extras, key, value):
+        self.sendMessage(command, 0, 0, self.STATUSES['success'], opaque, 0)
+
+    def _handleIncrDecrCommand(self, command, opaque, cas, extras, key, value):
+        if len(extras) != codec.COUNTER_EXTRAS.size:
+            self.sendMessage(command, 0, 0,
+                self.STATUSES['invalid_arguments'], opaque, 0)
+            return
+        (delta, initial, expiry) = codec.COUNTER_EXTRAS.unpack(extras)
+        if command in self.DECREMENTS:
+            delta = -delta
+        if expiry == self.NO_CREATE:
+            initial = None
+
+        if cas and not self.checkCas(command, opaque, cas, key):
+            return
 
-    def handleDeleteCommand(self, magic, command, keyLength, extLength, dataType,
-        status, bodyLength, opaque, cas, extra):
-        key = struct.unpack(self.COMMANDS['delete']['struct'] % keyLength,
-            extra)[0]
         try:
-            del self.factory.storage[key]
-            self.sendMessage(command, 0, 0, self.STATUSES['success'], 0, 0)
+            (value, cas) = self.factory.storage.counter(key, delta, initial,
+                expiry)
         except KeyError:
-             self.sendMessage(command, 0, 0, self.STATUSES['key_not_found'], 0, 0)
-
-    def _handleIncrDecrCommand(self, magic, command, keyLength, extLength,
-        dataType, status, bodyLength, opaque, cas, extra):
-        (delta, initial, expiry, key) = struct.unpack(self.COMMANDS['incr']['struct'] % keyLength, extra)
-        if key in self.factory.storage:
-            try:
-                value = self.factory.storage[key]
-                self.factory.storage[key] = {
-                    'expiry': expiry,
-                    'value': value['value'] + delta,
-                }
-            except TypeError:
-                self.factory.storage[key] = {
-                    'expiry': expiry,
-                    'value': initial
-                }
-        else:
-            self.factory.storage[key] = {
-                    'expiry': expiry,
-                    'value': initial
-                }
+            self.sendMessage(command, 0, 0, self.STATUSES['key_not_found'],
+                opaque, 0)
+            return
+        except ValueError:
+            self.sendMessage(command, 0, 0, self.STATUSES['non_numeric'],
+                opaque, 0)
+            return
+        except OutOfMemory:
+            self.sendMessage(command, 0, 0, self.STATUSES['out_of_memory'],
+                opaque, 0)
+            return
+        if self.replication is not None:
+            self.replication.changed(key)
 
-        self.sendMessage(command, 0, 0, self.STATUSES['success'], 0, 0, None,
-            self.factory.storage[key])
+        if command not in self.QUIET_COMMANDS:
+            self._queued += self.HEADER_SIZE + codec.COUNTER.size
+            self.stats.bytes_written += self.HEADER_SIZE + codec.COUNTER.size
+            self._responses.append(codec.encodeHeader(command, 0, 0,
+                self.STATUSES['success']['code'], codec.COUNTER.size, opaque,
+                cas) + codec.COUNTER.pack(value))
 
-    def handleIncrCommand(self, *args):
-        return self._handleIncrDecrCommand(*args)
+    handleIncrCommand = _handleIncrDecrCommand
+    handleDecrCommand = _handleIncrDecrCommand
 
     def handleHeader(self, header):
         if len(header) != self.HEADER_SIZE:
-            log.msg('Invalid header')
+            log.warning('Invalid header')
             return False
 
         (magic, command, keyLength, extLength, dataType, status, bodyLength,
-            opaque, cas) = struct.unpack(self.HEADER_STRUCT, header)
+            opaque, cas) = codec.HEADER.unpack(header)
 
         if magic != self.MAGIC['request']:
-            log.msg('Invalid magic code 0x%0.2x' % magic)
+            log.warning('Invalid magic code 0x%0.2x', magic)
             return False
 
         return (magic, command, keyLength, extLength, dataType, status,
             bodyLength, opaque, cas)
 
     def handleData(self, data):
-        header = self.handleHeader(data[:self.HEADER_SIZE])
-        if header:
-            header = list(header)
-            header.append(data[self.HEADER_SIZE:])
-            self.handleCommand(*header)
-        return ''
+        """
+        Dispatch every complete frame found in data and return the offset
+        of the first byte that was not consumed. Frames are sliced out of
+        a single memoryview so pipelined requests do not copy the buffer.
+        """
+        view = memoryview(data)
+        size = len(data)
+        offset = min(self._discarding, size)
+        self._discarding -= offset
+        while size - offset >= self.HEADER_SIZE:
+            header = self.handleHeader(view[offset:offset + self.HEADER_SIZE])
+            if not header:
+                if self._batch:
+                    self.runBatch()
+                self.flushResponses()
+                self.transport.loseConnection()
+                return size
+
+            if header[6] > self.maxRequest:
+                offset = self.rejectRequest(header, size, offset)
+                continue
+
+            end = offset + self.HEADER_SIZE + header[6]
+            if end > size:
+                if self._batch:
+                    self.runBatch()
+                self._needed = end - offset
+                return offset
+
+            self.handleCommand(*(header +
+                (view[offset + self.HEADER_SIZE:end],)))
+            offset = end
+            if self._queued > self.maxPending:
+                # Writing may pause the connection, requests left in data
+                # then wait for it to resume
+                self.flushResponses()
+                if self.paused:
+                    break
+
+        if self._batch:
+            self.runBatch()
+        self._needed = self.HEADER_SIZE
+        return offset
+
+    def rejectRequest(self, header, size, offset):
+        """
+        Answer a request bigger than maxRequest with value_too_large and
+        skip its body without buffering it. Return the offset after what
+        was skipped from a read of size bytes.
+        """
+        log.warning('Rejecting a request of %d bytes from %s', header[6],
+            self.client)
+        if self._batch:
+            self.runBatch()
+        self.sendMessage(header[1], 0, 0, self.STATUSES['value_too_large'],
+            header[7], 0)
+        offset += self.HEADER_SIZE
+        skipped = min(header[6], size - offset)
+        self._discarding = header[6] - skipped
+        return offset + skipped
 
     def dataReceived(self, data):
-        self.transport.write(self.handleData(data))
+        self.stats.bytes_read += len(data)
+        if self._buffered:
+            self._chunks.append(data)
+            self._buffered += len(data)
+            if self._buffered < self._needed:
+                return
+            data = b''.join(self._chunks)
+
+        offset = self.handleData(data)
+        self.factory.storage.commit()
+        self.flushResponses()
+        if offset < len(data):
+            self._chunks = [data[offset:]]
+            self._buffered = len(data) - offset
+        else:
+            self._chunks = []
+            self._buffered = 0
+
+
+Memcached.COMMAND_NAMES = dict((opcode, name)
+    for name, opcode in Memcached.COMMANDS.items())
+
+# Replies without key nor CAS of every command and status, split around
+# their opaque
+Memcached.REPLIES = dict(((opcode, status['code']),
+    codec.splitReply(opcode, status['code'], status['message']))
+    for opcode in Memcached.COMMAND_NAMES
+    for status in Memcached.STATUSES.values())
 
 
 class MemcachedFactory(protocol.Factory):
     protocol = Memcached
 
-    def __init__(self, storage):
+    def __init__(self, storage, shards=None, stats=None, accessLog=None,
+        maxRequest=Memcached.MAX_REQUEST, maxPending=Memcached.MAX_PENDING,
+        compressor=None, replication=None):
+        """
+        shards, when given, routes keys owned by other servers to them, see
+        workers.Shards. Requests are recorded to accessLog, a
+        logger.AccessLog, when given. See Memcached.MAX_REQUEST and
+        Memcached.MAX_PENDING for the limits. Values are compressed by
+        compressor, a compression.Compressor, when it has a threshold.
+        Writes are reported to replication, a replication.Primary or
+        Replica, when given.
+        """
         self.storage = storage
+        self.shards = shards
+        self.stats = stats if stats is not None else Stats()
+        self.accessLog = accessLog
+        self.maxRequest = maxRequest
+        self.maxPending = maxPending
+        self.compressor = compressor if compressor is not None else \
+            Compressor()
+        self.replication = replication
 
     def buildProtocol(self, addr):
         return self.protocol(self)
@@ -0,0 +1,191 @@
+"""
+Snapshots of a storage to a binary file, to warm a cache up after a
+restart.
+
+The file is a header followed by one record per item, least recently used
+first, and an end record holding the item count:
+
+    header: magic (4s) | version (B)
+    record: data type (B) | key length (H) | flags (L) | value length (L)
+            | expires at (d) | key | value
+    end:    a record with every field set to 0 | item count (Q)
+
+Expiry times are absolute unix timestamps, 0 means the item never expires.
+Version 1 snapshots, whose records have no data type, are still loaded.
+"""
+import math
+import mmap
+import os
+import struct
+import time
+from twisted.internet import task
+from .logger import log
+from .storages.base import OutOfMemory, as_bytes
+
+MAGIC = b'PMCS'
+VERSION = 2
+HEADER = struct.Struct('!4sB')
+RECORD = struct.Struct('!BHLLd')
+# Records of version 1, every value is raw
+RECORD_V1 = struct.Struct('!HLLd')
+END = struct.Struct('!Q')
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def write_items(storage, output):
+    """
+    Write the items of storage to output, yielding after each one so it can
+    be run cooperatively. Items changed while it runs are written with
+    whatever value they have when reached.
+    """
+    output.write(HEADER.pack(MAGIC, VERSION))
+    now = storage.seconds()
+    count = 0
+    for key in storage.keys():
+        item = storage.peek(key)
+        deadline = storage.deadline(key)
+        if item is None or 0 < deadline <= now or \
+            storage.is_flushed(key, item['cas']):
+            continue
+
+        value = as_bytes(item['value'])
+        output.write(RECORD.pack(item.get('datatype', 0), len(key),
+            item['flags'], len(value), deadline))
+        output.write(key)
+        output.write(value)
+        count += 1
+        yield
+
+    output.write(RECORD.pack(0, 0, 0, 0, 0))
+    output.write(END.pack(count))
+
+
+def load(storage, path):
+    """
+    Fill storage with the items of the snapshot at path and return how many
+    were loaded. Items that expired meanwhile are skipped.
+    """
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            raise SnapshotError('Empty snapshot %s' % path)
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        return _load(storage, data)
+    finally:
+        data.close()
+
+
+def _load(storage, data):
+    size = len(data)
+    if size < HEADER.size or HEADER.unpack_from(data) not in \
+        ((MAGIC, VERSION), (MAGIC, 1)):
+        raise SnapshotError('Not a version %d snapshot' % VERSION)
+    record = RECORD if HEADER.unpack_from(data)[1] == VERSION else RECORD_V1
+
+    now = storage.seconds()
+    offset = HEADER.size
+    loaded = 0
+    count = 0
+    datatype = 0
+    while offset + record.size <= size:
+        if record is RECORD:
+            datatype, keyLength, flags, valueLength, deadline = \
+                record.unpack_from(data, offset)
+        else:
+            keyLength, flags, valueLength, deadline = record.unpack_from(data,
+                offset)
+        offset += record.size
+        if not keyLength:
+            if offset + END.size > size or \
+                END.unpack_from(data, offset)[0] != count:
+                raise SnapshotError('Corrupted snapshot')
+            return loaded
+
+        keyEnd = offset + keyLength
+        end = keyEnd + valueLength
+        if end > size:
+            break
+        count += 1
+
+        key = data[offset:keyEnd]
+        offset = end
+        if not deadline:
+            expiry = 0
+        elif deadline <= now:
+            continue
+        else:
+            expiry = int(math.ceil(deadline - now))
+            if expiry > storage.MAX_RELATIVE_EXPIRY:
+                expiry = int(math.ceil(deadline))
+
+        try:
+            storage[key] = {'flags': flags, 'expiry': expiry,
+                'value': data[keyEnd:end], 'datatype': datatype}
+        except OutOfMemory:
+            continue
+        loaded += 1
+
+    raise SnapshotError('Truncated snapshot')
+
+
+class Snapshotter:
+    """
+    Periodically writes snapshots of a storage to path. Snapshots run
+    cooperatively in slices of at most SLICE seconds so the reactor keeps
+    serving requests, and land on path atomically once complete.
+    """
+    SLICE = 0.002
+
+    def __init__(self, storage, path, interval=300):
+        self.storage = storage
+        self.path = path
+        self.interval = interval
+        self.cooperator = task.Cooperator(
+            terminationPredicateFactory=self._slice,
+            scheduler=lambda work: self.storage.callLater(0, work))
+        self.loop = task.LoopingCall(self._periodic)
+        self._task = None
+
+    def _slice(self):
+        deadline = time.time() + self.SLICE
+        return lambda: time.time() >= deadline
+
+    def start(self):
+        self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def _periodic(self):
+        return self.snapshot().addErrback(log.err, 'Snapshot failed')
+
+    def snapshot(self):
+        """
+        Start a snapshot unless one is running, the deferred fires once it
+        is on disk.
+        """
+        if self._task is None:
+            self._task = self.cooperator.cooperate(self._write())
+        return self._task.whenDone()
+
+    def _write(self):
+        started = time.time()
+        temporary = '%s.tmp' % self.path
+        try:
+            with open(temporary, 'wb') as output:
+                for step in write_items(self.storage, output):
+                    yield step
+            os.rename(temporary, self.path)
+        except Exception:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+            raise
+        finally:
+            self._task = None
+        log.info('Snapshot written to %s in %.2f seconds', self.path,
+            time.time() - started)
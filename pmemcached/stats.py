@@ -0,0 +1,242 @@
+"""
+Counters and latency histograms reported by the stat command.
+
+Everything here is updated from the reactor thread with plain integer
+arithmetic, reports are built only when a client asks for them.
+"""
+import heapq
+import os
+import threading
+import time
+from timeit import default_timer
+
+
+class Histogram:
+    """
+    HDR style histogram of microseconds. Every power of two range is split
+    in SUB_BUCKETS linear buckets, so recorded values keep a relative error
+    under 1 / SUB_BUCKETS with a few hundred counters.
+    """
+    SUB_BUCKET_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.max = 0
+
+    def record(self, value):
+        shift = max(value.bit_length() - self.SUB_BUCKET_BITS - 1, 0)
+        index = shift * self.SUB_BUCKETS + (value >> shift)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def highest(self, index):
+        """
+        Highest value recorded in the bucket at index.
+        """
+        if index < 2 * self.SUB_BUCKETS:
+            return index
+        shift = index // self.SUB_BUCKETS - 1
+        return ((index - shift * self.SUB_BUCKETS + 1) << shift) - 1
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        wanted = max(self.count * percent / 100.0, 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(self.highest(index), self.max)
+        return self.max  # pragma: no cover
+
+
+class SpaceSaving:
+    """
+    Space-Saving heavy hitters: keeps the weight of at most capacity keys.
+    A new key takes the place of the one with the smallest count and starts
+    from that count, which is the most it may overestimate it by, so keys
+    weighing more than total / capacity are never missed.
+
+    The smallest count is found with a heap of (count, key) pushed on every
+    update. Entries outdated by later updates are skipped, and dropped by
+    rebuilding the heap once they pile up.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.heap = []
+
+    def add(self, key, weight=1):
+        counts = self.counts
+        count = counts.get(key)
+        if count is None:
+            count = self._evict() if len(counts) >= self.capacity else 0
+        count += weight
+        counts[key] = count
+        heapq.heappush(self.heap, (count, key))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(count, key) for key, count in counts.items()]
+            heapq.heapify(self.heap)
+
+    def _evict(self):
+        while True:
+            count, key = heapq.heappop(self.heap)
+            if self.counts.get(key) == count:
+                del self.counts[key]
+                return count
+
+    def top(self, count):
+        """
+        Return the (key, count) of the count heaviest keys.
+        """
+        return heapq.nlargest(count, self.counts.items(),
+            key=lambda item: item[1])
+
+
+class Stats:
+    """
+    Server wide counters, shared by every connection of a factory. The
+    threads of --threads share them too, without locking: updates racing
+    each other may be lost, which is fine for stats.
+
+    The latency of one command every sample_every is recorded, 0 disables
+    latency tracking. The hot_keys keys getting the most requests and bytes
+    are tracked from one get or set every key_sample_every, 0 disables
+    them. Tracking more keys than reported keeps the top ones accurate.
+    """
+    PERCENTILES = (50, 90, 99, 99.9)
+    # Keys tracked per hot key reported
+    HOT_KEY_SLACK = 10
+
+    def __init__(self, sample_every=10, hot_keys=0, key_sample_every=10):
+        self.started = time.time()
+        self.settings = {}
+        # Commands received by opcode
+        self.commands = [0] * 256
+        self.get_hits = 0
+        self.get_misses = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.curr_connections = 0
+        self.total_connections = 0
+        # Times a connection stopped being read from until it caught up
+        # with its responses
+        self.pauses = 0
+        # Values compressed by the server, their size before and after, and
+        # values decompressed for clients not accepting them compressed
+        self.compressed_values = 0
+        self.compressed_bytes_in = 0
+        self.compressed_bytes_out = 0
+        self.decompressions = 0
+        self.latencies = {}
+        self.timer = default_timer
+        self.sample_every = sample_every
+        # Commands left until the next sample, never reaches 0 when
+        # disabled
+        self.until_sample = sample_every - 1 if sample_every else \
+            float('inf')
+        self.top_keys = hot_keys
+        self.key_sample_every = key_sample_every
+        self.until_key_sample = key_sample_every - 1 \
+            if hot_keys and key_sample_every else float('inf')
+        self.hot_requests = SpaceSaving(hot_keys * self.HOT_KEY_SLACK)
+        self.hot_bytes = SpaceSaving(hot_keys * self.HOT_KEY_SLACK)
+        # Unlike counters, the trackers can't take racing updates
+        self.hot_lock = threading.Lock()
+
+    def record_latency(self, command, seconds):
+        self.until_sample = self.sample_every - 1
+        histogram = self.latencies.get(command)
+        if histogram is None:
+            histogram = self.latencies[command] = Histogram()
+        histogram.record(int(seconds * 1000000))
+
+    def record_key(self, key, size):
+        """
+        Count a request for key serving size bytes.
+        """
+        self.until_key_sample = self.key_sample_every - 1
+        with self.hot_lock:
+            self.hot_requests.add(key)
+            if size:
+                self.hot_bytes.add(key, size)
+
+    def compressed(self, size, compressed_size):
+        self.compressed_values += 1
+        self.compressed_bytes_in += size
+        self.compressed_bytes_out += compressed_size
+
+    def general(self, storage, names):
+        """
+        Return the stat name and value pairs of the default group, names
+        maps the opcodes of the commands served to their names.
+        """
+        now = time.time()
+        stats = [
+            ('pid', os.getpid()),
+            ('uptime', int(now - self.started)),
+            ('time', int(now)),
+            ('curr_connections', self.curr_connections),
+            ('total_connections', self.total_connections),
+            ('pauses', self.pauses),
+            ('get_hits', self.get_hits),
+            ('get_misses', self.get_misses),
+            ('bytes_read', self.bytes_read),
+            ('bytes_written', self.bytes_written),
+            ('curr_items', len(storage)),
+            ('bytes', storage.bytes),
+            ('evictions', storage.evictions),
+            ('expirations', storage.expirations),
+            ('compressed_values', self.compressed_values),
+            ('compressed_bytes_in', self.compressed_bytes_in),
+            ('compressed_bytes_out', self.compressed_bytes_out),
+            ('compression_ratio', '%.2f' % (self.compressed_bytes_in /
+                self.compressed_bytes_out if self.compressed_bytes_out
+                else 1)),
+            ('decompressions', self.decompressions),
+        ]
+        stats.extend(('cmd_%s' % names[opcode], self.commands[opcode])
+            for opcode in sorted(names))
+        return stats
+
+    def hot_keys(self):
+        """
+        Return the top keys by requests then by bytes, ranked from 1, with
+        their counts scaled back from the samples.
+        """
+        stats = []
+        with self.hot_lock:
+            for name, tracker in (('requests', self.hot_requests),
+                ('bytes', self.hot_bytes)):
+                for rank, (key, count) in enumerate(
+                    tracker.top(self.top_keys), 1):
+                    stats.append(('%s:%d:%s' % (name, rank,
+                        key.decode('ascii', 'backslashreplace')),
+                        count * self.key_sample_every))
+        return stats
+
+    def latency(self, names):
+        stats = []
+        for opcode in sorted(self.latencies):
+            histogram = self.latencies[opcode]
+            name = names.get(opcode, '0x%0.2x' % opcode)
+            stats.append(('%s:count' % name, histogram.count))
+            stats.extend(('%s:p%s_us' % (name, percent),
+                histogram.percentile(percent))
+                for percent in self.PERCENTILES)
+            stats.append(('%s:max_us' % name, histogram.max))
+        return stats
@@ -1,11 +1,20 @@
 from .memory import Storage as Memcached
+from .oplog import Storage as OpLog
+from .slab import Storage as Slab
+from .striped import Storage as Striped
+from .tiered import Storage as Tiered
 STORAGES = {
-    'memcached': Memcached
+    'memcached': Memcached,
+    'memory': Memcached,
+    'oplog': OpLog,
+    'slab': Slab,
+    'striped': Striped,
+    'tiered': Tiered,
 }
 
 
-def getStorage(name=None):
+def getStorage(name=None, **options):
     if name in STORAGES:
-        return STORAGES[name]()
+        return STORAGES[name](**options)
 
-    return Memcached()
+    return Memcached(**options)
@@ -1,34 +1,346 @@
-import datetime
-from twisted.internet import reactor
+import math
 from ..logger import log
 
+# Counters wrap around past this
+MAX_COUNTER = 2 ** 64 - 1
+
+
+def as_bytes(value):
+    """
+    Values are bytes like, except counters that backends keep as ints.
+    """
+    if isinstance(value, int):
+        return str(value).encode('ascii')
+    return value
+
+
+class OutOfMemory(Exception):
+    """
+    Raised when an item can't fit in the storage even after evicting
+    everything else.
+    """
+
+
+class KeyExists(Exception):
+    """
+    Raised by check_and_set when key holds an item it must not hold, or one
+    of another CAS.
+    """
+
+
+class BaseStorage:
+    """
+    Keeps track of item expiral for the backends.
+
+    Expired items are detected lazily when they are read and reclaimed in
+    the background by a hashed timing wheel: every key waits in the slot of
+    the second it expires at and a single sweeper walks the slots as time
+    goes by, expiring at most SWEEP_BATCH keys before yielding.
+
+    The sweeper is scheduled with callLater, unless sweep_from_ticks was
+    called: then it only runs when tick is called, which servers do as they
+    handle requests.
+
+    Flushes don't touch items either: they record the last CAS handed out,
+    for every key or for the keys of a namespace, and items whose CAS isn't
+    above it expire when they are next read. Until then they keep their
+    memory, unless they are evicted first.
+    """
+    # Bigger expiry times are absolute unix timestamps instead of seconds
+    MAX_RELATIVE_EXPIRY = 60 * 60 * 24 * 30
+    # Seconds covered by each slot of the wheel
+    WHEEL_RESOLUTION = 1
+    WHEEL_SIZE = 512
+    SWEEP_BATCH = 1000
+    # Keys are in the namespace found before it, see flush
+    NAMESPACE_SEPARATOR = b':'
+    # Storages shared between threads set it and implement lock, protocols
+    # then hold the lock of a key while they handle a request for it
+    threadsafe = False
 
-class BaseStorage(object):
     def __init__(self):
+        # Key and the timestamp it expires at
         self.expires = {}
+        self.wheel = [set() for i in range(self.WHEEL_SIZE)]
+        # Bytes used by items, as accounted by the backend
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        # Imported late so an event loop can choose the reactor first
+        from twisted.internet import reactor
+        # Last CAS value handed out, every write gets a new one
+        self.cas = 0
         self.callLater = reactor.callLater
+        self.seconds = reactor.seconds
+        self.sweep_on_tick = False
+        # Scheduled call of the sweeper, or the time it is due at with
+        # sweep_from_ticks
+        self._sweeper = None
+        self._nextTick = 0
+        # Items up to this CAS were flushed, and up to the CAS of their
+        # namespace here
+        self.flushed = 0
+        self.namespaces = {}
+        # Time and namespace of delayed flushes with sweep_from_ticks
+        self._flushes = []
 
     # Implemented in backend
     def expire_key(self, key):
         pass  # pragma: no cover
 
+    def keys(self):
+        """
+        List the stored keys, least recently used first when the backend
+        keeps track of it.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def peek(self, key):
+        """
+        Return the item of key or None, without checking its expiral or
+        counting it as used.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def __len__(self):
+        raise NotImplementedError  # pragma: no cover
+
+    def lock(self, key):
+        """
+        Return the reentrant lock guarding key, see threadsafe.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def counter(self, key, delta, initial, expiry):
+        """
+        Add delta, which may be negative, to the counter of key and return
+        its value and CAS. Counters never go below 0 and wrap around past
+        MAX_COUNTER.
+
+        A missing key is created with initial and expiry, unless initial is
+        None and KeyError is raised. ValueError is raised when the value
+        isn't a number.
+        """
+        try:
+            item = self[key]
+        except KeyError:
+            if initial is None:
+                raise
+            value = initial
+            flags = 0
+        else:
+            value = self._parse_counter(item['value'])
+            value = max(value + delta, 0) & MAX_COUNTER
+            flags = item['flags']
+            expiry = None
+
+        item = {'flags': flags, 'expiry': expiry,
+            'value': self._encode_counter(value)}
+        self[key] = item
+        return value, item['cas']
+
+    def _parse_counter(self, value):
+        if isinstance(value, int):
+            return value
+        if isinstance(value, memoryview):
+            value = value.tobytes()
+        if not value.isdigit() or int(value) > MAX_COUNTER:
+            raise ValueError(value)
+        return int(value)
+
+    def _encode_counter(self, value):
+        return str(value).encode('ascii')
+
+    def commit(self):
+        """
+        Called once the requests of a read are handled and before they are
+        answered, so backends can persist their writes in a single batch.
+        """
+
+    def close(self):
+        pass
+
+    def _next_cas(self):
+        self.cas += 1
+        return self.cas
+
     def _expire_key(self, key):
-        log.msg('Expiring key %s' % key)
+        if log.debugging:
+            log.debug('Expiring key %r', key)
         self.expire_key(key)
-        del self.expires[key]
+        self._cancel_expiry_time(key)
+        self.expirations += 1
+
+    def _deadline(self, expiry):
+        if expiry > self.MAX_RELATIVE_EXPIRY:
+            return expiry
+        return self.seconds() + expiry
+
+    def _tick(self, timestamp):
+        # Rounded up so a slot is only swept once all of its keys are due
+        return int(math.ceil(timestamp / float(self.WHEEL_RESOLUTION)))
 
     def _add_expiry_time(self, key, expiry):
-        log.msg('Key %s will expire in %d microseconds' % (key, expiry))
+        self._cancel_expiry_time(key)
+        if not expiry:
+            return
 
-        if key in self.expires:
-            log.msg('Key %s already exists, cancelling its expiral' % key)
-            self.expires[key].cancel()
-            del self.expires[key]
+        deadline = self._deadline(expiry)
+        if log.debugging:
+            log.debug('Key %r will expire at %d', key, deadline)
+        self.expires[key] = deadline
+        self.wheel[self._tick(deadline) % self.WHEEL_SIZE].add(key)
 
-        self.expires[key] = self.callLater(expiry/ 1000.0, self._expire_key, key)
+        if self._sweeper is None:
+            self._nextTick = self._tick(self.seconds())
+            self._sweeper = self._schedule_sweep(self.WHEEL_RESOLUTION)
+
+    def _cancel_expiry_time(self, key):
+        deadline = self.expires.pop(key, None)
+        if deadline is not None:
+            self.wheel[self._tick(deadline) % self.WHEEL_SIZE].discard(key)
+
+    def deadline(self, key):
+        """
+        Return the timestamp key expires at, 0 if it doesn't.
+        """
+        return self.expires.get(key, 0)
+
+    def _is_expired(self, key, cas):
+        if cas <= self.flushed or self.namespaces and \
+            self._namespace_flushed(key, cas):
+            return True
+        deadline = self.expires.get(key)
+        return deadline is not None and deadline <= self.seconds()
+
+    def _namespace_flushed(self, key, cas):
+        namespace, separator, rest = key.partition(self.NAMESPACE_SEPARATOR)
+        return bool(separator) and cas <= self.namespaces.get(namespace, 0)
+
+    def is_flushed(self, key, cas):
+        """
+        Return whether the item of key with cas was flushed, items returned
+        by peek may have been.
+        """
+        return cas <= self.flushed or bool(self.namespaces) and \
+            self._namespace_flushed(key, cas)
+
+    def flush(self, expiry=0, namespace=None):
+        """
+        Invalidate every item, or those whose key starts with namespace and
+        NAMESPACE_SEPARATOR, in constant time. With an expiry time, in
+        seconds or as a unix timestamp, it happens then and takes the items
+        written meanwhile along. Flushed items still count in len and bytes
+        until they are read, deleted or evicted.
+        """
+        if not expiry:
+            self._flush(namespace)
+            return
+        delay = max(self._deadline(expiry) - self.seconds(), 0)
+        if self.sweep_on_tick:
+            self._flushes.append((self.seconds() + delay, namespace))
+        else:
+            self.callLater(delay, self._flush, namespace)
+
+    def _flush(self, namespace):
+        if namespace is None:
+            self.flushed = self.cas
+            # Covered by the flush of everything
+            self.namespaces.clear()
+        else:
+            self.namespaces[namespace] = self.cas
+
+    def _sweep_slot(self, slot, now, budget):
+        expired = []
+        for key in slot:
+            if self.expires[key] <= now:
+                expired.append(key)
+                if len(expired) == budget:
+                    break
+
+        for key in expired:
+            self._expire_key(key)
+        return len(expired)
+
+    def _sweep(self):
+        now = self.seconds()
+        current = self._tick(now)
+        budget = self.SWEEP_BATCH
+
+        tick = max(self._nextTick, current - self.WHEEL_SIZE + 1)
+        while tick <= current:
+            budget -= self._sweep_slot(self.wheel[tick % self.WHEEL_SIZE],
+                now, budget)
+            if not budget:
+                # The slot may still have expired keys, continue after
+                # giving the reactor a chance to run
+                break
+            tick += 1
+        self._nextTick = tick
+
+        if not self.expires:
+            self._sweeper = None
+            return
+        self._sweeper = self._schedule_sweep(
+            self.WHEEL_RESOLUTION if budget else 0)
+
+    def _schedule_sweep(self, delay):
+        if self.sweep_on_tick:
+            return self.seconds() + delay
+        return self.callLater(delay, self._sweep)
+
+    def sweep_from_ticks(self):
+        """
+        Run the sweeper from tick from now on instead of with callLater.
+        """
+        self.sweep_on_tick = True
+        if self._sweeper is not None:
+            due = self._sweeper.getTime()
+            self._sweeper.cancel()
+            self._sweeper = due
+
+    def tick(self):
+        """
+        Run the sweeper if it is due, see sweep_from_ticks.
+        """
+        if self._sweeper is not None and self.sweep_on_tick and \
+            self._sweeper <= self.seconds():
+            self._sweep()
+        if self._flushes:
+            now = self.seconds()
+            for due, namespace in list(self._flushes):
+                if due <= now:
+                    self._flushes.remove((due, namespace))
+                    self._flush(namespace)
 
     def __setitem__(self, key, value):
-        self._add_expiry_time(key, value['expiry'])
+        """
+        Backends store value['value'] and set value['cas'], an expiry of None
+        keeps the expiry time the key had. value['datatype'], 0 when
+        missing, is stored along and given back with the item.
+        """
+        if value['expiry'] is not None:
+            self._add_expiry_time(key, value['expiry'])
+
+    def swap_value(self, key, cas, value, datatype):
+        """
+        Replace the value of key with an equivalent one of another datatype,
+        like its compressed copy, if key still holds the item of cas. The
+        item keeps its flags, expiry time and CAS. Return whether it was
+        replaced.
+        """
+        item = self.peek(key)
+        if item is None or item['cas'] != cas:
+            return False
+        # The write takes cas again, later ones carry on from the counter
+        last = self.cas
+        self.cas = cas - 1
+        try:
+            self[key] = {'flags': item['flags'], 'expiry': None,
+                'value': value, 'datatype': datatype}
+        finally:
+            self.cas = last
+        return True
 
     def __contains__(self, key):
         try:
@@ -36,3 +348,70 @@ class BaseStorage(object):
             return True
         except KeyError:
             return False
+
+    def check_and_set(self, key, value, cas=0, exists=None):
+        """
+        Store value like __setitem__ after checking the item of key, in a
+        single lookup: its CAS must be cas unless that is 0, and key must
+        hold an item when exists is True and must not when it is False.
+        Raise KeyError when key holds no item but must and KeyExists when
+        it holds one but must not or one of another CAS.
+        """
+        try:
+            item = self[key]
+        except KeyError:
+            if exists or cas:
+                raise
+        else:
+            if exists is False or cas and item['cas'] != cas:
+                raise KeyExists(key)
+        self[key] = value
+
+    def get_many(self, keys):
+        """
+        Return the items of keys, None for those missing. Backends may
+        share their locks, lookups and I/O between the keys.
+
+        Values that are views into the storage are copied, a later lookup
+        of the batch may move another item to where they point.
+        """
+        items = []
+        for key in keys:
+            try:
+                item = self[key]
+            except KeyError:
+                items.append(None)
+                continue
+            if item['value'].__class__ is memoryview:
+                item = dict(item, value=item['value'].tobytes())
+            items.append(item)
+        return items
+
+    def set_many(self, items):
+        """
+        Store (key, value) pairs like __setitem__ and return whether each
+        one was, those that can't fit are not.
+        """
+        stored = []
+        for key, value in items:
+            try:
+                self[key] = value
+            except OutOfMemory:
+                stored.append(False)
+            else:
+                stored.append(True)
+        return stored
+
+    def delete_many(self, keys):
+        """
+        Delete keys and return whether each one held an item.
+        """
+        deleted = []
+        for key in keys:
+            try:
+                del self[key]
+            except KeyError:
+                deleted.append(False)
+            else:
+                deleted.append(True)
+        return deleted
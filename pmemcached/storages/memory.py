@@ -1,21 +1,113 @@
-from .base import BaseStorage
+from collections import OrderedDict
+from .base import BaseStorage, MAX_COUNTER, OutOfMemory
 
 
 class Storage(BaseStorage):
-    def __init__(self):
-        super(Storage, self).__init__()
-        self.data = {}
+    # Bytes charged for every item on top of its key and value
+    ITEM_OVERHEAD = 48
+    # A read only moves an item to the most recently used end if it was not
+    # moved in the last BUMP_INTERVAL seconds, so hot keys don't churn.
+    BUMP_INTERVAL = 60
+    # Bytes charged for the value of a counter, kept as an int
+    COUNTER_SIZE = 8
+
+    def __init__(self, max_bytes=0):
+        """
+        max_bytes limits the size of keys and values kept, 0 means
+        unlimited. Least recently used items are evicted to honor it.
+        """
+        super().__init__()
+        # Ordered from least to most recently used
+        self.data = OrderedDict()
+        self.max_bytes = max_bytes
+        # Bigger items are rejected, max_bytes when None, see striped
+        self.max_item_bytes = None
+
+    def _item_size(self, key, value):
+        data = value['value']
+        if isinstance(data, int):
+            return len(key) + self.COUNTER_SIZE + self.ITEM_OVERHEAD
+        return len(key) + len(data) + self.ITEM_OVERHEAD
+
+    def _remove(self, key):
+        value = self.data.pop(key)
+        self.bytes -= self._item_size(key, value)
+        return value
 
     def expire_key(self, key):
         if key in self.data:
-            del self.data[key]
+            self._remove(key)
+
+    def evict(self):
+        key, value = self.data.popitem(last=False)
+        self.bytes -= self._item_size(key, value)
+        self._cancel_expiry_time(key)
+        self.evictions += 1
 
     def __setitem__(self, key, value):
+        size = self._item_size(key, value)
+        max_item_bytes = self.max_item_bytes
+        if max_item_bytes is None:
+            max_item_bytes = self.max_bytes
+        if max_item_bytes and size > max_item_bytes:
+            raise OutOfMemory(key)
+
+        if key in self.data:
+            self._remove(key)
+        while self.max_bytes and self.data and \
+            self.bytes + size > self.max_bytes:
+            self.evict()
+
+        value['bumped'] = self.seconds()
+        value['cas'] = self._next_cas()
         self.data[key] = value
-        super(Storage, self).__setitem__(key, value)
+        self.bytes += size
+        super().__setitem__(key, value)
 
     def __getitem__(self, key):
-        return self.data[key]
+        value = self.data[key]
+        if self._is_expired(key, value['cas']):
+            self._expire_key(key)
+            raise KeyError(key)
+
+        now = self.seconds()
+        if now - value['bumped'] >= self.BUMP_INTERVAL:
+            value['bumped'] = now
+            # Reinserting moves it to the most recently used end
+            del self.data[key]
+            self.data[key] = value
+        return value
+
+    def counter(self, key, delta, initial, expiry):
+        """
+        Counters are kept as ints and updated in place once created.
+        """
+        try:
+            item = self[key]
+        except KeyError:
+            item = None
+        if item is None or not isinstance(item['value'], int):
+            return super().counter(key, delta, initial, expiry)
+
+        item['value'] = max(item['value'] + delta, 0) & MAX_COUNTER
+        item['cas'] = self._next_cas()
+        return item['value'], item['cas']
+
+    def _encode_counter(self, value):
+        return value
+
+    def __len__(self):
+        return len(self.data)
+
+    def keys(self):
+        return list(self.data)
+
+    def peek(self, key):
+        return self.data.get(key)
 
     def __delitem__(self, key):
-        del self.data[key]
+        if self._is_expired(key, self.data[key]['cas']):
+            self._expire_key(key)
+            raise KeyError(key)
+        self._remove(key)
+        self._cancel_expiry_time(key)
@@ -0,0 +1,359 @@
+"""
+Durable storage keeping values in an append-only log of operations.
+
+Every set and delete is appended to the log as a record:
+
+    op (B) | key length (H) | flags (L) | value length (L) | expires at (d)
+    | key | value
+
+Sets of values compressed by the server, or sent compressed by clients,
+are logged with the SET_COMPRESSED op so their data type survives a
+replay. Flushes are logged as FLUSH records, or FLUSH_NAMESPACE ones whose
+key is the namespace, and invalidate the sets before them.
+
+Only an index of where each live value sits in the log is kept in memory,
+values are read back with pread. Writes are buffered and appended in one
+go when the protocol commits a batch of requests, so a pipelined batch
+costs a single write (and fsync, depending on the policy). Once most of
+the log is garbage it is compacted in the background.
+"""
+import math
+import mmap
+import os
+import struct
+import time
+from twisted.internet import task
+from ..codec import DATATYPE_COMPRESSED
+from ..logger import log
+from .base import BaseStorage
+
+RECORD = struct.Struct('!BHLLd')
+SET = 1
+DELETE = 2
+SET_COMPRESSED = 3
+FLUSH = 4
+FLUSH_NAMESPACE = 5
+
+# Op of the sets of each datatype, and the other way around
+SET_OPS = {0: SET, DATATYPE_COMPRESSED: SET_COMPRESSED}
+DATATYPES = dict((op, datatype) for datatype, op in SET_OPS.items())
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+def write_all(fd, data):
+    written = 0
+    while written < len(data):
+        written += os.write(fd, data[written:])
+
+
+def pread(fd, length, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, length, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+
+class Storage(BaseStorage):
+    """
+    fsync is one of FSYNC_POLICIES: after every commit, every
+    fsync_interval milliseconds or never, leaving it to the OS.
+
+    max_bytes is accepted for compatibility with the other storages, values
+    live on disk so it doesn't limit anything.
+    """
+    # Compact when the log is this many times bigger than its live records
+    COMPACT_RATIO = 2
+    COMPACT_MIN_BYTES = 64 * 1024 * 1024
+    # See snapshot.Snapshotter.SLICE
+    SLICE = 0.002
+
+    def __init__(self, path='pmemcached.log', fsync='interval',
+        fsync_interval=1000, max_bytes=0):
+        super().__init__()
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy %r' % fsync)
+        self.path = path
+        self.fsync = fsync
+        # Key and the (offset, length, flags, cas, datatype) of its value in
+        # the log
+        self.index = {}
+        # Values appended but not committed yet
+        self.pending = {}
+        self._buffer = []
+        self._commit = None
+        self.size = 0
+        self.live = 0
+        self.compactions = 0
+        self._compaction = None
+        self._dirty = set()
+        self._flushedWhileCompacting = False
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._replay()
+        self._synced = True
+        self.syncer = None
+        if fsync == 'interval':
+            self.syncer = task.LoopingCall(self.sync)
+            self.syncer.start(fsync_interval / 1000.0, now=False)
+        self.cooperator = task.Cooperator(
+            terminationPredicateFactory=self._slice,
+            scheduler=lambda work: self.callLater(0, work))
+
+    def _slice(self):
+        deadline = time.time() + self.SLICE
+        return lambda: time.time() >= deadline
+
+    def _replay(self):
+        size = os.fstat(self.fd).st_size
+        if not size:
+            return
+        data = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        now = self.seconds()
+        try:
+            offset = 0
+            while offset + RECORD.size <= size:
+                op, keyLength, flags, valueLength, deadline = \
+                    RECORD.unpack_from(data, offset)
+                keyEnd = offset + RECORD.size + keyLength
+                end = keyEnd + valueLength
+                if end > size or op not in DATATYPES and \
+                    op not in (DELETE, FLUSH, FLUSH_NAMESPACE):
+                    break
+                key = data[keyEnd - keyLength:keyEnd]
+                if op in (FLUSH, FLUSH_NAMESPACE):
+                    BaseStorage._flush(self, key if op == FLUSH_NAMESPACE
+                        else None)
+                    offset = end
+                    continue
+                self._forget(key)
+                self._cancel_expiry_time(key)
+                if op != DELETE and not 0 < deadline <= now:
+                    self._index(key, keyEnd, valueLength, flags,
+                        self._next_cas(), DATATYPES[op])
+                    if deadline:
+                        self._add_expiry_time(key, self._expiry(deadline, now))
+                offset = end
+        finally:
+            data.close()
+
+        if offset < size:
+            log.warning('Dropping %d bytes of incomplete records from %s',
+                size - offset, self.path)
+            os.ftruncate(self.fd, offset)
+        self.size = offset
+
+    def _expiry(self, deadline, now):
+        expiry = int(math.ceil(deadline - now))
+        if expiry > self.MAX_RELATIVE_EXPIRY:
+            return int(math.ceil(deadline))
+        return expiry
+
+    def _index(self, key, offset, length, flags, cas, datatype):
+        self.index[key] = (offset, length, flags, cas, datatype)
+        self.live += RECORD.size + len(key) + length
+        self.bytes += len(key) + length
+
+    def _forget(self, key):
+        entry = self.index.pop(key, None)
+        if entry is not None:
+            self.live -= RECORD.size + len(key) + entry[1]
+            self.bytes -= len(key) + entry[1]
+        self.pending.pop(key, None)
+
+    def _append(self, op, key, flags=0, value=b'', deadline=0):
+        record = RECORD.pack(op, len(key), flags, len(value), deadline)
+        offset = self.size + RECORD.size + len(key)
+        self._buffer.extend((record, key, value))
+        self.size = offset + len(value)
+        if self._compaction is not None:
+            self._dirty.add(key)
+        if self._commit is None:
+            # In case nobody commits for us
+            self._commit = self.callLater(0, self.commit)
+        return offset
+
+    def commit(self):
+        """
+        Write the buffered records to the log.
+        """
+        if self._commit is not None:
+            if self._commit.active():
+                self._commit.cancel()
+            self._commit = None
+        if not self._buffer:
+            return
+
+        data = b''.join(self._buffer)
+        self._buffer = []
+        write_all(self.fd, data)
+        self.pending.clear()
+        self._synced = False
+        if self.fsync == 'always':
+            self.sync()
+        self._maybe_compact()
+
+    def sync(self):
+        if not self._synced:
+            os.fsync(self.fd)
+            self._synced = True
+
+    def close(self):
+        self.commit()
+        self.sync()
+        if self.syncer is not None and self.syncer.running:
+            self.syncer.stop()
+        os.close(self.fd)
+
+    def expire_key(self, key):
+        if key in self.index:
+            self._forget(key)
+            self._append(DELETE, key)
+
+    def _flush(self, namespace):
+        super()._flush(namespace)
+        if namespace is None:
+            self._append(FLUSH, b'')
+        else:
+            self._append(FLUSH_NAMESPACE, namespace)
+        if self._compaction is not None:
+            self._flushedWhileCompacting = True
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        data = value['value']
+        datatype = value.get('datatype', 0)
+        self._forget(key)
+        offset = self._append(SET_OPS[datatype], key, value['flags'], data,
+            self.expires.get(key, 0))
+        value['cas'] = self._next_cas()
+        self._index(key, offset, len(data), value['flags'], value['cas'],
+            datatype)
+        self.pending[key] = data
+
+    def _read(self, key):
+        offset, length, flags, cas, datatype = self.index[key]
+        value = self.pending.get(key)
+        if value is None:
+            value = pread(self.fd, length, offset)
+        return {'flags': flags, 'cas': cas, 'value': value,
+            'datatype': datatype}
+
+    def __getitem__(self, key):
+        if key not in self.index:
+            raise KeyError(key)
+        if self._is_expired(key, self.index[key][3]):
+            self._expire_key(key)
+            raise KeyError(key)
+        return self._read(key)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return list(self.index)
+
+    def peek(self, key):
+        if key not in self.index:
+            return None
+        return self._read(key)
+
+    def __delitem__(self, key):
+        if key not in self.index:
+            raise KeyError(key)
+        if self._is_expired(key, self.index[key][3]):
+            self._expire_key(key)
+            raise KeyError(key)
+        self._forget(key)
+        self._cancel_expiry_time(key)
+        self._append(DELETE, key)
+
+    def _maybe_compact(self):
+        if self._compaction is None and \
+            self.size > self.COMPACT_MIN_BYTES and \
+            self.size > self.live * self.COMPACT_RATIO:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the log with only its live records. Records are copied a
+        few at a time, keys written meanwhile are copied again at the end.
+        Flushed items found on the way are reclaimed, a flush meanwhile
+        gives the compaction up as items copied before it may be stale.
+        """
+        if self._compaction is None:
+            self._compaction = self.cooperator.cooperate(self._compact())
+            self._compaction.whenDone().addErrback(log.err,
+                'Compacting %s failed' % self.path)
+        return self._compaction.whenDone()
+
+    def _compact(self):
+        started = time.time()
+        temporary = '%s.compact' % self.path
+        fd = os.open(temporary,
+            os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+        index = {}
+        size = [0]
+
+        def write(key, item):
+            value = item['value']
+            record = RECORD.pack(SET_OPS[item['datatype']], len(key),
+                item['flags'], len(value), self.expires.get(key, 0))
+            write_all(fd, record + key)
+            write_all(fd, value)
+            offset = size[0] + len(record) + len(key)
+            index[key] = (offset, len(value), item['flags'], item['cas'],
+                item['datatype'])
+            size[0] = offset + len(value)
+
+        try:
+            for key in self.keys():
+                if key in self.index and key not in self._dirty:
+                    if self.is_flushed(key, self.index[key][3]):
+                        self._expire_key(key)
+                    else:
+                        write(key, self._read(key))
+                yield
+
+            if self._flushedWhileCompacting:
+                log.info('Giving up compacting %s, flushed meanwhile',
+                    self.path)
+                os.close(fd)
+                os.unlink(temporary)
+                return
+
+            # Keys written meanwhile, done in one go so nothing else
+            # changes before the logs are swapped
+            self.commit()
+            for key in self._dirty:
+                copied = index.pop(key, None)
+                if key in self.index:
+                    write(key, self._read(key))
+                elif copied is not None:
+                    # Deleted after being copied, it would be replayed
+                    record = RECORD.pack(DELETE, len(key), 0, 0, 0) + key
+                    write_all(fd, record)
+                    size[0] += len(record)
+            os.fsync(fd)
+            os.rename(temporary, self.path)
+        except Exception:
+            os.close(fd)
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+            raise
+        finally:
+            self._compaction = None
+            self._dirty = set()
+            self._flushedWhileCompacting = False
+
+        os.close(self.fd)
+        self.fd = fd
+        self.index = index
+        self.size = size[0]
+        # Copies of keys written meanwhile aren't live anymore
+        self.live = sum(RECORD.size + len(key) + entry[1]
+            for key, entry in index.items())
+        self._synced = True
+        self.compactions += 1
+        log.info('Compacted %s in %.2f seconds', self.path,
+            time.time() - started)
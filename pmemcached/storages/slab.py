@@ -0,0 +1,241 @@
+from array import array
+from bisect import bisect_left
+from .base import BaseStorage, OutOfMemory
+
+# No chunk, at the ends of the least recently used lists
+NONE = -1
+
+
+class SlabClass:
+    """
+    Chunks of a single size carved out of preallocated pages.
+
+    Item metadata lives in parallel arrays indexed by chunk number instead
+    of one object per item, and so do the links of the least recently used
+    list of the class.
+    """
+    def __init__(self, size, page_size):
+        self.size = size
+        self.per_page = page_size // size
+        self.page_size = page_size
+        self.pages = []
+        self.free = array('L')
+        self.lengths = array('L')
+        self.flags = array('L')
+        self.bumped = array('L')
+        self.cas = array('Q')
+        self.datatypes = array('B')
+        # Key stored in each chunk, None when free
+        self.keys = []
+        # Used chunks linked from the least recently used, head, to the
+        # most recently used, tail
+        self.prev = array('l')
+        self.next = array('l')
+        self.head = NONE
+        self.tail = NONE
+
+    def add_page(self, page):
+        first = len(self.pages) * self.per_page
+        self.pages.append(page)
+        # Reversed so chunks are handed out in order
+        self.free.extend(range(first + self.per_page - 1, first - 1, -1))
+        padding = array('L', [0]) * self.per_page
+        self.lengths.extend(padding)
+        self.flags.extend(padding)
+        self.bumped.extend(padding)
+        self.cas.extend(array('Q', [0]) * self.per_page)
+        self.datatypes.extend(array('B', [0]) * self.per_page)
+        self.keys.extend([None] * self.per_page)
+        links = array('l', [NONE]) * self.per_page
+        self.prev.extend(links)
+        self.next.extend(links)
+
+    def link(self, chunk):
+        """
+        Add chunk to the list as the most recently used.
+        """
+        self.prev[chunk] = self.tail
+        self.next[chunk] = NONE
+        if self.tail == NONE:
+            self.head = chunk
+        else:
+            self.next[self.tail] = chunk
+        self.tail = chunk
+
+    def unlink(self, chunk):
+        prev, next = self.prev[chunk], self.next[chunk]
+        if prev == NONE:
+            self.head = next
+        else:
+            self.next[prev] = next
+        if next == NONE:
+            self.tail = prev
+        else:
+            self.prev[next] = prev
+
+    def lru(self):
+        """
+        Yield the keys stored in this class, least recently used first.
+        """
+        chunk = self.head
+        while chunk != NONE:
+            yield self.keys[chunk]
+            chunk = self.next[chunk]
+
+    def view(self, chunk):
+        offset = (chunk % self.per_page) * self.size
+        return self.pages[chunk // self.per_page][
+            offset:offset + self.lengths[chunk]]
+
+    def write(self, chunk, data, flags, cas, now, datatype=0):
+        offset = (chunk % self.per_page) * self.size
+        self.pages[chunk // self.per_page][offset:offset + len(data)] = data
+        self.lengths[chunk] = len(data)
+        self.flags[chunk] = flags
+        self.cas[chunk] = cas
+        self.datatypes[chunk] = datatype
+        self.bumped[chunk] = now
+
+    def item(self, chunk):
+        return {'flags': self.flags[chunk], 'cas': self.cas[chunk],
+            'value': self.view(chunk), 'datatype': self.datatypes[chunk]}
+
+
+class Storage(BaseStorage):
+    """
+    Values are kept in size classed chunks of preallocated bytearray pages
+    and reads return memoryviews straight into them, so they are only valid
+    until the key is written again.
+
+    max_bytes limits how many pages are allocated, 0 means unlimited. Once
+    every page is in use a class evicts its own least recently used items.
+    """
+    GROWTH_FACTOR = 1.25
+    MIN_CHUNK_SIZE = 48
+    # See memory.Storage.BUMP_INTERVAL
+    BUMP_INTERVAL = 60
+
+    def __init__(self, max_bytes=0, page_size=1024 * 1024):
+        super().__init__()
+        self.classes = []
+        self.sizes = []
+        size = self.MIN_CHUNK_SIZE
+        while size < page_size:
+            self.classes.append(SlabClass(size, page_size))
+            self.sizes.append(size)
+            size = int(size * self.GROWTH_FACTOR + 7) & ~7
+        self.classes.append(SlabClass(page_size, page_size))
+        self.sizes.append(page_size)
+
+        self.page_size = page_size
+        # Key and its chunk << 8 | class
+        self.index = {}
+        self.max_pages = max_bytes // page_size if max_bytes else None
+        if self.max_pages is not None:
+            self.max_pages = max(self.max_pages, 1)
+        self.pages = 0
+
+    def _locate(self, key):
+        handle = self.index[key]
+        return self.classes[handle & 0xff], handle >> 8
+
+    def _remove(self, key):
+        slab, chunk = self._locate(key)
+        del self.index[key]
+        slab.unlink(chunk)
+        slab.keys[chunk] = None
+        slab.free.append(chunk)
+        self.bytes -= len(key) + slab.lengths[chunk]
+
+    def _new_page(self):
+        return memoryview(bytearray(self.page_size))
+
+    def _evicted(self, key):
+        self._cancel_expiry_time(key)
+
+    def _allocate(self, slab, key):
+        if not slab.free:
+            if self.max_pages is None or self.pages < self.max_pages:
+                slab.add_page(self._new_page())
+                self.pages += 1
+            elif slab.head != NONE:
+                evicted = slab.keys[slab.head]
+                self._remove(evicted)
+                self._evicted(evicted)
+                self.evictions += 1
+            else:
+                raise OutOfMemory(key)
+        return slab.free.pop()
+
+    def expire_key(self, key):
+        if key in self.index:
+            self._remove(key)
+
+    def __setitem__(self, key, value):
+        data = value['value']
+        cls = bisect_left(self.sizes, len(data))
+        if cls == len(self.sizes):
+            raise OutOfMemory(key)
+
+        if key in self.index:
+            self._remove(key)
+        slab = self.classes[cls]
+        try:
+            chunk = self._allocate(slab, key)
+        except OutOfMemory:
+            # The previous item of key is gone
+            self._cancel_expiry_time(key)
+            raise
+        value['cas'] = self._next_cas()
+        slab.write(chunk, data, value['flags'], value['cas'],
+            int(self.seconds()), value.get('datatype', 0))
+        slab.keys[chunk] = key
+        slab.link(chunk)
+        self.index[key] = chunk << 8 | cls
+        self.bytes += len(key) + len(data)
+        super().__setitem__(key, value)
+
+    def __getitem__(self, key):
+        slab, chunk = self._locate(key)
+        if self._is_expired(key, slab.cas[chunk]):
+            self._expire_key(key)
+            raise KeyError(key)
+
+        now = int(self.seconds())
+        if now - slab.bumped[chunk] >= self.BUMP_INTERVAL:
+            slab.bumped[chunk] = now
+            slab.unlink(chunk)
+            slab.link(chunk)
+        return slab.item(chunk)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        keys = []
+        for slab in self.classes:
+            keys.extend(slab.lru())
+        return keys
+
+    def peek(self, key):
+        if key not in self.index:
+            return None
+        slab, chunk = self._locate(key)
+        return slab.item(chunk)
+
+    def __contains__(self, key):
+        if key not in self.index:
+            return False
+        slab, chunk = self._locate(key)
+        if self._is_expired(key, slab.cas[chunk]):
+            self._expire_key(key)
+            return False
+        return True
+
+    def __delitem__(self, key):
+        slab, chunk = self._locate(key)
+        if self._is_expired(key, slab.cas[chunk]):
+            self._expire_key(key)
+            raise KeyError(key)
+        self._remove(key)
+        self._cancel_expiry_time(key)
@@ -0,0 +1,193 @@
+import threading
+from .base import BaseStorage
+from .memory import Storage as MemoryStorage
+
+
+class Storage:
+    """
+    Thread safe storage, shared by the event loops of --threads.
+
+    Keys are spread by hash over STRIPES memory storages, each one with its
+    own lock and its own share of the memory limit, so threads only wait
+    for each other when they use keys of the same stripe. Items up to the
+    whole limit are still stored, one bigger than the share of its stripe
+    evicts everything else in it. Locks are
+    reentrant: protocols hold lock(key) for a whole request, see
+    BaseStorage.threadsafe, and the operations take it again.
+    """
+    MAX_RELATIVE_EXPIRY = BaseStorage.MAX_RELATIVE_EXPIRY
+    NAMESPACE_SEPARATOR = BaseStorage.NAMESPACE_SEPARATOR
+    # A power of two, so a stripe is picked with a mask
+    STRIPES = 16
+    threadsafe = True
+
+    def __init__(self, max_bytes=0, stripes=STRIPES):
+        if stripes & (stripes - 1):
+            raise ValueError('Stripes must be a power of two, not %d' %
+                stripes)
+        self.stripes = [MemoryStorage(max_bytes // stripes)
+            for i in range(stripes)]
+        for stripe in self.stripes:
+            stripe.max_item_bytes = max_bytes
+        self.locks = [threading.RLock() for i in range(stripes)]
+        self.mask = stripes - 1
+        from twisted.internet import reactor
+        self.callLater = reactor.callLater
+        self.seconds = reactor.seconds
+        # Earliest time tick checks the stripes again
+        self._nextSweep = 0
+
+    def _stripe(self, key):
+        index = hash(key) & self.mask
+        return self.locks[index], self.stripes[index]
+
+    def _by_stripe(self, keys):
+        """
+        Return the index of the stripe of keys and the positions of its
+        keys among them, so batches take each lock once.
+        """
+        stripes = {}
+        mask = self.mask
+        for position, key in enumerate(keys):
+            stripes.setdefault(hash(key) & mask, []).append(position)
+        return stripes.items()
+
+    def lock(self, key):
+        return self.locks[hash(key) & self.mask]
+
+    def __getitem__(self, key):
+        lock, stripe = self._stripe(key)
+        with lock:
+            return stripe[key]
+
+    def __setitem__(self, key, value):
+        lock, stripe = self._stripe(key)
+        with lock:
+            stripe[key] = value
+
+    def __delitem__(self, key):
+        lock, stripe = self._stripe(key)
+        with lock:
+            del stripe[key]
+
+    def __contains__(self, key):
+        lock, stripe = self._stripe(key)
+        with lock:
+            return key in stripe
+
+    def check_and_set(self, key, value, cas=0, exists=None):
+        lock, stripe = self._stripe(key)
+        with lock:
+            stripe.check_and_set(key, value, cas, exists)
+
+    def get_many(self, keys):
+        """
+        Items are copied while their stripe is locked, so they stay
+        consistent after it is released.
+        """
+        items = [None] * len(keys)
+        for index, positions in self._by_stripe(keys):
+            stripe = self.stripes[index]
+            with self.locks[index]:
+                found = stripe.get_many([keys[i] for i in positions])
+                for position, item in zip(positions, found):
+                    if item is not None:
+                        items[position] = dict(item)
+        return items
+
+    def set_many(self, items):
+        stored = [False] * len(items)
+        keys = [key for key, value in items]
+        for index, positions in self._by_stripe(keys):
+            with self.locks[index]:
+                done = self.stripes[index].set_many(
+                    [items[i] for i in positions])
+            for position, result in zip(positions, done):
+                stored[position] = result
+        return stored
+
+    def delete_many(self, keys):
+        deleted = [False] * len(keys)
+        for index, positions in self._by_stripe(keys):
+            with self.locks[index]:
+                done = self.stripes[index].delete_many(
+                    [keys[i] for i in positions])
+            for position, result in zip(positions, done):
+                deleted[position] = result
+        return deleted
+
+    def counter(self, key, delta, initial, expiry):
+        lock, stripe = self._stripe(key)
+        with lock:
+            return stripe.counter(key, delta, initial, expiry)
+
+    def swap_value(self, key, cas, value, datatype):
+        lock, stripe = self._stripe(key)
+        with lock:
+            return stripe.swap_value(key, cas, value, datatype)
+
+    def is_flushed(self, key, cas):
+        lock, stripe = self._stripe(key)
+        with lock:
+            return stripe.is_flushed(key, cas)
+
+    def flush(self, expiry=0, namespace=None):
+        for lock, stripe in zip(self.locks, self.stripes):
+            with lock:
+                stripe.flush(expiry, namespace)
+
+    def peek(self, key):
+        lock, stripe = self._stripe(key)
+        with lock:
+            return stripe.peek(key)
+
+    def deadline(self, key):
+        lock, stripe = self._stripe(key)
+        with lock:
+            return stripe.deadline(key)
+
+    def keys(self):
+        keys = []
+        for lock, stripe in zip(self.locks, self.stripes):
+            with lock:
+                keys.extend(stripe.keys())
+        return keys
+
+    def __len__(self):
+        return sum(len(stripe) for stripe in self.stripes)
+
+    @property
+    def bytes(self):
+        return sum(stripe.bytes for stripe in self.stripes)
+
+    @property
+    def evictions(self):
+        return sum(stripe.evictions for stripe in self.stripes)
+
+    @property
+    def expirations(self):
+        return sum(stripe.expirations for stripe in self.stripes)
+
+    def sweep_from_ticks(self):
+        for lock, stripe in zip(self.locks, self.stripes):
+            with lock:
+                stripe.sweep_from_ticks()
+
+    def tick(self):
+        """
+        Sweep the stripes that are due, at most once per wheel slot
+        whichever thread calls it.
+        """
+        now = self.seconds()
+        if now < self._nextSweep:
+            return
+        self._nextSweep = now + BaseStorage.WHEEL_RESOLUTION
+        for lock, stripe in zip(self.locks, self.stripes):
+            with lock:
+                stripe.tick()
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,204 @@
+import mmap
+import os
+from .base import BaseStorage, KeyExists, OutOfMemory, as_bytes
+from .memory import Storage as MemoryStorage
+from .slab import Storage as SlabStorage
+
+
+class HotStorage(MemoryStorage):
+    """
+    Hands its least recently used items to demote instead of dropping them.
+    """
+    def __init__(self, max_bytes, demote):
+        super().__init__(max_bytes)
+        self.demote = demote
+
+    def evict(self):
+        key, value = self.data.popitem(last=False)
+        self.bytes -= self._item_size(key, value)
+        self.demote(key, value)
+
+
+class ColdStorage(SlabStorage):
+    """
+    Slabs whose pages are carved out of a file mapped in memory, so reads
+    are slices of the mapping. The file is removed as soon as it is
+    mapped, its space is given back when the process exits.
+    """
+    def __init__(self, path, max_bytes, evicted, page_size=1024 * 1024):
+        if not max_bytes:
+            raise ValueError('The cold tier needs a size')
+        super().__init__(max_bytes, page_size)
+        size = self.max_pages * page_size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+            os.unlink(path)
+        if hasattr(self.map, 'madvise'):
+            # Cold items are read one here and one there
+            self.map.madvise(mmap.MADV_RANDOM)
+        self.arena = memoryview(self.map)
+        self.evicted = evicted
+
+    def _new_page(self):
+        offset = self.pages * self.page_size
+        return self.arena[offset:offset + self.page_size]
+
+    def _evicted(self, key):
+        self.evicted(key)
+
+
+class Storage(BaseStorage):
+    """
+    Small and recently used items are kept in memory, up to max_bytes, and
+    the rest in a memory mapped file of cold_bytes at path, meant for fast
+    local disks. Only values live in the file, the index of its items stays
+    in memory, and reads of cold items are memoryviews into the mapping.
+
+    Values of large_value bytes or more are written straight to the file,
+    the least recently used items in memory are moved to it when memory is
+    full and small cold items move back to memory when read a second time.
+    Items are only dropped when the file is full too, per size class like
+    the slab storage.
+    """
+    LARGE_VALUE = 64 * 1024
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, path='pmemcached.cold',
+        cold_bytes=1024 * 1024 * 1024, large_value=LARGE_VALUE):
+        super().__init__()
+        self.hot = HotStorage(max_bytes, self._demote)
+        self.cold = ColdStorage(path, cold_bytes, self._dropped)
+        self.large_value = large_value
+        # Cold keys read once, the next read moves them to memory
+        self.read_once = set()
+
+    def _store(self, tier, key, item, cas):
+        # Tiers number the items they store with their own CAS counter,
+        # the item keeps the one it was given here instead
+        tier.cas = cas - 1
+        tier[key] = item
+
+    def _demote(self, key, value):
+        item = {'flags': value['flags'], 'expiry': None,
+            'value': as_bytes(value['value']),
+            'datatype': value.get('datatype', 0)}
+        try:
+            self._store(self.cold, key, item, value['cas'])
+        except OutOfMemory:
+            self._dropped(key)
+
+    def _dropped(self, key):
+        self.read_once.discard(key)
+        self._cancel_expiry_time(key)
+        self.evictions += 1
+
+    def _update_stats(self):
+        self.bytes = self.hot.bytes + self.cold.bytes
+
+    def _discard(self, key):
+        if key in self.hot.data:
+            self.hot._remove(key)
+        elif key in self.cold.index:
+            self.cold._remove(key)
+            self.read_once.discard(key)
+
+    def expire_key(self, key):
+        self._discard(key)
+        self._update_stats()
+
+    def __setitem__(self, key, value):
+        self._discard(key)
+        cas = self._next_cas()
+        data = value['value']
+        item = {'flags': value['flags'], 'expiry': None, 'value': data,
+            'datatype': value.get('datatype', 0)}
+        try:
+            if len(data) < self.large_value:
+                try:
+                    self._store(self.hot, key, item, cas)
+                except OutOfMemory:
+                    # Bigger than the whole memory tier
+                    self._store(self.cold, key, item, cas)
+            else:
+                self._store(self.cold, key, item, cas)
+        except OutOfMemory:
+            self._cancel_expiry_time(key)
+            raise
+        finally:
+            self._update_stats()
+        value['cas'] = cas
+        super().__setitem__(key, value)
+
+    def __getitem__(self, key):
+        if key in self.hot.data:
+            tier = self.hot
+        elif key in self.cold.index:
+            tier = self.cold
+        else:
+            raise KeyError(key)
+        item = tier[key]
+        if self._is_expired(key, item['cas']):
+            self._expire_key(key)
+            raise KeyError(key)
+
+        if tier is self.hot or len(item['value']) >= self.large_value or \
+            self.hot.max_bytes and \
+            self.hot._item_size(key, item) > self.hot.max_bytes:
+            return item
+        if key not in self.read_once:
+            self.read_once.add(key)
+            return item
+
+        self._discard(key)
+        cas = item['cas']
+        item = {'flags': item['flags'], 'expiry': None,
+            'value': item['value'].tobytes(), 'datatype': item['datatype']}
+        self._store(self.hot, key, item, cas)
+        self._update_stats()
+        return item
+
+    def _peek_live(self, key):
+        # Like a read, but cold items stay where they are
+        item = self.peek(key)
+        if item is not None and self._is_expired(key, item['cas']):
+            self._expire_key(key)
+            return None
+        return item
+
+    def __contains__(self, key):
+        return self._peek_live(key) is not None
+
+    def check_and_set(self, key, value, cas=0, exists=None):
+        """
+        Checking doesn't count as a read of cold items, which would move
+        them to memory right before being overwritten.
+        """
+        item = self._peek_live(key)
+        if item is None:
+            if exists or cas:
+                raise KeyError(key)
+        elif exists is False or cas and item['cas'] != cas:
+            raise KeyExists(key)
+        self[key] = value
+
+    def __delitem__(self, key):
+        if self._peek_live(key) is None:
+            raise KeyError(key)
+        self._discard(key)
+        self._cancel_expiry_time(key)
+        self._update_stats()
+
+    def __len__(self):
+        return len(self.hot) + len(self.cold)
+
+    def keys(self):
+        return self.cold.keys() + self.hot.keys()
+
+    def peek(self, key):
+        item = self.hot.peek(key)
+        if item is None:
+            item = self.cold.peek(key)
+        return item
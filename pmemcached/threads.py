@@ -0,0 +1,45 @@
+"""
+Threaded mode: every thread runs its own asyncio event loop accepting
+connections on the same port with SO_REUSEPORT, and they all share one
+thread safe storage. Twisted keeps the main thread for snapshots, the
+access log and shutdown.
+"""
+import threading
+from . import aio
+from .logger import log
+
+
+def serve_threads(args, storage, stats=None, compressor=None):
+    """
+    Serve args.port from args.threads event loops until the reactor stops.
+    """
+    from twisted.internet import reactor
+
+    if not storage.threadsafe:
+        raise SystemExit('--threads needs a thread safe storage, like '
+            '-s striped')
+
+    loops = []
+    threads = []
+    for index in range(args.threads):
+        loop = aio.new_event_loop('uvloop' if args.event_loop == 'uvloop'
+            else 'asyncio')
+        factory = aio.MemcachedFactory(storage, stats=stats,
+            maxRequest=args.max_request_size, maxPending=args.max_pending,
+            compressor=compressor)
+        aio.listenTCP(args.port, factory, reusePort=True, loop=loop)
+        loops.append(loop)
+        threads.append(threading.Thread(target=loop.run_forever,
+            name='pmemcached-%d' % index, daemon=True))
+
+    def stop():
+        for loop in loops:
+            loop.call_soon_threadsafe(loop.stop)
+        for thread in threads:
+            thread.join()
+
+    reactor.addSystemEventTrigger('before', 'shutdown', stop)
+    for thread in threads:
+        thread.start()
+    log.info('Listening on port %d from %d threads', args.port, args.threads)
+    reactor.run()
@@ -0,0 +1,113 @@
+"""
+Multi process mode: every worker accepts connections on the same port with
+SO_REUSEPORT and owns a shard of the keys. Requests for keys owned by
+another worker are forwarded to it over a local unix socket.
+"""
+import os
+import signal
+import socket
+import subprocess
+import sys
+import zlib
+from twisted.internet import reactor
+from twisted.internet.endpoints import UNIXClientEndpoint
+from .client import Backend
+from .logger import log
+from .server import MemcachedFactory
+
+
+def shard_for(key, count):
+    return (zlib.crc32(key) & 0xffffffff) % count
+
+
+def socket_path(directory, port, index):
+    return os.path.join(directory, 'pmemcached-%d-%d.sock' % (port, index))
+
+
+class Shards:
+    """
+    Routes keys to the backend of the worker owning them, None means the
+    key belongs to this worker.
+    """
+    def __init__(self, index, backends):
+        self.index = index
+        self.backends = backends
+
+    def route(self, key):
+        return self.backends[shard_for(key, len(self.backends))]
+
+    def others(self):
+        """
+        Return the backends of every other worker, for requests about all
+        of the keys.
+        """
+        return [backend for backend in self.backends if backend is not None]
+
+
+def listen_reuse_port(port, factory, interface=''):
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit('--workers needs SO_REUSEPORT support')
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((interface, port))
+    sock.listen(socket.SOMAXCONN)
+    sock.setblocking(False)
+    try:
+        return reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    finally:
+        # The reactor keeps its own copy of the descriptor
+        sock.close()
+
+
+def serve_worker(args, storage, stats=None, accessLog=None, compressor=None):
+    """
+    Run worker number args.worker_index, sharing the storage options.
+    """
+    index = args.worker_index
+    backends = [None if i == index else
+        Backend(UNIXClientEndpoint(reactor,
+            socket_path(args.socket_dir, args.port, i)))
+        for i in range(args.workers)]
+    shards = Shards(index, backends)
+    options = {'maxRequest': args.max_request_size,
+        'maxPending': args.max_pending, 'compressor': compressor}
+
+    path = socket_path(args.socket_dir, args.port, index)
+    if os.path.exists(path):
+        os.unlink(path)
+    if args.event_loop == 'twisted':
+        factory = MemcachedFactory(storage, shards, stats, accessLog,
+            **options)
+        reactor.listenUNIX(path, factory)
+        listen_reuse_port(args.port, factory)
+    else:
+        from . import aio
+        factory = aio.MemcachedFactory(storage, shards, stats,
+            accessLog, **options)
+        aio.listenUNIX(path, factory)
+        aio.listenTCP(args.port, factory, reusePort=True)
+    log.info('Worker %d listening on port %d', index, args.port)
+    reactor.run()
+
+
+def run_workers(args, argv):
+    """
+    Start args.workers fresh interpreters running a single worker each and
+    wait for them. They are not forked from this process because the
+    reactor it already installed can't be shared.
+    """
+    children = [subprocess.Popen([sys.executable, '-m', 'pmemcached'] +
+        argv + ['--worker-index', str(index)])
+        for index in range(args.workers)]
+
+    def stop(signum, frame):
+        for child in children:
+            if child.poll() is None:
+                child.send_signal(signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for child in children:
+        child.wait()
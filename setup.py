@@ -7,7 +7,8 @@ setup(
     author_email='santosdosreis@gmail.com',
     description='A binary protocol memcached server written with twisted.',
     url='https://github.com/jaysonsantos/python-async-memcached-server',
-    packages=['pmemcached'],
+    packages=['pmemcached', 'pmemcached.storages'],
+    python_requires='>=3.7',
     classifiers=[
         'Development Status :: 4 - Beta',
         'License :: OSI Approved :: MIT License',
@@ -17,6 +18,9 @@ setup(
         'console_scripts': ['pmemcached=pmemcached:run_server'],
     },
     install_requires=[
-        'Twisted==16.1.1'
-    ]
+        'Twisted>=18.9.0'
+    ],
+    extras_require={
+        'uvloop': ['uvloop'],
+    }
 )
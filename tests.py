@@ -1,11 +1,42 @@
+import json
+import os
+import shutil
 import struct
+import tempfile
+import threading
 from twisted.trial import unittest
 from twisted.test import proto_helpers
-from twisted.internet import task
+from twisted.internet import address, defer, reactor, task
 from pmemcached.storages.memory import Storage
 from pmemcached.storages import getStorage
 from pmemcached.storages.memory import Storage as MemoryStorage
+from pmemcached.storages.base import KeyExists, OutOfMemory
+from pmemcached.storages.slab import Storage as SlabStorage
+from pmemcached.storages.oplog import Storage as OpLogStorage
+from pmemcached.storages.striped import Storage as StripedStorage
+from pmemcached.storages.tiered import Storage as TieredStorage
 from pmemcached.server import MemcachedFactory
+from pmemcached import codec
+from pmemcached.client import MemcachedClientProtocol
+from pmemcached.workers import Shards, shard_for
+from pmemcached.proxy import Ring, ketama_points
+from pmemcached import snapshot
+from pmemcached.replication import Primary, Replica
+from pmemcached.stats import Histogram, SpaceSaving, Stats
+from pmemcached.compression import Compressor
+from pmemcached import logger
+from pmemcached import aio
+from benchmark import load, micro
+
+
+def temporaryPath(test):
+    """
+    Return a path in a directory removed after test. Unlike mktemp it is
+    absolute, so runners not changing directory leave nothing behind.
+    """
+    directory = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, directory, True)
+    return os.path.join(directory, 'temp')
 
 
 class ServerTests(unittest.TestCase):
@@ -26,8 +57,16 @@ class ServerTests(unittest.TestCase):
         'delete': {'command': 0x04, 'struct': '%ds'},
         'incr': {'command': 0x05, 'struct': 'QQL%ds'},
         'decr': {'command': 0x06, 'struct': 'QQL%ds'},
+        'incrq': {'command': 0x15, 'struct': 'QQL%ds'},
+        'decrq': {'command': 0x16, 'struct': 'QQL%ds'},
         'flush': {'command': 0x08, 'struct': 'I'},
+        'getq': {'command': 0x09, 'struct': '%ds'},
+        'noop': {'command': 0x0a},
+        'getk': {'command': 0x0c, 'struct': '%ds'},
+        'getkq': {'command': 0x0d, 'struct': '%ds'},
         'stat': {'command': 0x10},
+        'setq': {'command': 0x11, 'struct': 'LL%ds%ds'},
+        'deleteq': {'command': 0x14, 'struct': '%ds'},
         'auth_negotiation': {'command': 0x20},
         'auth_request': {'command': 0x21, 'struct': '%ds%ds'}
     }
@@ -55,6 +94,7 @@ class ServerTests(unittest.TestCase):
 
         self.clock = task.Clock()
         self.storage.callLater = self.clock.callLater
+        self.storage.seconds = self.clock.seconds
 
         self.protocol.makeConnection(self.tr)
 
@@ -62,9 +102,9 @@ class ServerTests(unittest.TestCase):
         self.protocol.transport.loseConnection()
 
     def testGetInvalidKey(self):
-        key = 'foobarbazdoesnotexist'
-        expected = '\x81\x00\x00\x15\x00\x00\x00\x01\x00\x00\x00\t\x00\x00' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Not found'
+        key = b'foobarbazdoesnotexist'
+        expected = b'\x81\x00\x00\x15\x00\x00\x00\x01\x00\x00\x00\t\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Not found'
 
         self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
             self.COMMANDS['get']['struct'] % (len(key)),
@@ -75,12 +115,12 @@ class ServerTests(unittest.TestCase):
         self.assertEqual(self.tr.value(), expected)
 
     def testGet(self):
-        key = 'foo'
-        value = 'bar'
-        expected = '\x81\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'+ \
-            '\x81\x00\x00\x00\x04\x00\x00\x00\x00\x00\x00\x07\x00\x00\x00' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00bar'
+        key = b'foo'
+        value = b'bar'
+        expected = b'\x81\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01'+ \
+            b'\x81\x00\x00\x00\x04\x00\x00\x00\x00\x00\x00\x07\x00\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00bar'
 
         flags = 0
         time = 1000
@@ -100,17 +140,17 @@ class ServerTests(unittest.TestCase):
         self.assertEqual(self.tr.value(), expected)
 
     def testGetExpiredKey(self):
-        key = 'foo'
-        value = 'bar'
-        expected = '\x81\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'+ \
-            '\x81\x00\x00\x00\x04\x00\x00\x00\x00\x00\x00\x07\x00\x00\x00' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00bar'
-        expected_not_found = '\x81\x00\x00\x03\x00\x00\x00\x01\x00\x00\x00\t' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Not found'
+        key = b'foo'
+        value = b'bar'
+        expected = b'\x81\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01'+ \
+            b'\x81\x00\x00\x00\x04\x00\x00\x00\x00\x00\x00\x07\x00\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00bar'
+        expected_not_found = b'\x81\x00\x00\x03\x00\x00\x00\x01\x00\x00\x00\t' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Not found'
 
         flags = 0
-        time = 1000
+        time = 1
 
         self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
             self.COMMANDS['set']['struct'] % (len(key), len(value)),
@@ -138,20 +178,20 @@ class ServerTests(unittest.TestCase):
 
     def testOverwritedExpireTime(self):
         """
-        This will test if storage wont create 2 callLaters for the same key. It have to
-        aways delete old one if it is not expired and create a new one.
+        This will test if storage keeps only the newest expiry time for a key
+        and if a single sweeper is scheduled no matter how many keys expire.
         """
-        key = 'foo'
-        value = 'bar'
-        expected = '\x81\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'+ \
-            '\x81\x00\x00\x00\x04\x00\x00\x00\x00\x00\x00\x07\x00\x00\x00' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00bar'
-        expected_not_found = '\x81\x00\x00\x03\x00\x00\x00\x01\x00\x00\x00\t' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Not found'
+        key = b'foo'
+        value = b'bar'
+        expected = b'\x81\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01'+ \
+            b'\x81\x00\x00\x00\x04\x00\x00\x00\x00\x00\x00\x07\x00\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00bar'
+        expected_not_found = b'\x81\x00\x00\x03\x00\x00\x00\x01\x00\x00\x00\t' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Not found'
 
         flags = 0
-        time = 1000
+        time = 1
 
         self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
             self.COMMANDS['set']['struct'] % (len(key), len(value)),
@@ -168,7 +208,7 @@ class ServerTests(unittest.TestCase):
 
         self.assertEqual(self.tr.value(), expected)
 
-        time = 1500
+        time = 2
 
         self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
             self.COMMANDS['set']['struct'] % (len(key), len(value)),
@@ -185,20 +225,22 @@ class ServerTests(unittest.TestCase):
             self.MAGIC['request'],
             self.COMMANDS['get']['command'],
             len(key), 0, 0, 0, len(key), 0, 0, key))
-        self.assertEqual(self.tr.value(), '\x81\x00\x00\x00\x04\x00\x00\x00\x00' + \
-            '\x00\x00\x07\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01\x00' + \
-            '\x00\x00\x00bar')
+        self.assertEqual(self.tr.value(), b'\x81\x00\x00\x00\x04\x00\x00\x00\x00' + \
+            b'\x00\x00\x07\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x02\x00' + \
+            b'\x00\x00\x00bar')
 
-        # Can't have more than one because the backend should overwrite the first
-        # one
+        self.assertEqual(self.storage.expires, {key: 2})
         self.assertEqual(len(self.clock.calls), 1)
-        self.assertEqual(self.clock.calls[0].getTime(), 1.5)
+
+        self.clock.advance(1)
+        self.assertEqual(self.storage.data, {})
+        self.assertEqual(self.clock.calls, [])
 
     def testSet(self):
-        key = 'foo'
-        value = 'bar'
-        expected = '\x81\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+        key = b'foo'
+        value = b'bar'
+        expected = b'\x81\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01'
 
         flags = 0
         time = 1000
@@ -212,12 +254,12 @@ class ServerTests(unittest.TestCase):
         self.assertEqual(self.tr.value(), expected)
 
     def testAdd(self):
-        key = 'foo'
-        value = 'bar'
-        expected_add_success = '\x81\x02\x00\x00\x00\x00\x00\x00\x00\x00' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-        expected_add_fail ='\x81\x02\x00\x00\x00\x00\x00\x02\x00\x00\x00\x14' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Data exists for key.'
+        key = b'foo'
+        value = b'bar'
+        expected_add_success = b'\x81\x02\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01'
+        expected_add_fail =b'\x81\x02\x00\x00\x00\x00\x00\x02\x00\x00\x00\x14' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Data exists for key.'
 
         flags = 0
         time = 1000
@@ -242,12 +284,12 @@ class ServerTests(unittest.TestCase):
         self.assertEqual(self.tr.value(), expected_add_fail)
 
     def testReplace(self):
-        key = 'foo'
-        value = 'bar'
-        expected_replace = '\x81\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-        expected_get = '\x81\x00\x00\x00\x04\x00\x00\x00\x00\x00\x00\x07' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00baz'
+        key = b'foo'
+        value = b'bar'
+        expected_replace = b'\x81\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x02'
+        expected_get = b'\x81\x00\x00\x00\x04\x00\x00\x00\x00\x00\x00\x07' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x02\x00\x00\x00\x00baz'
 
         flags = 0
         time = 1000
@@ -259,7 +301,7 @@ class ServerTests(unittest.TestCase):
             8, 0, 0, len(key) + len(value) + 8, 0, 0, flags, time, key, value))
         self.tr.clear()
 
-        value = 'baz'
+        value = b'baz'
         self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
             self.COMMANDS['replace']['struct'] % (len(key), len(value)),
             self.MAGIC['request'],
@@ -278,10 +320,10 @@ class ServerTests(unittest.TestCase):
         self.assertEqual(self.tr.value(), expected_get)
 
     def testReplaceInvalidKey(self):
-        key = 'foo'
-        value = 'bar'
-        expected = '\x81\x03\x00\x00\x00\x00\x00\x01\x00\x00\x00\t\x00\x00' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Not found'
+        key = b'foo'
+        value = b'bar'
+        expected = b'\x81\x03\x00\x00\x00\x00\x00\x01\x00\x00\x00\t\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Not found'
 
         flags = 0
         time = 1000
@@ -296,17 +338,17 @@ class ServerTests(unittest.TestCase):
         self.assertEqual(self.tr.value(), expected)
 
     def testDelete(self):
-        key = 'foo'
-        value = 'bar'
-        expected_set = '\x81\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-        expected_delete = '\x81\x04\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
-        expected_delete_fail = '\x81\x04\x00\x00\x00\x00\x00\x01\x00\x00\x00\t' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Not found'
-        expected_get_should_not_exists = '\x81\x00\x00\x03\x00\x00\x00\x01' + \
-            '\x00\x00\x00\t\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
-            'Not found'
+        key = b'foo'
+        value = b'bar'
+        expected_set = b'\x81\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01'
+        expected_delete = b'\x81\x04\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+        expected_delete_fail = b'\x81\x04\x00\x00\x00\x00\x00\x01\x00\x00\x00\t' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Not found'
+        expected_get_should_not_exists = b'\x81\x00\x00\x03\x00\x00\x00\x01' + \
+            b'\x00\x00\x00\t\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'Not found'
 
         flags = 0
         time = 1000
@@ -347,9 +389,9 @@ class ServerTests(unittest.TestCase):
         self.assertEqual(self.tr.value(), expected_get_should_not_exists)
 
     def testUnknownCommand(self):
-        key = 'foo'
-        expected = '\x81\x91\x00\x00\x00\x00\x00\x81\x00\x00\x00\x0F\x00' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Unknown command'
+        key = b'foo'
+        expected = b'\x81\x91\x00\x00\x00\x00\x00\x81\x00\x00\x00\x0F\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Unknown command'
 
         self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
             self.COMMANDS['get']['struct'] % (len(key)),
@@ -360,34 +402,849 @@ class ServerTests(unittest.TestCase):
         self.assertEqual(self.tr.value(), expected)
 
     def testInvalidHeader(self):
-        self.protocol.dataReceived('foobar')
+        self.protocol.dataReceived(b'foobar')
 
-        self.assertEqual(self.tr.value(), '')
+        self.assertEqual(self.tr.value(), b'')
 
 
     def testInvalidMagicCode(self):
         self.protocol.dataReceived(
-            '\x82\x91\x00\x00\x00\x00\x00\x81\x00\x00\x00\x0F\x00\x00' + \
-            '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')
-        self.assertEqual(self.tr.value(), '')
+            b'\x82\x91\x00\x00\x00\x00\x00\x81\x00\x00\x00\x0F\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+        self.assertEqual(self.tr.value(), b'')
+        self.assertTrue(self.tr.disconnecting)
+
+    def testPipelinedRequests(self):
+        key = b'foo'
+        value = b'bar'
+        expected = b'\x81\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01'+ \
+            b'\x81\x00\x00\x00\x04\x00\x00\x00\x00\x00\x00\x07\x00\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00bar'
 
-    def testIncrement(self):
-        key = 'foo'
-        value = 1
+        flags = 0
+        time = 1000
+        self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
+            self.COMMANDS['set']['struct'] % (len(key), len(value)),
+            self.MAGIC['request'],
+            self.COMMANDS['set']['command'],
+            len(key),
+            8, 0, 0, len(key) + len(value) + 8, 0, 0, flags, time, key, value) + \
+            struct.pack(self.HEADER_STRUCT + \
+            self.COMMANDS['get']['struct'] % (len(key)),
+            self.MAGIC['request'],
+            self.COMMANDS['get']['command'],
+            len(key), 0, 0, 0, len(key), 0, 0, key))
+
+        self.assertEqual(self.tr.value(), expected)
+
+    def testPipelinedRequestsAreBatched(self):
+        batches = []
+        for name in ('get_many', 'set_many', 'delete_many'):
+            method = getattr(self.storage, name)
+            self.patch(self.storage, name, lambda arg, method=method,
+                name=name: batches.append((name, len(arg))) or method(arg))
+        # The first request goes alone, until response sizes are known
+        self.protocol.dataReceived(codec.encodeRequestHeader(0x0a, 0, 0, 0,
+            0, 0, 0) + codec.encodeRequestHeader(0x09, 3, 0, 0, 3, 0, 0) +
+            b'foo')
+
+        requests = []
+        for i, key in enumerate((b'foo', b'bar', b'baz')):
+            requests.append(codec.encodeRequestHeader(0x11, 3, 8, 0, 14, i,
+                0) + codec.STORE_EXTRAS.pack(i, 0) + key + b'abc')
+        for i, key in enumerate((b'foo', b'qux', b'bar')):
+            requests.append(codec.encodeRequestHeader(0x0d, 3, 0, 0, 3, i,
+                0) + key)
+        requests.append(codec.encodeRequestHeader(0x14, 3, 0, 0, 3, 0, 0) +
+            b'foo')
+        requests.append(codec.encodeRequestHeader(0x0c, 3, 0, 0, 3, 9, 0) +
+            b'foo')
+        self.tr.clear()
+        self.protocol.dataReceived(b''.join(requests))
+
+        self.assertEqual(batches, [('get_many', 1), ('set_many', 3),
+            ('get_many', 3), ('delete_many', 1), ('get_many', 1)])
+        response = self.tr.value()
+        # Hits of foo and bar, then the miss of the last get
+        self.assertEqual(response[codec.HEADER_SIZE + 4:
+            codec.HEADER_SIZE + 10], b'fooabc')
+        self.assertEqual(struct.unpack_from('!L', response, 12)[0], 0)
+        second = codec.HEADER_SIZE + 10
+        self.assertEqual(struct.unpack_from('!L', response, second + 12)[0],
+            2)
+        last = response[2 * second:]
+        self.assertEqual(last[6:8], b'\x00\x01')
+        self.assertEqual(struct.unpack_from('!L', last, 12)[0], 9)
+
+    def testFragmentedRequest(self):
+        key = b'foo'
+        value = b'x' * 4096
+        expected = b'\x81\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01'
+
+        flags = 0
+        time = 1000
+        data = struct.pack(self.HEADER_STRUCT + \
+            self.COMMANDS['set']['struct'] % (len(key), len(value)),
+            self.MAGIC['request'],
+            self.COMMANDS['set']['command'],
+            len(key),
+            8, 0, 0, len(key) + len(value) + 8, 0, 0, flags, time, key, value)
+
+        # Chunks smaller than the header split it as well as the body
+        for start in range(0, len(data), 10):
+            self.assertEqual(self.tr.value(), b'')
+            self.protocol.dataReceived(data[start:start + 10])
+        self.assertEqual(self.tr.value(), expected)
+        self.assertEqual(self.storage[key]['value'], value)
+
+    def testMultiGetQuiet(self):
+        key = b'foo'
+        value = b'bar'
+        missing = b'baz'
+        expected = b'\x81\x0d\x00\x03\x04\x00\x00\x00\x00\x00\x00\x0a' + \
+            b'\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00\x01' + \
+            b'\x00\x00\x00\x00foobar' + \
+            b'\x81\x0a\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'\x00\x00\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00'
+
+        flags = 0
+        time = 1000
+        self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
+            self.COMMANDS['setq']['struct'] % (len(key), len(value)),
+            self.MAGIC['request'],
+            self.COMMANDS['setq']['command'],
+            len(key),
+            8, 0, 0, len(key) + len(value) + 8, 0, 0, flags, time, key, value))
+        self.assertEqual(self.tr.value(), b'')
+
+        writes = []
+        self.tr.writeSequence = writes.append
+        self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
+            self.COMMANDS['getkq']['struct'] % (len(key)),
+            self.MAGIC['request'],
+            self.COMMANDS['getkq']['command'],
+            len(key), 0, 0, 0, len(key), 1, 0, key) + \
+            struct.pack(self.HEADER_STRUCT + \
+            self.COMMANDS['getkq']['struct'] % (len(missing)),
+            self.MAGIC['request'],
+            self.COMMANDS['getkq']['command'],
+            len(missing), 0, 0, 0, len(missing), 2, 0, missing) + \
+            struct.pack(self.HEADER_STRUCT,
+            self.MAGIC['request'],
+            self.COMMANDS['noop']['command'],
+            0, 0, 0, 0, 0, 3, 0))
+
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(b''.join(writes[0]), expected)
 
-        raise unittest.SkipTest("Skipping increment for now")
+    def testValuesAreNotCopied(self):
+        key = b'foo'
+        value = b'x' * 100000
+        self.storage[key] = {'flags': 5, 'expiry': 0, 'value': value}
 
+        writes = []
+        self.tr.writeSequence = writes.append
+        self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
+            self.COMMANDS['get']['struct'] % len(key),
+            self.MAGIC['request'],
+            self.COMMANDS['get']['command'],
+            len(key), 0, 0, 0, len(key), 0, 0, key))
+
+        header, body = writes[0]
+        self.assertIs(body, value)
+        self.assertEqual(header, struct.pack(self.HEADER_STRUCT + 'L',
+            self.MAGIC['response'], self.COMMANDS['get']['command'], 0, 4, 0,
+            0, len(value) + 4, 0, 1, 5))
+
+    def testStaticRepliesKeepOpaque(self):
+        key = b'foo'
+        self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
+            self.COMMANDS['delete']['struct'] % len(key),
+            self.MAGIC['request'],
+            self.COMMANDS['delete']['command'],
+            len(key), 0, 0, 0, len(key), 0xdeadbeef, 0, key))
+
+        self.assertEqual(self.tr.value(), b'\x81\x04\x00\x00\x00\x00\x00\x01' + \
+            b'\x00\x00\x00\t\xde\xad\xbe\xef\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'Not found')
+
+    def testGetKeyNotFound(self):
+        key = b'foo'
+        expected = b'\x81\x0c\x00\x03\x00\x00\x00\x01\x00\x00\x00\x0c' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00fooNot found'
+
+        self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
+            self.COMMANDS['getk']['struct'] % (len(key)),
+            self.MAGIC['request'],
+            self.COMMANDS['getk']['command'],
+            len(key), 0, 0, 0, len(key), 0, 0, key) + \
+            struct.pack(self.HEADER_STRUCT + \
+            self.COMMANDS['getq']['struct'] % (len(key)),
+            self.MAGIC['request'],
+            self.COMMANDS['getq']['command'],
+            len(key), 0, 0, 0, len(key), 0, 0, key))
+
+        self.assertEqual(self.tr.value(), expected)
+
+    def testDeleteQuiet(self):
+        key = b'foo'
+        expected = b'\x81\x14\x00\x00\x00\x00\x00\x01\x00\x00\x00\t' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Not found'
+        self.storage[key] = {'flags': 0, 'expiry': 0, 'value': b'bar'}
+
+        for i in range(2):
+            self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
+                self.COMMANDS['deleteq']['struct'] % len(key),
+                self.MAGIC['request'],
+                self.COMMANDS['deleteq']['command'],
+                len(key), 0, 0, 0, len(key), 0, 0, key))
+            if not i:
+                self.assertEqual(self.tr.value(), b'')
+
+        self.assertEqual(self.tr.value(), expected)
+
+    def testSetOutOfMemory(self):
+        key = b'foo'
+        value = b'x' * 100
+        expected = b'\x81\x01\x00\x00\x00\x00\x00\x82\x00\x00\x00\x0d' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00Out of memory'
+        self.storage.max_bytes = 100
+
+        flags = 0
+        time = 1000
+        self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
+            self.COMMANDS['set']['struct'] % (len(key), len(value)),
+            self.MAGIC['request'],
+            self.COMMANDS['set']['command'],
+            len(key),
+            8, 0, 0, len(key) + len(value) + 8, 0, 0, flags, time, key, value))
+
+        self.assertEqual(self.tr.value(), expected)
+        self.assertFalse(key in self.storage)
+
+    def sendStat(self, group=b''):
+        self.tr.clear()
+        self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
+            '%ds' % len(group),
+            self.MAGIC['request'],
+            self.COMMANDS['stat']['command'],
+            len(group), 0, 0, 0, len(group), 7, 0, group))
+
+        stats = []
+        data = self.tr.value()
+        while data:
+            header = struct.unpack(self.HEADER_STRUCT, data[:self.HEADER_SIZE])
+            magic, command, keyLength, _, _, status, bodyLength, opaque, _ = \
+                header
+            self.assertEqual((magic, command, opaque), (0x81, 0x10, 7))
+            body = data[self.HEADER_SIZE:self.HEADER_SIZE + bodyLength]
+            data = data[self.HEADER_SIZE + bodyLength:]
+            if status:
+                return status
+            stats.append((body[:keyLength], body[keyLength:]))
+        self.assertEqual(stats[-1], (b'', b''))
+        return dict(stats[:-1])
+
+    def testStat(self):
+        self.storage[b'foo'] = {'flags': 0, 'expiry': 0, 'value': b'bar'}
+        for key in (b'foo', b'baz'):
+            self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
+                self.COMMANDS['getq']['struct'] % len(key),
+                self.MAGIC['request'],
+                self.COMMANDS['getq']['command'],
+                len(key), 0, 0, 0, len(key), 0, 0, key))
+
+        stats = self.sendStat()
+        self.assertEqual(stats[b'curr_connections'], b'1')
+        self.assertEqual(stats[b'curr_items'], b'1')
+        self.assertEqual(stats[b'bytes'],
+            str(self.storage.bytes).encode('ascii'))
+        self.assertEqual(stats[b'get_hits'], b'1')
+        self.assertEqual(stats[b'get_misses'], b'1')
+        self.assertEqual(stats[b'cmd_getq'], b'2')
+        self.assertEqual(stats[b'cmd_stat'], b'1')
+        self.assertEqual(stats[b'bytes_read'], str(2 * 27 + 24).encode())
+
+    def testStatGroups(self):
+        self.protocol.stats.settings['storage'] = 'memory'
+        self.assertEqual(self.sendStat(b'settings'), {b'storage': b'memory'})
+
+        self.protocol.stats.until_sample = 0
+        self.sendStat()
+        stats = self.sendStat(b'latency')
+        self.assertEqual(stats[b'stat:count'], b'1')
+        self.assertIn(b'stat:p99_us', stats)
+
+        self.assertEqual(self.sendStat(b'nope'), 0x01)
+
+    def testStatCountsBytesWritten(self):
+        self.protocol.stats.settings['storage'] = 'memory'
+        written = self.protocol.stats.bytes_written
+        self.sendStat(b'settings')
+        self.assertEqual(self.protocol.stats.bytes_written - written,
+            len(self.tr.value()))
+
+    def testHotKeys(self):
+        self.protocol.stats = Stats(hot_keys=2, key_sample_every=1)
+        self.storage[b'foo'] = {'flags': 0, 'expiry': 0, 'value': b'x' * 10}
+        self.storage[b'bar'] = {'flags': 0, 'expiry': 0, 'value': b'x'}
+        for key in [b'foo'] * 2 + [b'bar'] * 3 + [b'baz']:
+            self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
+                self.COMMANDS['getq']['struct'] % len(key),
+                self.MAGIC['request'],
+                self.COMMANDS['getq']['command'],
+                len(key), 0, 0, 0, len(key), 0, 0, key))
+
+        self.assertEqual(self.sendStat(b'hotkeys'), {
+            b'requests:1:bar': b'3',
+            b'requests:2:foo': b'2',
+            b'bytes:1:foo': b'20',
+            b'bytes:2:bar': b'3',
+        })
+
+    def sendCounter(self, command, key, delta, initial=0, expiry=0, cas=0):
+        self.tr.clear()
         self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
             self.COMMANDS['incr']['struct'] % len(key),
             self.MAGIC['request'],
-            self.COMMANDS['incr']['command'],
+            self.COMMANDS[command]['command'],
             len(key),
-            20, 0, 0, len(key) + 20, 0, 0, value, 0, 1000, key))
+            20, 0, 0, len(key) + 20, 0, cas, delta, initial, expiry, key))
+        return self.tr.value()
+
+    def counterResponse(self, command, value, cas):
+        return struct.pack(self.HEADER_STRUCT + 'Q', self.MAGIC['response'],
+            self.COMMANDS[command]['command'], 0, 0, 0, 0, 8, 0, cas, value)
+
+    def testIncrement(self):
+        key = b'foo'
 
-        self.assertEqual(1, self.tr.value())
+        self.assertEqual(self.sendCounter('incr', key, 1, 5),
+            self.counterResponse('incr', 5, 1))
+        self.assertEqual(self.sendCounter('incr', key, 3, 5),
+            self.counterResponse('incr', 8, 2))
+        self.assertEqual(self.storage[key]['value'], 8)
+
+        self.tr.clear()
+        self.protocol.dataReceived(struct.pack(self.HEADER_STRUCT + \
+            self.COMMANDS['get']['struct'] % len(key),
+            self.MAGIC['request'],
+            self.COMMANDS['get']['command'],
+            len(key), 0, 0, 0, len(key), 0, 0, key))
+        self.assertEqual(self.tr.value(), b'\x81\x00\x00\x00\x04\x00\x00' + \
+            b'\x00\x00\x00\x00\x05\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'\x00\x00\x02\x00\x00\x00\x008')
+
+        self.assertEqual(self.sendCounter('incr', key, 2 ** 64 - 8),
+            self.counterResponse('incr', 0, 3))
+
+    def testIncrementStoredValue(self):
+        self.storage[b'foo'] = {'flags': 4, 'expiry': 10, 'value': b'41'}
+
+        self.assertEqual(self.sendCounter('incr', b'foo', 1),
+            self.counterResponse('incr', 42, 2))
+        self.assertEqual(self.storage[b'foo']['flags'], 4)
+        self.assertEqual(self.storage.expires, {b'foo': 10})
+
+        self.storage[b'bar'] = {'flags': 0, 'expiry': 0, 'value': b'bar'}
+        self.assertEqual(self.sendCounter('incr', b'bar', 1),
+            b'\x81\x05\x00\x00\x00\x00\x00\x06\x00\x00\x00\x2e' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'Non-numeric server-side value for incr or decr')
 
     def testDecrement(self):
-        raise unittest.SkipTest('stub')
+        key = b'foo'
+        expected_not_found = b'\x81\x06\x00\x00\x00\x00\x00\x01\x00\x00' + \
+            b'\x00\t\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'Not found'
+
+        self.assertEqual(self.sendCounter('decr', key, 1, expiry=0xffffffff),
+            expected_not_found)
+        self.assertFalse(key in self.storage)
+
+        self.storage[key] = {'flags': 0, 'expiry': 0, 'value': b'10'}
+        self.assertEqual(self.sendCounter('decr', key, 4),
+            self.counterResponse('decr', 6, 2))
+        self.assertEqual(self.sendCounter('decr', key, 100),
+            self.counterResponse('decr', 0, 3))
+
+    def testCounterQuiet(self):
+        self.assertEqual(self.sendCounter('incrq', b'foo', 1, 1), b'')
+        self.assertEqual(self.sendCounter('decrq', b'foo', 1), b'')
+        self.assertEqual(self.storage[b'foo']['value'], 0)
+
+    def testInvalidExtras(self):
+        for command, extras in ((0x02, b'\x00\x00'), (0x05, b'')):
+            self.tr.clear()
+            self.protocol.dataReceived(codec.encodeRequestHeader(command, 3,
+                len(extras), 0, len(extras) + 3, 0, 0) + extras + b'foo')
+            self.assertEqual(struct.unpack_from('!H', self.tr.value(), 6)[0],
+                0x04)
+        self.assertFalse(b'foo' in self.storage)
+
+    def testInvalidExtrasInBatch(self):
+        self.protocol.dataReceived(codec.encodeRequestHeader(0x0a, 0, 0, 0,
+            0, 0, 0))
+        self.tr.clear()
+        requests = []
+        for opaque, (key, extras) in enumerate(((b'foo', b'\x00' * 8),
+            (b'bar', b'\x00\x00'), (b'baz', b'\x00' * 8))):
+            requests.append(codec.encodeRequestHeader(0x01, 3, len(extras),
+                0, len(extras) + 6, opaque, 0) + extras + key + b'abc')
+        self.protocol.dataReceived(b''.join(requests))
+
+        response = self.tr.value()
+        statuses = []
+        while response:
+            statuses.append((struct.unpack_from('!H', response, 6)[0],
+                struct.unpack_from('!L', response, 12)[0]))
+            response = response[codec.HEADER_SIZE +
+                struct.unpack_from('!L', response, 8)[0]:]
+        self.assertEqual(statuses, [(0, 0), (0x04, 1), (0, 2)])
+        self.assertTrue(b'foo' in self.storage)
+        self.assertFalse(b'bar' in self.storage)
+        self.assertTrue(b'baz' in self.storage)
+
+    def testCas(self):
+        key = b'foo'
+        value = b'bar'
+        self.storage[key] = {'flags': 0, 'expiry': 0, 'value': value}
+
+        def send(command, cas):
+            self.tr.clear()
+            if command == 'delete':
+                data = struct.pack(self.HEADER_STRUCT + \
+                    self.COMMANDS['delete']['struct'] % len(key),
+                    self.MAGIC['request'], self.COMMANDS['delete']['command'],
+                    len(key), 0, 0, 0, len(key), 0, cas, key)
+            else:
+                data = struct.pack(self.HEADER_STRUCT + \
+                    self.COMMANDS[command]['struct'] % (len(key), len(value)),
+                    self.MAGIC['request'], self.COMMANDS[command]['command'],
+                    len(key), 8, 0, 0, len(key) + len(value) + 8, 0, cas, 0,
+                    0, key, value)
+            self.protocol.dataReceived(data)
+            header = struct.unpack(self.HEADER_STRUCT,
+                self.tr.value()[:self.HEADER_SIZE])
+            # Status and CAS
+            return header[5], header[8]
+
+        self.assertEqual(send('set', 2), (self.STATUS['key_exists'], 0))
+        self.assertEqual(send('set', 1), (self.STATUS['success'], 2))
+        self.assertEqual(send('replace', 2), (self.STATUS['success'], 3))
+        self.assertEqual(send('delete', 2), (self.STATUS['key_exists'], 0))
+        self.assertEqual(self.sendCounter('incr', key, 1, cas=2)[7:8],
+            b'\x02')
+        self.assertEqual(send('delete', 3), (self.STATUS['success'], 0))
+        self.assertEqual(send('set', 3), (self.STATUS['key_not_found'], 0))
+        self.assertFalse(key in self.storage)
+
+
+class PausingTransport(proto_helpers.StringTransport):
+    """
+    Pauses its producer once more than bufferSize bytes were written, like
+    Twisted's socket transports.
+    """
+    bufferSize = 64 * 1024
+
+    def write(self, data):
+        proto_helpers.StringTransport.write(self, data)
+        if self.producer is not None and len(self.value()) > self.bufferSize:
+            self.producer.pauseProducing()
+
+    def writeSequence(self, data):
+        self.write(b''.join(data))
+
+
+class FlowControlTests(unittest.TestCase):
+    def setUp(self):
+        self.storage = MemoryStorage()
+        self.storage[b'foo'] = {'flags': 0, 'expiry': 0, 'value': b'x' * 60}
+        factory = MemcachedFactory(self.storage, maxRequest=100,
+            maxPending=100)
+        self.protocol = factory.buildProtocol(None)
+        self.tr = PausingTransport()
+        self.protocol.makeConnection(self.tr)
+
+    def get(self, opaque):
+        return codec.encodeRequestHeader(0x00, 3, 0, 0, 3, opaque, 0) + \
+            b'foo'
+
+    def opaques(self, data):
+        opaques = []
+        while data:
+            opaques.append(struct.unpack_from('!L', data, 12)[0])
+            data = data[codec.HEADER_SIZE +
+                struct.unpack_from('!L', data, 8)[0]:]
+        return opaques
+
+    def testLimitsAreSet(self):
+        self.assertEqual(self.tr.bufferSize, 100)
+        self.assertTrue(self.tr.producer is self.protocol)
+        self.assertTrue(self.tr.streaming)
+
+    def testPausesUntilResponsesAreWritten(self):
+        self.protocol.dataReceived(b''.join(self.get(i) for i in range(5)))
+        # Paused as soon as the responses went over the limit
+        self.assertEqual(self.opaques(self.tr.value()), [0, 1])
+        self.assertEqual(self.tr.producerState, 'paused')
+        self.assertEqual(self.protocol.stats.pauses, 1)
+
+        received = self.opaques(self.tr.value())
+        while self.protocol.paused:
+            self.tr.clear()
+            self.protocol.resumeProducing()
+            received.extend(self.opaques(self.tr.value()))
+        self.assertEqual(received, [0, 1, 2, 3, 4])
+        self.assertEqual(self.tr.producerState, 'producing')
+
+    def testRejectsTooLargeRequests(self):
+        value = b'x' * 200
+        data = codec.encodeRequestHeader(0x01, 3, 8, 0, 211, 1, 0) + \
+            codec.STORE_EXTRAS.pack(0, 0) + b'bar' + value + self.get(2)
+        # The body is skipped as it comes
+        for start in range(0, len(data), 50):
+            self.protocol.dataReceived(data[start:start + 50])
+
+        response = self.tr.value()
+        self.assertEqual(self.opaques(response), [1, 2])
+        self.assertEqual(struct.unpack_from('!H', response, 6)[0], 0x03)
+        self.assertFalse(b'bar' in self.storage)
+        self.assertEqual(self.protocol._chunks, [])
+
+    def testAsyncioFlowControl(self):
+        tr = FakeAsyncioTransport()
+        protocol = aio.MemcachedFactory(self.storage, maxPending=100)()
+        protocol.connection_made(tr)
+        self.assertEqual(tr.high, 100)
+
+        def writelines(data):
+            tr.written.extend(bytes(chunk) for chunk in data)
+            if len(tr.value()) > tr.high:
+                protocol.pause_writing()
+        tr.writelines = writelines
+        protocol.transport.writeSequence = writelines
+
+        data = b''.join(self.get(i) for i in range(5))
+        buffer = protocol.get_buffer(-1)
+        buffer[:len(data)] = data
+        protocol.buffer_updated(len(data))
+        self.assertEqual(self.opaques(tr.value()), [0, 1])
+        self.assertFalse(tr.reading)
+
+        received = self.opaques(tr.value())
+        while protocol.paused:
+            tr.written = []
+            protocol.resume_writing()
+            received.extend(self.opaques(tr.value()))
+        self.assertEqual(received, [0, 1, 2, 3, 4])
+        self.assertTrue(tr.reading)
+
+
+class CompressionTests(unittest.TestCase):
+    VALUE = json.dumps([{'id': i, 'name': 'item'} for i in range(100)]
+        ).encode('ascii')
+
+    def setUp(self):
+        self.storage = SlabStorage()
+        self.compressor = Compressor(threshold=256)
+        # Compressed right away, so a thread pool stays out of the tests
+        self.pool = []
+        self.compressor.callInThread = lambda *args: self.pool.append(args)
+        self.compressor.callFromThread = lambda f, *args: f(*args)
+        factory = MemcachedFactory(self.storage, compressor=self.compressor)
+        self.protocol = factory.buildProtocol(None)
+        self.tr = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.tr)
+
+    def set(self, key, value, dataType=0):
+        self.tr.clear()
+        self.protocol.dataReceived(codec.encodeRequestHeader(0x01, len(key),
+            8, dataType, 8 + len(key) + len(value), 0, 0) +
+            codec.STORE_EXTRAS.pack(0, 0) + key + value)
+        return struct.unpack_from('!Q', self.tr.value(), 16)[0]
+
+    def get(self, key, dataType=0):
+        self.tr.clear()
+        self.protocol.dataReceived(codec.encodeRequestHeader(0x00, len(key),
+            0, dataType, len(key), 0, 0) + key)
+        response = self.tr.value()
+        return response[5], response[codec.HEADER_SIZE + 4:]
+
+    def testCompressesLargeValues(self):
+        self.set(b'foo', self.VALUE)
+        self.set(b'small', b'x' * 255)
+        item = self.storage[b'foo']
+        self.assertEqual(item['datatype'], codec.DATATYPE_COMPRESSED)
+        self.assertTrue(len(item['value']) * 4 < len(self.VALUE))
+        self.assertEqual(self.storage[b'small']['datatype'], 0)
+
+        stats = self.protocol.stats
+        self.assertEqual(stats.compressed_values, 1)
+        self.assertEqual(stats.compressed_bytes_in, len(self.VALUE))
+        self.assertEqual(stats.compressed_bytes_out, len(item['value']))
+        self.assertTrue(float(dict(stats.general(self.storage, {}))[
+            'compression_ratio']) > 4)
+
+    def testDecompressesUnlessAccepted(self):
+        self.set(b'foo', self.VALUE)
+        self.assertEqual(self.get(b'foo'), (0, self.VALUE))
+        self.assertEqual(self.protocol.stats.decompressions, 1)
+
+        dataType, value = self.get(b'foo', codec.DATATYPE_COMPRESSED)
+        self.assertEqual(dataType, codec.DATATYPE_COMPRESSED)
+        self.assertEqual(value, self.compressor.codec.compress(self.VALUE))
+        self.assertEqual(self.protocol.stats.decompressions, 1)
+
+    def testCorruptedValues(self):
+        self.set(b'foo', b'not zlib', codec.DATATYPE_COMPRESSED)
+        self.assertEqual(self.get(b'foo', codec.DATATYPE_COMPRESSED),
+            (codec.DATATYPE_COMPRESSED, b'not zlib'))
+        self.tr.clear()
+        self.protocol.dataReceived(codec.encodeRequestHeader(0x00, 3, 0, 0,
+            3, 0, 0) + b'foo')
+        self.assertEqual(struct.unpack_from('!H', self.tr.value(), 6)[0],
+            0x84)
+        self.assertFalse(self.tr.disconnecting)
+
+    def testStoresCompressedValuesAsSent(self):
+        self.compressor.threshold = 0
+        self.set(b'foo', self.compressor.codec.compress(b'bar'),
+            codec.DATATYPE_COMPRESSED)
+        self.assertEqual(self.storage[b'foo']['datatype'],
+            codec.DATATYPE_COMPRESSED)
+        self.assertEqual(self.get(b'foo'), (0, b'bar'))
+
+    def testLargeValuesAreCompressedInThePool(self):
+        value = self.VALUE * 100
+        cas = self.set(b'foo', value)
+        # Stored as it is until the pool is done
+        self.assertEqual(self.storage[b'foo']['datatype'], 0)
+        self.assertEqual(len(self.pool), 1)
+
+        function, args = self.pool[0][0], self.pool[0][1:]
+        function(*args)
+        item = self.storage[b'foo']
+        self.assertEqual(item['datatype'], codec.DATATYPE_COMPRESSED)
+        self.assertEqual(item['cas'], cas)
+        self.assertEqual(self.get(b'foo'), (0, value))
+        # CAS values handed out later are still new
+        self.assertTrue(self.set(b'bar', b'bar') > cas)
+
+    def testOverwrittenValuesAreNotSwapped(self):
+        self.set(b'foo', self.VALUE * 100)
+        self.set(b'foo', b'new')
+        function, args = self.pool[0][0], self.pool[0][1:]
+        function(*args)
+        self.assertEqual(self.get(b'foo'), (0, b'new'))
+        self.assertEqual(self.protocol.stats.compressed_values, 0)
+
+    def testDataTypeIsPersisted(self):
+        self.set(b'foo', self.VALUE)
+        path = temporaryPath(self)
+        with open(path, 'wb') as output:
+            for step in snapshot.write_items(self.storage, output):
+                pass
+
+        storage = MemoryStorage()
+        self.assertEqual(snapshot.load(storage, path), 1)
+        self.assertEqual(storage[b'foo']['datatype'],
+            codec.DATATYPE_COMPRESSED)
+
+        path = temporaryPath(self)
+        storage = OpLogStorage(path, fsync='never')
+        storage[b'foo'] = {'flags': 0, 'expiry': 0, 'value': b'x',
+            'datatype': codec.DATATYPE_COMPRESSED}
+        storage.close()
+        storage = OpLogStorage(path, fsync='never')
+        self.assertEqual(storage[b'foo']['datatype'],
+            codec.DATATYPE_COMPRESSED)
+        storage.close()
+
+
+class SpaceSavingTests(unittest.TestCase):
+    def testHeavyHittersAreKept(self):
+        tracker = SpaceSaving(10)
+        for i in range(10000):
+            tracker.add(b'hot')
+            if not i % 3:
+                tracker.add(b'warm', 2)
+            tracker.add(str(i).encode())
+
+        self.assertEqual([key for key, count in tracker.top(2)],
+            [b'hot', b'warm'])
+        self.assertTrue(tracker.top(1)[0][1] >= 10000)
+        self.assertEqual(len(tracker.counts), 10)
+        self.assertTrue(len(tracker.heap) <= 40)
+
+
+class HistogramTests(unittest.TestCase):
+    def testPercentiles(self):
+        histogram = Histogram()
+        for value in range(1, 1001):
+            histogram.record(value)
+
+        self.assertEqual(histogram.count, 1000)
+        self.assertEqual(histogram.max, 1000)
+        for percent, value in ((50, 500), (90, 900), (99, 990)):
+            found = histogram.percentile(percent)
+            self.assertTrue(value <= found <= value * 17 // 16, found)
+        self.assertEqual(histogram.percentile(100), 1000)
+
+    def testSmallValuesAreExact(self):
+        histogram = Histogram()
+        for value in (0, 3, 31):
+            histogram.record(value)
+        self.assertEqual([histogram.percentile(p) for p in (33, 66, 100)],
+            [0, 3, 31])
+
+
+class LoggerTests(unittest.TestCase):
+    def setUp(self):
+        self.messages = []
+        self.patch(logger.twistedLog, 'msg',
+            lambda message, logLevel: self.messages.append(message))
+
+    def testDisabledLevelsFormatNothing(self):
+        class Unprintable:
+            def __str__(self):
+                raise AssertionError('Formatted')
+
+        log = logger.Logger(logger.WARNING)
+        log.debug('%s', Unprintable())
+        log.info('%s', Unprintable())
+        log.warning('%s %d', 'bar', 1)
+        self.assertFalse(log.debugging)
+        self.assertEqual(self.messages, ['bar 1'])
+
+    def testDebugSampling(self):
+        log = logger.Logger(logger.DEBUG, debug_sample=3)
+        for i in range(7):
+            log.debug('%d', i)
+        self.assertEqual(self.messages, ['0', '3', '6'])
+
+
+class AccessLogTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.accessLog = logger.AccessLog(temporaryPath(self))
+        self.accessLog.callLater = self.clock.callLater
+        self.accessLog.loop.clock = self.clock
+        self.addCleanup(self.accessLog.close)
+
+    def lines(self):
+        with open(self.accessLog.path) as f:
+            return [json.loads(line) for line in f]
+
+    def testBuffered(self):
+        self.accessLog.start()
+        protocol = MemcachedFactory(Storage(),
+            accessLog=self.accessLog).buildProtocol(('127.0.0.1', 0))
+        protocol.makeConnection(proto_helpers.StringTransport())
+        protocol.dataReceived(struct.pack('!BBHBBHLLQ3s', 0x80, 0x00, 3, 0,
+            0, 0, 3, 0, 0, b'foo'))
+
+        self.assertEqual(self.lines(), [])
+        self.clock.advance(self.accessLog.interval)
+        [line] = self.lines()
+        self.assertEqual(line['client'], '192.168.1.1:54321')
+        self.assertEqual((line['command'], line['key'], line['length']),
+            ('get', 'foo', 3))
+
+    def testFlushesWhenFull(self):
+        self.accessLog.MAX_BUFFERED = 2
+        self.accessLog.record('unix', 'get', b'foo', 3)
+        self.assertEqual(self.clock.calls, [])
+        self.accessLog.record('unix', 'get', b'\xff', 1)
+        self.clock.advance(0)
+        self.assertEqual([line['key'] for line in self.lines()],
+            ['foo', '\ufffd'])
+
+
+class BenchmarkTests(unittest.TestCase):
+    def testZipf(self):
+        import random
+        zipf = load.Zipf(100, 1.0, random.Random(0))
+        counts = [0] * 100
+        for i in range(10000):
+            counts[zipf.sample()] += 1
+        self.assertTrue(counts[0] > counts[1] > counts[10] > counts[99])
+
+        uniform = load.Zipf(100, 0, random.Random(0))
+        self.assertTrue(all(0 <= uniform.sample() < 100 for i in range(100)))
+
+    def testParseSizes(self):
+        self.assertEqual(load.parse_sizes('100'), (100, 100))
+        self.assertEqual(load.parse_sizes('10-1000'), (10, 1000))
+        self.assertRaises(ValueError, load.parse_sizes, '10-1')
+
+    def testWorkloadIsRepeatable(self):
+        def requests():
+            workload = load.Workload(1000, (1, 100), 0.5, 0.99, 7)
+            generator = workload.requests()
+            return [next(generator) for i in range(100)]
+        self.assertEqual(requests(), requests())
+
+    def testResults(self):
+        results = load.Results()
+        results.record(codec.encodeHeader(0x00, 0, 4, 0, 7, 0, 1), 0.001)
+        results.record(codec.encodeHeader(0x00, 0, 0, 1, 9, 0, 0), 0.002)
+        results.record(codec.encodeHeader(0x01, 0, 0, 0x82, 13, 0, 0), 0.003)
+        results.elapsed = 2.0
+
+        report = results.report()
+        self.assertEqual((report['operations'], report['hits'],
+            report['misses'], report['sets'], report['errors']),
+            (3, 1, 1, 1, 1))
+        self.assertEqual(report['throughput'], 1.5)
+        self.assertEqual(report['latency_us']['max'], 3000)
+
+
+class MicroBenchmarkTests(unittest.TestCase):
+    def testMeasure(self):
+        kept = []
+        released = []
+        result = micro.measure(lambda: (lambda: kept.append(object()),
+            lambda: released.append(True)), repeat=1, allocations=100)
+
+        self.assertEqual(released, [True])
+        self.assertTrue(result['ns_per_op'] > 0)
+        self.assertTrue(result['bytes_per_op'] > 0)
+        self.assertTrue(result['blocks_per_op'] >= 1)
+
+    def testBenchmarksRun(self):
+        for name, setup in micro.BENCHMARKS:
+            op, release = setup()
+            try:
+                op()
+            finally:
+                release()
+
+    def testProtocolBenchmarksDiscardResponses(self):
+        protocols = []
+        make_protocol = micro.make_protocol
+
+        def record():
+            protocols.append(make_protocol())
+            return protocols[-1]
+        self.patch(micro, 'make_protocol', record)
+        for setup in (micro.handle_data_get, micro.send_message_value):
+            op, release = setup()
+            for i in range(1000):
+                op()
+            release()
+
+        for protocol in protocols:
+            self.assertEqual(protocol._queued, 0)
+            self.assertEqual(protocol.transport.value(), b'')
+
+    def testCompare(self):
+        baseline = {'fast': {'ns_per_op': 100}, 'slow': {'ns_per_op': 100}}
+        results = {'fast': {'ns_per_op': 105}, 'slow': {'ns_per_op': 120},
+            'new': {'ns_per_op': 1}}
+        self.assertEqual(micro.compare(results, baseline, 0.1), ['slow'])
 
 
 class BaseTests(unittest.TestCase):
@@ -396,3 +1253,1301 @@ class BaseTests(unittest.TestCase):
 
     def testGetInvalidValidStorage(self):
         self.assertTrue(isinstance(getStorage('foo'), MemoryStorage))
+
+    def testGetStorageOptions(self):
+        storage = getStorage('slab', max_bytes=1024 * 1024)
+        self.assertTrue(isinstance(storage, SlabStorage))
+        self.assertEqual(storage.max_pages, 1)
+
+
+class MemoryStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        # Room for three items with 3 bytes keys and values
+        self.storage = MemoryStorage(max_bytes=3 * (6 + MemoryStorage.ITEM_OVERHEAD))
+        self.storage.callLater = self.clock.callLater
+        self.storage.seconds = self.clock.seconds
+
+    def set(self, key):
+        self.storage[key] = {'flags': 0, 'expiry': 3600, 'value': b'bar'}
+
+    def testEvictLeastRecentlyUsed(self):
+        for key in (b'foo', b'bar', b'baz'):
+            self.set(key)
+        self.clock.advance(MemoryStorage.BUMP_INTERVAL)
+        self.storage[b'foo']
+
+        self.set(b'qux')
+
+        self.assertEqual(list(self.storage.data), [b'baz', b'foo', b'qux'])
+        self.assertEqual(self.storage.evictions, 1)
+        self.assertEqual(self.storage.bytes, self.storage.max_bytes)
+        # Evicted items don't keep their expiral around
+        self.assertEqual(sorted(self.storage.expires), [b'baz', b'foo', b'qux'])
+
+    def testReadsWithinBumpIntervalDontReorder(self):
+        for key in (b'foo', b'bar', b'baz'):
+            self.set(key)
+        self.storage[b'foo']
+
+        self.set(b'qux')
+
+        self.assertEqual(list(self.storage.data), [b'bar', b'baz', b'qux'])
+
+    def testExpiryTimes(self):
+        self.storage.max_bytes = 0
+        self.clock.advance(1000)
+        self.storage[b'never'] = {'flags': 0, 'expiry': 0, 'value': b'bar'}
+        self.storage[b'relative'] = {'flags': 0, 'expiry': 10, 'value': b'bar'}
+        self.storage[b'absolute'] = {'flags': 0,
+            'expiry': MemoryStorage.MAX_RELATIVE_EXPIRY + 1, 'value': b'bar'}
+        self.storage[b'past'] = {'flags': 0, 'expiry': 999, 'value': b'bar'}
+
+        self.assertEqual(self.storage.expires, {b'relative': 1010,
+            b'absolute': MemoryStorage.MAX_RELATIVE_EXPIRY + 1, b'past': 1999})
+        self.clock.advance(10)
+        self.assertFalse(b'relative' in self.storage)
+        self.assertTrue(b'never' in self.storage)
+
+    def testSweeperExpiresInBatches(self):
+        self.storage.max_bytes = 0
+        self.storage.SWEEP_BATCH = 2
+        delays = []
+
+        def callLater(delay, *args):
+            delays.append(delay)
+            return self.clock.callLater(delay, *args)
+        self.storage.callLater = callLater
+
+        for key in (b'foo', b'bar', b'baz'):
+            self.storage[key] = {'flags': 0, 'expiry': 1, 'value': b'bar'}
+        self.storage[b'qux'] = {'flags': 0, 'expiry': 600, 'value': b'bar'}
+
+        self.clock.advance(1)
+        self.assertEqual(list(self.storage.data), [b'qux'])
+        # The second batch ran right after the first one
+        self.assertEqual(delays, [1, 0, 1])
+        self.assertEqual(self.storage.expirations, 3)
+
+        # Passes over the slot of qux once before it is due
+        self.clock.pump([1] * 600)
+        self.assertEqual(self.storage.data, {})
+        self.assertEqual(self.clock.calls, [])
+
+    def testCountersAreInts(self):
+        self.storage.max_bytes = 0
+        self.storage[b'foo'] = {'flags': 0, 'expiry': 0, 'value': b'1'}
+        self.assertEqual(self.storage.counter(b'foo', 1, 0, 0), (2, 2))
+        item = self.storage[b'foo']
+        self.assertEqual(self.storage.counter(b'foo', -5, 0, 0), (0, 3))
+        self.assertIs(self.storage[b'foo'], item)
+        self.assertEqual(item['value'], 0)
+        self.assertEqual(self.storage.bytes,
+            3 + MemoryStorage.COUNTER_SIZE + MemoryStorage.ITEM_OVERHEAD)
+
+    def testOverwriteAndDeleteKeepSize(self):
+        self.set(b'foo')
+        self.set(b'foo')
+        self.assertEqual(self.storage.bytes, 6 + MemoryStorage.ITEM_OVERHEAD)
+
+        del self.storage[b'foo']
+        self.assertEqual(self.storage.bytes, 0)
+        self.assertEqual(self.storage.expires, {})
+
+    def testItemBiggerThanLimit(self):
+        self.set(b'foo')
+        self.assertRaises(OutOfMemory, self.storage.__setitem__, b'bar',
+            {'flags': 0, 'expiry': 1000, 'value': b'x' * self.storage.max_bytes})
+        self.assertEqual(list(self.storage.data), [b'foo'])
+
+    def testBatchOperations(self):
+        self.assertEqual(self.storage.set_many([
+            (b'foo', {'flags': 0, 'expiry': 0, 'value': b'bar'}),
+            (b'big', {'flags': 0, 'expiry': 0, 'value': b'x' * 1024}),
+            (b'baz', {'flags': 1, 'expiry': 0, 'value': b'qux'})]),
+            [True, False, True])
+        items = self.storage.get_many([b'baz', b'big', b'foo'])
+        self.assertEqual([item and item['value'] for item in items],
+            [b'qux', None, b'bar'])
+        self.assertEqual(self.storage.delete_many([b'foo', b'foo']),
+            [True, False])
+        self.assertNotIn(b'foo', self.storage)
+
+    def testCheckAndSet(self):
+        value = {'flags': 0, 'expiry': 0, 'value': b'bar'}
+        self.assertRaises(KeyError, self.storage.check_and_set, b'foo',
+            dict(value), exists=True)
+        self.assertRaises(KeyError, self.storage.check_and_set, b'foo',
+            dict(value), cas=1)
+        self.storage.check_and_set(b'foo', dict(value), exists=False)
+        cas = self.storage[b'foo']['cas']
+
+        self.assertRaises(KeyExists, self.storage.check_and_set, b'foo',
+            dict(value), exists=False)
+        self.assertRaises(KeyExists, self.storage.check_and_set, b'foo',
+            dict(value), cas=cas + 1)
+        self.storage.check_and_set(b'foo', dict(value), cas=cas, exists=True)
+        self.assertEqual(self.storage[b'foo']['cas'], cas + 1)
+
+    def testFlush(self):
+        self.storage.max_bytes = 0
+        self.set(b'foo')
+        self.set(b't1:foo')
+        self.storage.flush()
+        self.set(b'bar')
+
+        # Nothing was walked, items go when read
+        self.assertEqual(len(self.storage), 3)
+        self.assertFalse(b'foo' in self.storage)
+        self.assertFalse(b't1:foo' in self.storage)
+        self.assertTrue(b'bar' in self.storage)
+        self.assertEqual(len(self.storage), 1)
+
+    def testDeleteFlushedItems(self):
+        for storage in (self.storage, SlabStorage()):
+            storage[b'foo'] = {'flags': 0, 'expiry': 0, 'value': b'bar'}
+            storage.flush()
+            with self.assertRaises(KeyError):
+                del storage[b'foo']
+            self.assertEqual(len(storage), 0)
+            self.assertEqual(storage.expirations, 1)
+
+    def testFlushNamespace(self):
+        self.storage.max_bytes = 0
+        for key in (b't1:foo', b't2:foo', b't1'):
+            self.set(key)
+        self.storage.flush(namespace=b't1')
+        self.set(b't1:bar')
+
+        self.assertFalse(b't1:foo' in self.storage)
+        self.assertTrue(b't2:foo' in self.storage)
+        self.assertTrue(b't1' in self.storage)
+        self.assertTrue(b't1:bar' in self.storage)
+        self.assertTrue(self.storage.is_flushed(b't1:foo', 1))
+        self.assertFalse(self.storage.is_flushed(b't2:foo', 2))
+
+    def testDelayedFlush(self):
+        self.set(b'foo')
+        self.storage.flush(10)
+        self.clock.advance(5)
+        self.set(b'bar')
+        self.assertTrue(b'foo' in self.storage)
+
+        self.clock.advance(5)
+        self.assertFalse(b'foo' in self.storage)
+        self.assertFalse(b'bar' in self.storage)
+
+        self.storage.sweep_from_ticks()
+        self.set(b'baz')
+        self.storage.flush(10)
+        self.clock.advance(10)
+        self.assertTrue(b'baz' in self.storage)
+        self.storage.tick()
+        self.assertFalse(b'baz' in self.storage)
+
+
+class StripedStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.storage = StripedStorage(max_bytes=64 * 1024, stripes=4)
+        self.clock = task.Clock()
+        self.storage.seconds = self.clock.seconds
+        for stripe in self.storage.stripes:
+            stripe.callLater = self.clock.callLater
+            stripe.seconds = self.clock.seconds
+
+    def set(self, key, value, expiry=0):
+        self.storage[key] = {'flags': 0, 'expiry': expiry, 'value': value}
+
+    def testItemsUpToTheWholeLimit(self):
+        self.set(b'foo', b'bar')
+        stripe = self.storage._stripe(b'foo')[1]
+        key = next(key for key in (str(i).encode() for i in range(100))
+            if self.storage._stripe(key)[1] is stripe)
+        # Bigger than the 16KB share of a stripe
+        self.set(key, b'x' * 32 * 1024)
+        self.assertEqual(self.storage[key]['value'], b'x' * 32 * 1024)
+        self.assertFalse(b'foo' in self.storage)
+
+        self.assertRaises(OutOfMemory, self.set, b'big', b'x' * 64 * 1024)
+
+    def testKeysAreSpreadOverStripes(self):
+        keys = [('key%d' % i).encode('ascii') for i in range(100)]
+        for key in keys:
+            self.set(key, b'bar')
+
+        self.assertEqual(len(self.storage), 100)
+        self.assertEqual(sorted(self.storage.keys()), sorted(keys))
+        self.assertTrue(all(len(stripe) for stripe in self.storage.stripes))
+        self.assertEqual(self.storage.bytes,
+            sum(stripe.bytes for stripe in self.storage.stripes))
+        # Each stripe gets its share of the memory limit
+        self.assertEqual(self.storage.stripes[0].max_bytes, 16 * 1024)
+
+        self.assertEqual(self.storage[b'key1']['value'], b'bar')
+        del self.storage[b'key1']
+        self.assertFalse(b'key1' in self.storage)
+        self.assertRaises(ValueError, StripedStorage, stripes=3)
+
+    def testConcurrentCounters(self):
+        def increment():
+            for i in range(1000):
+                self.storage.counter(b'foo', 1, 0, 0)
+        threads = [threading.Thread(target=increment) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Created by the first increment
+        self.assertEqual(self.storage[b'foo']['value'], 3999)
+
+    def testTickSweepsStripes(self):
+        self.storage.sweep_from_ticks()
+        for i in range(20):
+            self.set(('key%d' % i).encode('ascii'), b'bar', expiry=1)
+        self.assertEqual(self.clock.calls, [])
+
+        self.clock.advance(1)
+        self.storage.tick()
+        self.assertEqual(len(self.storage), 0)
+        self.assertEqual(self.storage.expirations, 20)
+
+    def testBatchOperations(self):
+        keys = [('key%d' % i).encode('ascii') for i in range(20)]
+        self.assertEqual(self.storage.set_many([(key,
+            {'flags': 0, 'expiry': 0, 'value': key}) for key in keys]),
+            [True] * 20)
+        items = self.storage.get_many(keys + [b'missing'])
+        self.assertEqual([item['value'] for item in items[:-1]], keys)
+        self.assertEqual(items[-1], None)
+        # Copies, taken while the stripe was locked
+        items[0]['value'] = b'changed'
+        self.assertEqual(self.storage[keys[0]]['value'], keys[0])
+        self.assertEqual(self.storage.delete_many(keys[::2] + [b'missing']),
+            [True] * 10 + [False])
+        self.assertEqual(len(self.storage), 10)
+
+    def testProtocolHoldsTheLockOfKeys(self):
+        held = []
+        lock = self.storage.lock(b'foo')
+        protocol = MemcachedFactory(self.storage).buildProtocol(None)
+        protocol.handlers = {0x02: lambda *args: held.append(lock._is_owned())}
+        protocol.makeConnection(proto_helpers.StringTransport())
+        protocol.dataReceived(codec.encodeRequestHeader(0x02, 3, 0, 0, 3, 0,
+            0) + b'foo')
+        self.assertEqual(held, [True])
+
+
+class TieredStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.path = temporaryPath(self)
+        self.storage = TieredStorage(max_bytes=1024, path=self.path,
+            cold_bytes=2 * 1024 * 1024, large_value=256)
+        self.clock = task.Clock()
+        self.storage.callLater = self.clock.callLater
+        self.storage.seconds = self.clock.seconds
+
+    def set(self, key, value, expiry=0):
+        item = {'flags': 3, 'expiry': expiry, 'value': value}
+        self.storage[key] = item
+        return item['cas']
+
+    def testLargeValuesAreMapped(self):
+        self.assertFalse(os.path.exists(self.path))
+        self.set(b'large', b'x' * 300)
+        self.set(b'small', b'bar')
+        self.assertTrue(b'large' in self.storage.cold.index)
+        self.assertTrue(b'small' in self.storage.hot.data)
+
+        value = self.storage[b'large']['value']
+        self.assertTrue(isinstance(value, memoryview))
+        self.assertTrue(value.obj is self.storage.cold.map)
+        self.assertEqual(value.tobytes(), b'x' * 300)
+        self.assertEqual(len(self.storage), 2)
+        self.assertEqual(self.storage.bytes,
+            self.storage.hot.bytes + self.storage.cold.bytes)
+
+    def testColdItemsMoveBetweenTiers(self):
+        cas = self.set(b'foo', b'bar')
+        for i in range(20):
+            self.set(('key%d' % i).encode('ascii'), b'x' * 50)
+        self.assertTrue(b'foo' in self.storage.cold.index)
+        self.assertEqual(self.storage.evictions, 0)
+        self.assertEqual(len(self.storage), 21)
+
+        # Served from the file first, moved back to memory when read again
+        item = self.storage[b'foo']
+        self.assertTrue(isinstance(item['value'], memoryview))
+        self.assertEqual((item['flags'], item['cas']), (3, cas))
+        item = self.storage[b'foo']
+        self.assertEqual(item['value'], b'bar')
+        self.assertEqual((item['flags'], item['cas']), (3, cas))
+        self.assertTrue(b'foo' in self.storage.hot.data)
+        self.assertFalse(b'foo' in self.storage.cold.index)
+
+    def testChecksDontMoveColdItems(self):
+        cas = self.set(b'foo', b'bar')
+        for i in range(20):
+            self.set(('key%d' % i).encode('ascii'), b'x' * 50)
+        self.assertTrue(b'foo' in self.storage.cold.index)
+
+        self.assertTrue(b'foo' in self.storage)
+        self.assertTrue(b'foo' in self.storage)
+        item = {'flags': 0, 'expiry': 0, 'value': b'new'}
+        self.assertRaises(KeyExists, self.storage.check_and_set, b'foo',
+            item, exists=False)
+        self.assertRaises(KeyExists, self.storage.check_and_set, b'foo',
+            item, cas + 1)
+        self.assertTrue(b'foo' in self.storage.cold.index)
+        self.assertFalse(b'foo' in self.storage.read_once)
+
+        self.storage.check_and_set(b'foo', item, cas, exists=True)
+        self.assertEqual(self.storage[b'foo']['value'], b'new')
+        self.assertRaises(KeyError, self.storage.check_and_set, b'nope',
+            item, exists=True)
+
+    def testBatchedGetsOfColdKeys(self):
+        self.set(b'foo', b'a' * 50)
+        for i in range(20):
+            self.set(('key%d' % i).encode('ascii'), b'x' * 50)
+        self.assertTrue(b'foo' in self.storage.cold.index)
+        protocol = MemcachedFactory(self.storage).buildProtocol(None)
+        tr = proto_helpers.StringTransport()
+        protocol.makeConnection(tr)
+        # Responses are small, the next gets are batched
+        protocol.dataReceived(codec.encodeRequestHeader(0x0c, 4, 0, 0, 4, 0,
+            0) + b'key0')
+        tr.clear()
+
+        # The second read moves foo to memory, and a hot item to the chunk
+        # foo leaves
+        get = codec.encodeRequestHeader(0x0c, 3, 0, 0, 3, 0, 0) + b'foo'
+        protocol.dataReceived(get + get)
+        response = tr.value()
+        size = codec.HEADER_SIZE + 4 + 3 + 50
+        self.assertEqual(len(response), 2 * size)
+        self.assertEqual(response[size - 50:size], b'a' * 50)
+        self.assertEqual(response[-50:], b'a' * 50)
+        self.assertTrue(b'foo' in self.storage.hot.data)
+
+    def testExpiryFollowsItems(self):
+        self.set(b'foo', b'bar', expiry=10)
+        for i in range(20):
+            self.set(('key%d' % i).encode('ascii'), b'x' * 50)
+        self.assertTrue(b'foo' in self.storage.cold.index)
+
+        self.clock.advance(10)
+        self.assertFalse(b'foo' in self.storage)
+        self.assertEqual(self.storage.expirations, 1)
+        self.assertFalse(b'foo' in self.storage.cold.index)
+
+    def testDropsWhenTheFileIsFull(self):
+        # Every value takes one of the two pages
+        for i in range(3):
+            self.set(('key%d' % i).encode('ascii'), b'x' * 1024 * 1024,
+                expiry=60)
+        self.assertEqual(len(self.storage), 2)
+        self.assertEqual(self.storage.evictions, 1)
+        self.assertEqual(sorted(self.storage.expires), [b'key1', b'key2'])
+
+    def testCounters(self):
+        self.assertEqual(self.storage.counter(b'foo', 1, 5, 0)[0], 5)
+        self.assertEqual(self.storage.counter(b'foo', 2, 0, 0)[0], 7)
+        self.assertEqual(self.storage[b'foo']['value'], b'7')
+
+
+class SlabStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        # Two pages of 1KB
+        self.storage = SlabStorage(max_bytes=2048, page_size=1024)
+        self.storage.callLater = self.clock.callLater
+        self.storage.seconds = self.clock.seconds
+
+    def set(self, key, value, expiry=0):
+        self.storage[key] = {'flags': 3, 'expiry': expiry, 'value': value}
+
+    def testGetReturnsViewIntoSlab(self):
+        self.set(b'foo', b'bar')
+        value = self.storage[b'foo']
+
+        self.assertEqual(value['flags'], 3)
+        self.assertTrue(isinstance(value['value'], memoryview))
+        self.assertEqual(value['value'].tobytes(), b'bar')
+        self.assertEqual(self.storage.bytes, 6)
+        self.assertRaises(KeyError, self.storage.__getitem__, b'baz')
+
+    def testSizeClasses(self):
+        self.set(b'small', b'x' * 10)
+        self.set(b'big', b'x' * 100)
+        small = self.storage.classes[0]
+
+        self.assertEqual(small.size, SlabStorage.MIN_CHUNK_SIZE)
+        self.assertEqual(list(small.lru()), [b'small'])
+        self.assertEqual(self.storage.pages, 2)
+        self.assertEqual(self.storage.sizes[-1], 1024)
+        self.assertRaises(OutOfMemory, self.set, b'huge', b'x' * 1025)
+
+    def testOverwriteOutOfMemory(self):
+        self.set(b'foo', b'bar', expiry=10)
+        self.set(b'big', b'x' * 1000)
+        # No page left for its size class
+        self.assertRaises(OutOfMemory, self.set, b'foo', b'x' * 200)
+        self.assertFalse(b'foo' in self.storage)
+        self.assertEqual(self.storage.expires, {})
+
+    def testOverwriteAndDeleteReuseChunks(self):
+        self.set(b'foo', b'bar')
+        self.set(b'foo', b'bazz')
+        self.assertEqual(self.storage[b'foo']['value'].tobytes(), b'bazz')
+        self.assertEqual(list(self.storage.classes[0].lru()), [b'foo'])
+
+        del self.storage[b'foo']
+        self.assertFalse(b'foo' in self.storage)
+        self.assertEqual(self.storage.bytes, 0)
+        self.assertEqual(len(self.storage.classes[0].free),
+            self.storage.classes[0].per_page)
+
+    def testEvictsWithinClass(self):
+        slab = self.storage.classes[0]
+        for i in range(slab.per_page):
+            self.set(str(i).encode(), b'bar')
+        self.set(b'big', b'x' * 1000)
+        self.assertEqual(self.storage.pages, 2)
+
+        self.set(b'new', b'bar')
+
+        self.assertFalse(b'0' in self.storage)
+        self.assertTrue(b'big' in self.storage)
+        self.assertEqual(self.storage.evictions, 1)
+        # Classes without pages can't take them from others
+        self.assertRaises(OutOfMemory, self.set, b'medium', b'x' * 100)
+
+    def testLeastRecentlyUsedOrder(self):
+        slab = self.storage.classes[0]
+        for key in (b'a', b'b', b'c', b'd'):
+            self.set(key, b'bar')
+        self.clock.advance(SlabStorage.BUMP_INTERVAL)
+        self.storage[b'a']
+        self.assertEqual(list(slab.lru()), [b'b', b'c', b'd', b'a'])
+
+        del self.storage[b'c']
+        del self.storage[b'b']
+        self.set(b'd', b'baz')
+        self.assertEqual(list(slab.lru()), [b'a', b'd'])
+        del self.storage[b'd']
+        del self.storage[b'a']
+        self.assertEqual(list(slab.lru()), [])
+        self.set(b'e', b'bar')
+        self.assertEqual(list(slab.lru()), [b'e'])
+
+    def testCasOver32Bits(self):
+        self.storage.cas = 2 ** 40
+        self.set(b'foo', b'bar')
+        self.assertEqual(self.storage[b'foo']['cas'], 2 ** 40 + 1)
+
+    def testCounter(self):
+        self.set(b'foo', b'99', 10)
+        self.assertEqual(self.storage.counter(b'foo', 1, 0, 0), (100, 2))
+        self.assertEqual(self.storage[b'foo']['value'].tobytes(), b'100')
+        self.assertEqual(self.storage[b'foo']['flags'], 3)
+        self.assertEqual(self.storage.expires, {b'foo': 10})
+        self.assertRaises(KeyError, self.storage.counter, b'bar', 1, None, 0)
+
+    def testExpiry(self):
+        self.set(b'foo', b'bar', 1)
+        self.clock.advance(1)
+
+        self.assertFalse(b'foo' in self.storage)
+        self.assertEqual(self.storage.index, {})
+        self.assertEqual(self.storage.expirations, 1)
+
+    def testServeFromSlab(self):
+        factory = MemcachedFactory(self.storage)
+        protocol = factory.buildProtocol(('127.0.0.1', 0))
+        tr = proto_helpers.StringTransport()
+        protocol.makeConnection(tr)
+        self.set(b'foo', b'bar')
+
+        protocol.dataReceived(struct.pack('!BBHBBHLLQ3s', 0x80, 0x00, 3, 0, 0,
+            0, 3, 0, 0, b'foo'))
+
+        self.assertEqual(tr.value(), b'\x81\x00\x00\x00\x04\x00\x00\x00' + \
+            b'\x00\x00\x00\x07\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'\x00\x01\x00\x00\x00\x03bar')
+
+
+class FakeBackend:
+    def __init__(self):
+        self.requests = []
+
+    def request(self, frame):
+        d = defer.Deferred()
+        self.requests.append((frame, d))
+        return d
+
+
+class ShardTests(unittest.TestCase):
+    HEADER_STRUCT = '!BBHBBHLLQ'
+
+    def setUp(self):
+        self.storage = MemoryStorage()
+        self.backend = FakeBackend()
+        # Pick a local and a remote key for a two workers setup
+        self.local = b'foo'
+        self.remote = next(key for key in (b'bar', b'baz', b'qux', b'quux')
+            if shard_for(key, 2) != shard_for(self.local, 2))
+        backends = [None, None]
+        backends[shard_for(self.remote, 2)] = self.backend
+        factory = MemcachedFactory(self.storage,
+            Shards(shard_for(self.local, 2), backends))
+        self.protocol = factory.buildProtocol(('127.0.0.1', 0))
+        self.tr = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.tr)
+        self.storage[self.local] = {'flags': 0, 'expiry': 0, 'value': b'local'}
+
+    def get(self, command, key, opaque=0):
+        return struct.pack(self.HEADER_STRUCT + '%ds' % len(key), 0x80,
+            command, len(key), 0, 0, 0, len(key), opaque, 0, key)
+
+    def response(self, command, status, body=b'', opaque=0):
+        return struct.pack(self.HEADER_STRUCT, 0x81, command, 0, 0, 0, status,
+            len(body), opaque, 0) + body
+
+    def testShardFor(self):
+        self.assertEqual(shard_for(b'foo', 1), 0)
+        self.assertEqual(shard_for(b'foo', 4), shard_for(b'foo', 4))
+        self.assertEqual(set(shard_for(str(i).encode(), 4) for i in range(100)),
+            set(range(4)))
+
+    def testForwardedResponsesKeepOrder(self):
+        self.protocol.dataReceived(self.get(0x00, self.local, 1) +
+            self.get(0x00, self.remote, 2) + self.get(0x00, self.local, 3))
+
+        first = self.tr.value()
+        self.assertEqual(struct.unpack_from('!L', first, 12)[0], 1)
+        self.assertEqual(len(self.backend.requests), 1)
+        self.assertEqual(self.backend.requests[0][0],
+            self.get(0x00, self.remote, 2))
+
+        remote = self.response(0x00, 0x00, b'\x00\x00\x00\x00remote', 2)
+        self.backend.requests[0][1].callback(remote)
+
+        rest = self.tr.value()[len(first):]
+        self.assertEqual(rest[:len(remote)], remote)
+        self.assertEqual(struct.unpack_from('!L', rest, len(remote) + 12)[0], 3)
+
+    def testForwardedQuietCommands(self):
+        self.protocol.dataReceived(self.get(0x09, self.remote) +
+            self.get(0x0d, self.remote) + self.get(0x0a, b''))
+
+        # Sent loud so they are always answered
+        self.assertEqual([frame[1:2] for frame, d in self.backend.requests],
+            [b'\x00', b'\x0c'])
+        self.backend.requests[0][1].callback(self.response(0x00, 0x01,
+            b'Not found'))
+        self.backend.requests[1][1].callback(self.response(0x0c, 0x00,
+            b'\x00\x00\x00\x00value'))
+
+        self.assertEqual(self.tr.value(), self.response(0x0d, 0x00,
+            b'\x00\x00\x00\x00value') + self.response(0x0a, 0x00))
+
+    def testForwardFailed(self):
+        self.protocol.dataReceived(self.get(0x00, self.remote, 5))
+        self.backend.requests[0][1].errback(Exception('gone'))
+
+        self.assertEqual(self.tr.value(), self.response(0x00, 0x86,
+            b'Temporary failure', 5))
+
+    def testFlushReachesEveryWorker(self):
+        flush = struct.pack(self.HEADER_STRUCT + 'L2s', 0x80, 0x08, 2, 4, 0,
+            0, 6, 7, 0, 0, b't1')
+        self.storage[b't1:foo'] = {'flags': 0, 'expiry': 0, 'value': b'x'}
+        self.protocol.dataReceived(flush)
+        self.assertFalse(b't1:foo' in self.storage)
+        self.assertTrue(self.local in self.storage)
+
+        # Answered once the other workers are flushed too
+        self.assertEqual(self.tr.value(), b'')
+        self.assertEqual([frame for frame, d in self.backend.requests],
+            [flush])
+        self.backend.requests[0][1].callback(self.response(0x08, 0x00,
+            opaque=7))
+        self.assertEqual(self.tr.value(), self.response(0x08, 0x00,
+            opaque=7))
+
+        # Flushes from other workers are not sent on
+        tr = proto_helpers.StringTransport(
+            peerAddress=address.UNIXAddress('worker.sock'))
+        protocol = self.protocol.factory.buildProtocol(None)
+        protocol.makeConnection(tr)
+        protocol.dataReceived(struct.pack(self.HEADER_STRUCT, 0x80, 0x18, 0,
+            0, 0, 0, 0, 8, 0))
+        self.assertEqual(len(self.backend.requests), 1)
+        self.assertEqual(tr.value(), b'')
+        self.assertFalse(self.local in self.storage)
+
+
+class ProxyTests(unittest.TestCase):
+    HEADER_STRUCT = '!BBHBBHLLQ'
+
+    def setUp(self):
+        self.backends = dict(('127.0.0.1:%d' % port, FakeBackend())
+            for port in (11211, 11212, 11213))
+        self.ring = Ring(self.backends)
+        self.clock = task.Clock()
+        self.ring.callLater = self.clock.callLater
+        self.keys = [('key:%d' % i).encode('ascii') for i in range(1000)]
+
+    def owners(self):
+        return dict((key, self.ring.route(key).name) for key in self.keys)
+
+    def testKetamaPoints(self):
+        points = list(ketama_points('127.0.0.1:11211', 160))
+        self.assertEqual(len(points), 160)
+        self.assertEqual(len(set(points)), 160)
+        self.assertEqual(points, list(ketama_points('127.0.0.1:11211', 160)))
+
+    def testKeysAreSpread(self):
+        owners = self.owners()
+        for name in self.backends:
+            share = list(owners.values()).count(name)
+            self.assertTrue(200 < share < 450, (name, share))
+
+    def testEjectingMovesOnlyItsKeys(self):
+        before = self.owners()
+        self.ring.eject('127.0.0.1:11212')
+        after = self.owners()
+        for key in self.keys:
+            if before[key] != '127.0.0.1:11212':
+                self.assertEqual(after[key], before[key])
+            else:
+                self.assertNotEqual(after[key], '127.0.0.1:11212')
+
+        self.clock.advance(Ring.RETRY_INTERVAL)
+        self.assertEqual(self.owners(), before)
+
+    def testFailingNodesAreEjected(self):
+        node = self.ring.route(b'foo')
+        failures = []
+        for i in range(Ring.FAILURE_LIMIT):
+            node.request(b'frame').addErrback(failures.append)
+            self.backends[node.name].requests.pop()[1].errback(
+                Exception('gone'))
+        self.assertEqual(len(failures), Ring.FAILURE_LIMIT)
+        self.assertEqual(self.ring.ejected, set([node.name]))
+        self.assertNotEqual(self.ring.route(b'foo'), node)
+
+        # Everything ejected
+        for name in self.backends:
+            self.ring.eject(name)
+        self.ring.route(b'foo').request(b'frame').addErrback(failures.append)
+        self.assertEqual(len(failures), Ring.FAILURE_LIMIT + 1)
+
+    def testMultiGetIsSplitAndMerged(self):
+        protocol = MemcachedFactory(MemoryStorage(),
+            self.ring).buildProtocol(None)
+        tr = proto_helpers.StringTransport()
+        protocol.makeConnection(tr)
+        keys = self.keys[:6]
+        protocol.dataReceived(b''.join(struct.pack(self.HEADER_STRUCT +
+            '%ds' % len(key), 0x80, 0x0d, len(key), 0, 0, 0, len(key), i, 0,
+            key) for i, key in enumerate(keys)) + struct.pack(
+            self.HEADER_STRUCT, 0x80, 0x0a, 0, 0, 0, 0, 0, 6, 0))
+        self.assertEqual(tr.value(), b'')
+
+        # Every backend got its keys, answered in any order across them
+        requests = dict((name, backend.requests)
+            for name, backend in self.backends.items() if backend.requests)
+        self.assertTrue(len(requests) > 1)
+        for name in sorted(requests, reverse=True):
+            for frame, d in requests[name]:
+                key = frame[codec.HEADER_SIZE:]
+                opaque = struct.unpack_from('!L', frame, 12)[0]
+                status = 0x01 if opaque % 2 else 0x00
+                body = b'' if status else b'\x00' * 4 + key
+                d.callback(struct.pack(self.HEADER_STRUCT, 0x81, 0x0c,
+                    len(key) if not status else 0, 4 if not status else 0,
+                    0, status, len(body), opaque, 0) + body)
+
+        # Misses dropped, hits and the noop in the order sent
+        opaques = []
+        data = tr.value()
+        while data:
+            opaques.append(struct.unpack_from('!L', data, 12)[0])
+            data = data[codec.HEADER_SIZE +
+                struct.unpack_from('!L', data, 8)[0]:]
+        self.assertEqual(opaques, [0, 2, 4, 6])
+
+
+class ClientTests(unittest.TestCase):
+    def testResponsesMatchedInOrder(self):
+        client = MemcachedClientProtocol()
+        tr = proto_helpers.StringTransport()
+        client.makeConnection(tr)
+        results = []
+        for frame in (b'first', b'second'):
+            client.request(frame).addCallback(results.append)
+        self.assertEqual(tr.value(), b'firstsecond')
+
+        first = struct.pack('!BBHBBHLLQ', 0x81, 0, 0, 0, 0, 0, 3, 0, 0) + b'abc'
+        second = struct.pack('!BBHBBHLLQ', 0x81, 0, 0, 0, 0, 1, 0, 0, 0)
+        data = first + second
+        for i in range(len(data)):
+            client.dataReceived(data[i:i + 1])
+
+        self.assertEqual(results, [first, second])
+
+
+class FakeAsyncioTransport:
+    def __init__(self):
+        self.written = []
+        self.closed = False
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    def writelines(self, data):
+        self.written.extend(bytes(chunk) for chunk in data)
+
+    def close(self):
+        self.closed = True
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 12345)
+
+    def set_write_buffer_limits(self, high=None):
+        self.high = high
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+    def value(self):
+        return b''.join(self.written)
+
+
+class AsyncioTests(unittest.TestCase):
+    def setUp(self):
+        self.storage = MemoryStorage()
+        self.clock = task.Clock()
+        self.storage.callLater = self.clock.callLater
+        self.storage.seconds = self.clock.seconds
+        self.protocol = aio.MemcachedFactory(self.storage)()
+        self.tr = FakeAsyncioTransport()
+        self.protocol.connection_made(self.tr)
+
+    def feed(self, data, chunk):
+        for start in range(0, len(data), chunk):
+            piece = data[start:start + chunk]
+            while piece:
+                buffer = self.protocol.get_buffer(-1)
+                size = min(len(buffer), len(piece))
+                buffer[:size] = piece[:size]
+                self.protocol.buffer_updated(size)
+                piece = piece[size:]
+
+    def set(self, key, value, expiry=0):
+        return codec.encodeRequestHeader(0x01, len(key), 8, 0,
+            8 + len(key) + len(value), 0, 0) + \
+            codec.STORE_EXTRAS.pack(0, expiry) + key + value
+
+    def get(self, key):
+        return codec.encodeRequestHeader(0x00, len(key), 0, 0, len(key), 0,
+            0) + key
+
+    def testFragmentedAndPipelined(self):
+        expected = b'\x81\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x01'+ \
+            b'\x81\x00\x00\x00\x04\x00\x00\x00\x00\x00\x00\x07\x00\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x00\x00\x01\x00\x00\x00\x00bar'
+        data = self.set(b'foo', b'bar') + self.get(b'foo')
+        self.feed(data, 10)
+        self.assertEqual(self.tr.value(), expected)
+        self.assertEqual(self.protocol.stats.bytes_read, len(data))
+
+        # Both at once
+        self.tr.written = []
+        self.feed(data, len(data))
+        self.assertEqual(self.tr.value()[-3:], b'bar')
+        self.assertEqual(self.protocol.client, '127.0.0.1:12345')
+
+    def testBufferGrowsForBigFrames(self):
+        self.patch(aio.Memcached, 'BUFFER_SIZE', 64)
+        self.patch(aio.Memcached, 'MIN_READ', 16)
+        self.protocol = aio.MemcachedFactory(self.storage)()
+        self.protocol.connection_made(self.tr)
+        value = b'x' * 1000
+
+        self.feed(self.get(b'foo') + self.set(b'foo', value), 100)
+        self.assertEqual(self.storage[b'foo']['value'], value)
+        self.assertTrue(len(self.tr.written))
+        # Back to its size once the frame was handled
+        self.assertEqual(len(self.protocol._buffer), 64)
+
+        self.tr.written = []
+        self.feed(self.get(b'foo'), 5)
+        self.assertEqual(self.tr.value()[-1000:], value)
+
+    def testSweepsExpiredKeysFromTicks(self):
+        self.storage[b'foo'] = {'flags': 0, 'expiry': 1, 'value': b'bar'}
+        self.storage.sweep_from_ticks()
+        self.assertEqual(self.clock.calls, [])
+
+        self.storage[b'bar'] = {'flags': 0, 'expiry': 2, 'value': b'bar'}
+        self.clock.advance(2)
+        self.assertEqual(self.storage.expirations, 0)
+        self.feed(self.get(b'baz'), 100)
+        self.assertEqual(self.storage.expirations, 2)
+        self.assertEqual(self.clock.calls, [])
+
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.storage = self.makeStorage(MemoryStorage)
+        self.path = temporaryPath(self)
+
+    def makeStorage(self, factory):
+        storage = factory()
+        storage.callLater = self.clock.callLater
+        storage.seconds = self.clock.seconds
+        return storage
+
+    def takeSnapshot(self):
+        snapshotter = snapshot.Snapshotter(self.storage, self.path)
+        done = []
+        snapshotter.snapshot().addCallback(done.append)
+        while not done:
+            self.clock.advance(0)
+        return snapshotter
+
+    def testRoundTrip(self):
+        self.storage[b'foo'] = {'flags': 1, 'expiry': 0, 'value': b'bar'}
+        self.storage[b'baz'] = {'flags': 2, 'expiry': 100, 'value': b''}
+        self.storage[b'old'] = {'flags': 3, 'expiry': 10, 'value': b'old'}
+        self.takeSnapshot()
+
+        self.clock.advance(50)
+        storage = self.makeStorage(MemoryStorage)
+        self.assertEqual(snapshot.load(storage, self.path), 2)
+
+        self.assertEqual(storage.keys(), [b'foo', b'baz'])
+        self.assertEqual(storage[b'foo']['value'], b'bar')
+        self.assertEqual(storage[b'foo']['flags'], 1)
+        self.assertEqual(storage[b'baz']['value'], b'')
+        self.assertEqual(storage.expires, {b'baz': 1100})
+
+    def testFlushedItemsAreSkipped(self):
+        self.storage[b'foo'] = {'flags': 1, 'expiry': 0, 'value': b'bar'}
+        self.storage.flush()
+        self.storage[b'baz'] = {'flags': 1, 'expiry': 0, 'value': b'bar'}
+        self.takeSnapshot()
+
+        storage = self.makeStorage(MemoryStorage)
+        self.assertEqual(snapshot.load(storage, self.path), 1)
+        self.assertEqual(storage.keys(), [b'baz'])
+
+    def testCounters(self):
+        self.storage.counter(b'foo', 1, 41, 0)
+        self.storage.counter(b'foo', 1, 0, 0)
+        self.takeSnapshot()
+
+        storage = self.makeStorage(SlabStorage)
+        snapshot.load(storage, self.path)
+        self.assertEqual(storage[b'foo']['value'].tobytes(), b'42')
+
+    def testSlabStorage(self):
+        self.storage = self.makeStorage(SlabStorage)
+        self.storage[b'foo'] = {'flags': 1, 'expiry': 0, 'value': b'bar'}
+        self.takeSnapshot()
+
+        storage = self.makeStorage(SlabStorage)
+        self.assertEqual(snapshot.load(storage, self.path), 1)
+        self.assertEqual(storage[b'foo']['value'].tobytes(), b'bar')
+
+    def testRunsInSlices(self):
+        for i in range(10):
+            self.storage[str(i).encode()] = {'flags': 0, 'expiry': 0,
+                'value': b'bar'}
+        slices = []
+
+        def callLater(delay, *args):
+            slices.append(delay)
+            return self.clock.callLater(delay, *args)
+        self.storage.callLater = callLater
+
+        snapshotter = snapshot.Snapshotter(self.storage, self.path)
+        snapshotter.SLICE = -1
+        done = []
+        snapshotter.snapshot().addCallback(done.append)
+        # A second request while running waits for the same snapshot
+        snapshotter.snapshot().addCallback(done.append)
+        self.clock.advance(0)
+
+        self.assertEqual(len(done), 2)
+        # One item per slice when slices are over right away
+        self.assertTrue(len(slices) >= 10)
+        self.assertEqual(snapshot.load(self.makeStorage(MemoryStorage),
+            self.path), 10)
+
+    def testInvalidSnapshots(self):
+        self.storage[b'foo'] = {'flags': 1, 'expiry': 0, 'value': b'bar'}
+        self.takeSnapshot()
+        with open(self.path, 'rb') as f:
+            data = f.read()
+
+        for broken in (b'', b'XXXX\x01', data[:-3], data[:-8] + b'\x00' * 8):
+            with open(self.path, 'wb') as f:
+                f.write(broken)
+            self.assertRaises(snapshot.SnapshotError, snapshot.load,
+                self.makeStorage(MemoryStorage), self.path)
+
+
+class ReplicationTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.storage = self.makeStorage()
+        self.primary = Primary(self.storage, tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.primary.directory, True)
+        self.primary.seconds = self.clock.seconds
+        self.primary.callLater = self.clock.callLater
+        self.primary.heartbeat.clock = self.clock
+        self.protocol = MemcachedFactory(self.storage,
+            replication=self.primary).buildProtocol(None)
+        self.protocol.makeConnection(proto_helpers.StringTransport())
+
+        self.replicaStorage = self.makeStorage()
+        self.replica = Replica(self.replicaStorage, 'localhost', 11212,
+            self.primary.directory)
+        self.replica.seconds = self.clock.seconds
+
+    def makeStorage(self):
+        storage = MemoryStorage()
+        storage.callLater = self.clock.callLater
+        storage.seconds = self.clock.seconds
+        return storage
+
+    def request(self, command, key, extras=b'', value=b''):
+        self.protocol.dataReceived(codec.encodeRequestHeader(command,
+            len(key), len(extras), 0, len(extras) + len(key) + len(value),
+            0, 0) + extras + key + value)
+
+    def set(self, key, value, expiry=0):
+        self.request(0x01, key, codec.STORE_EXTRAS.pack(1, expiry), value)
+
+    def connect(self):
+        """
+        Connect a replica and send it the snapshot, return the transports
+        of both ends.
+        """
+        feed = self.primary.buildProtocol(None)
+        feedTransport = proto_helpers.StringTransport()
+        feed.makeConnection(feedTransport)
+        stream = self.replica.buildProtocol(None)
+        streamTransport = proto_helpers.StringTransport()
+        stream.makeConnection(streamTransport)
+        while not feedTransport.producer:
+            self.clock.advance(0)
+        while not feed.streaming:
+            feedTransport.producer.resumeProducing()
+        return feed, feedTransport, stream, streamTransport
+
+    def pump(self, feed, feedTransport, stream, streamTransport):
+        self.clock.advance(0)
+        data = feedTransport.value()
+        feedTransport.clear()
+        # One byte at a time, replicas cope with any fragmentation
+        for i in range(len(data)):
+            stream.dataReceived(data[i:i + 1])
+        feed.dataReceived(streamTransport.value())
+        streamTransport.clear()
+
+    def testBootstrapsThenStreams(self):
+        self.set(b'old', b'value')
+        self.set(b'gone', b'value')
+        self.replicaStorage[b'stale'] = {'flags': 0, 'expiry': 0,
+            'value': b'value'}
+        ends = self.connect()
+        # Written while the snapshot is being sent
+        self.request(0x04, b'gone')
+        self.pump(*ends)
+
+        self.assertEqual(self.replica.state, 'streaming')
+        self.assertEqual(self.replicaStorage[b'old']['value'], b'value')
+        self.assertNotIn(b'gone', self.replicaStorage)
+        self.assertNotIn(b'stale', self.replicaStorage)
+
+        self.set(b'new', b'value', expiry=100)
+        self.request(0x05, b'counter',
+            codec.COUNTER_EXTRAS.pack(1, 41, 0))
+        self.request(0x05, b'counter',
+            codec.COUNTER_EXTRAS.pack(1, 0, 0))
+        self.pump(*ends)
+
+        self.assertEqual(self.replicaStorage[b'new']['flags'], 1)
+        self.assertEqual(self.replicaStorage.deadline(b'new'), 1100)
+        self.assertEqual(self.replicaStorage[b'counter']['value'], b'42')
+
+        self.set(b'ns:key', b'value')
+        self.request(0x08, b'ns')
+        self.pump(*ends)
+        self.assertNotIn(b'ns:key', self.replicaStorage)
+        self.assertIn(b'old', self.replicaStorage)
+        self.assertEqual(os.listdir(self.primary.directory), [])
+
+    def testLag(self):
+        ends = self.connect()
+        self.pump(*ends)
+        self.set(b'foo', b'bar')
+        self.clock.advance(0)
+        self.clock.advance(0.25)
+        self.pump(*ends)
+
+        self.assertEqual(self.replica.lag, 0.25)
+        self.assertEqual(ends[0].lag, 0.25)
+        stats = dict(self.primary.stats())
+        self.assertEqual(stats['replicas'], 1)
+        self.assertEqual(stats['replica:192.168.1.1:54321:lag_ms'], 250)
+        self.assertEqual(stats['replica:192.168.1.1:54321:state'],
+            'streaming')
+        self.assertEqual(dict(self.replica.stats())['applied'], 1)
+
+        # Idle primaries send heartbeats
+        self.primary.startFactory()
+        self.clock.advance(self.primary.HEARTBEAT)
+        self.pump(*ends)
+        self.assertEqual(ends[0].lag, 0)
+        self.primary.stopFactory()
+
+    def testDisconnectedReplicasAreDropped(self):
+        feed, feedTransport, stream, streamTransport = self.connect()
+        feed.connectionLost(None)
+        self.set(b'foo', b'bar')
+        self.assertEqual(self.primary.feeds, [])
+        self.assertEqual(feed.records, [])
+
+    def testBatchesAreJoinedOnceComplete(self):
+        feed, feedTransport, stream, streamTransport = self.connect()
+        self.pump(feed, feedTransport, stream, streamTransport)
+        self.set(b'foo', b'x' * 1000)
+        self.clock.advance(0)
+        data = feedTransport.value()
+        for i in range(0, len(data) - 100, 100):
+            stream.dataReceived(data[i:i + 100])
+        self.assertEqual(len(stream._chunks), len(data) // 100)
+        self.assertNotIn(b'foo', self.replicaStorage)
+
+        stream.dataReceived(data[len(data) // 100 * 100:])
+        self.assertEqual(stream._chunks, [])
+        self.assertEqual(self.replicaStorage[b'foo']['value'], b'x' * 1000)
+
+    def testReplicasFallingBehindAreDisconnected(self):
+        self.primary.MAX_BACKLOG = 2000
+        feed, feedTransport, stream, streamTransport = self.connect()
+        feedTransport.clear()
+        feed.pauseProducing()
+        self.set(b'foo', b'x' * 1000)
+        self.clock.advance(0)
+        # Kept until the transport drained
+        self.assertEqual(feedTransport.value(), b'')
+        feed.resumeProducing()
+        self.assertTrue(feedTransport.value())
+        self.assertEqual(feed.backlog, 0)
+
+        feed.pauseProducing()
+        self.set(b'foo', b'x' * 1000)
+        self.set(b'bar', b'x' * 1000)
+        self.clock.advance(0)
+        self.assertEqual(self.primary.feeds, [])
+        self.assertEqual(feed.records, [])
+        self.assertTrue(feedTransport.disconnecting)
+
+
+class OpLogStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        # Replaying the log on open already needs the clock
+        self.patch(reactor, 'seconds', self.clock.seconds)
+        self.patch(reactor, 'callLater', self.clock.callLater)
+        self.path = temporaryPath(self)
+        self.storage = self.open()
+
+    def tearDown(self):
+        self.storage.close()
+
+    def open(self, **options):
+        return OpLogStorage(self.path, fsync='never', **options)
+
+    def reopen(self):
+        self.storage.close()
+        self.storage = self.open()
+
+    def set(self, key, value, expiry=0):
+        self.storage[key] = {'flags': 1, 'expiry': expiry, 'value': value}
+
+    def testWritesAreBatched(self):
+        self.set(b'foo', b'bar')
+        self.set(b'baz', b'qux')
+        self.assertEqual(os.path.getsize(self.path), 0)
+        # Readable before being written
+        self.assertEqual(self.storage[b'foo']['value'], b'bar')
+
+        self.storage.commit()
+        self.assertEqual(os.path.getsize(self.path), self.storage.size)
+        self.assertEqual(self.storage.pending, {})
+        self.assertEqual(self.storage[b'foo'],
+            {'flags': 1, 'cas': 1, 'value': b'bar', 'datatype': 0})
+
+    def testCommitsWhenNobodyDoes(self):
+        self.set(b'foo', b'bar')
+        self.clock.advance(0)
+        self.assertEqual(os.path.getsize(self.path), self.storage.size)
+
+    def testReplayFlushes(self):
+        self.set(b'foo', b'bar')
+        self.set(b't1:foo', b'bar')
+        self.storage.flush(namespace=b't1')
+        self.set(b't1:bar', b'bar')
+        self.reopen()
+        self.assertEqual(sorted(key for key in self.storage.keys()
+            if key in self.storage), [b'foo', b't1:bar'])
+
+        self.storage.flush()
+        self.reopen()
+        self.assertFalse(b'foo' in self.storage)
+
+    def testCompactionReclaimsFlushedItems(self):
+        self.set(b'foo', b'bar')
+        self.storage.flush()
+        self.set(b'baz', b'bar')
+        done = []
+        self.storage.compact().addCallback(done.append)
+        self.clock.advance(0)
+
+        self.assertTrue(done)
+        self.assertEqual(self.storage.keys(), [b'baz'])
+        self.assertEqual(self.storage.size, self.storage.live)
+        self.reopen()
+        self.assertEqual(self.storage.keys(), [b'baz'])
+
+    def testReplay(self):
+        self.set(b'foo', b'bar')
+        self.set(b'foo', b'baz')
+        self.set(b'gone', b'bar')
+        del self.storage[b'gone']
+        self.set(b'ttl', b'bar', 100)
+        self.reopen()
+
+        self.assertEqual(sorted(self.storage.keys()), [b'foo', b'ttl'])
+        self.assertEqual(self.storage[b'foo']['value'], b'baz')
+        self.assertEqual(self.storage.expires, {b'ttl': 100})
+        self.clock.advance(100)
+        self.assertFalse(b'ttl' in self.storage)
+
+    def testReplayDropsIncompleteRecords(self):
+        self.set(b'foo', b'bar')
+        self.storage.commit()
+        size = self.storage.size
+        with open(self.path, 'ab') as f:
+            f.write(b'\x01\x00\x03')
+        self.reopen()
+
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(self.storage[b'foo']['value'], b'bar')
+
+    def testCompaction(self):
+        for i in range(10):
+            self.set(b'foo', str(i).encode() * 100)
+        self.set(b'bar', b'bar')
+        self.storage.commit()
+        self.assertTrue(self.storage.size > self.storage.live * 5)
+
+        done = []
+        self.storage.compact().addCallback(done.append)
+        # Written while compacting
+        self.set(b'baz', b'baz')
+        self.set(b'bar', b'new')
+        self.clock.advance(0)
+
+        self.assertTrue(done)
+        self.assertEqual(self.storage.compactions, 1)
+        self.assertEqual(self.storage.size, self.storage.live)
+        self.assertEqual(os.path.getsize(self.path), self.storage.size)
+        self.reopen()
+        self.assertEqual(self.storage[b'foo']['value'], b'9' * 100)
+        self.assertEqual(self.storage[b'bar']['value'], b'new')
+        self.assertEqual(self.storage[b'baz']['value'], b'baz')
+
+    def compactInSlices(self):
+        """
+        Compact one record per second of the clock, so tests can write in
+        between.
+        """
+        self.storage.SLICE = -1
+        self.storage.callLater = lambda delay, *args, **kwargs: \
+            self.clock.callLater(1, *args, **kwargs)
+        done = []
+        self.storage.compact().addCallback(done.append)
+        return done
+
+    def testDeletesWhileCompacting(self):
+        self.set(b'foo', b'bar')
+        self.set(b'bar', b'bar')
+        self.set(b'baz', b'bar')
+        self.storage.commit()
+
+        done = self.compactInSlices()
+        self.clock.advance(1)
+        # Copied already
+        del self.storage[b'foo']
+        self.clock.advance(1)
+        # Not copied yet
+        del self.storage[b'baz']
+        while not done:
+            self.clock.advance(1)
+
+        self.assertEqual(self.storage.keys(), [b'bar'])
+        self.reopen()
+        self.assertEqual(self.storage.keys(), [b'bar'])
+
+    def testCompactionCountsLiveRecords(self):
+        for i in range(6):
+            self.set(str(i).encode(), b'old')
+        self.storage.commit()
+
+        done = self.compactInSlices()
+        for i in range(6):
+            self.clock.advance(1)
+            key = str(i).encode()
+            if i % 2:
+                del self.storage[key]
+            else:
+                self.set(key, b'new' * 10)
+        while not done:
+            self.clock.advance(1)
+
+        # Dead copies of the keys written meanwhile are left in the log
+        self.assertTrue(self.storage.size > self.storage.live)
+        live = self.storage.live
+        self.reopen()
+        self.assertEqual(self.storage.live, live)
+
+    def testProtocolCommitsBeforeAnswering(self):
+        protocol = MemcachedFactory(self.storage).buildProtocol(
+            ('127.0.0.1', 0))
+        tr = proto_helpers.StringTransport()
+        protocol.makeConnection(tr)
+
+        protocol.dataReceived(struct.pack('!BBHBBHLLQLL3s3s', 0x80, 0x01, 3,
+            8, 0, 0, 14, 0, 0, 0, 0, b'foo', b'bar'))
+
+        self.assertEqual(len(tr.value()), 24)
+        self.assertEqual(os.path.getsize(self.path), self.storage.size)
+
+    def testInvalidFsyncPolicy(self):
+        self.assertRaises(ValueError, OpLogStorage, self.path, fsync='maybe')